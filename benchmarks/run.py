@@ -0,0 +1,229 @@
+"""
+End-to-end download benchmarks against local stand-in servers
+
+Each case downloads one file in a fresh interpreter, so the CPU time and the peak RSS of the
+downloader and its worker processes are measured without the servers and without the cases before
+it. Results are written as JSON and can be compared with the results of another release:
+
+    python -m benchmarks.run --sizes 16 256 --output results.json
+    python -m benchmarks.run --sizes 16 256 --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+MODES = ('stream', 'sliced', 'm3u8', 'ftp', 'sftp')
+MB = 1024 * 1024
+
+
+def _peak_rss() -> int:
+    """
+    Peak resident set size in bytes of this process and its waited-for children
+    """
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _cpu_time() -> float:
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    )
+
+
+def run_case(case: dict) -> dict:
+    """
+    Download one file and measure it, called in the interpreter of the case
+
+    :param case: Mode, size, uri and save path of the case
+    :return: Measurements
+    """
+    from yundownload import Downloader, Resources
+    from yundownload.utils.logger import logger
+
+    logger.setLevel('WARNING')
+    options = {}
+    if case['mode'] == 'stream':
+        options.update(http_stream=True)
+    elif case['mode'] == 'sliced':
+        options.update(http_slice_threshold=1, http_sliced_chunk_size=max(MB, case['size'] // 16))
+    resources = Resources(case['uri'], case['save_path'], retry=1, **options)
+
+    cpu = _cpu_time()
+    started = time.perf_counter()
+    with Downloader() as d:
+        worker_future = d.submit(resources)
+        worker_future.wait()
+        result = worker_future.state
+    seconds = time.perf_counter() - started
+    cpu = _cpu_time() - cpu
+
+    size = Path(case['save_path']).stat().st_size if Path(case['save_path']).exists() else 0
+    return {
+        'result': result.name,
+        'bytes': size,
+        'seconds': seconds,
+        'mb_per_s': size / MB / seconds if seconds else 0.0,
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_gb': cpu / (size / 1024 ** 3) if size else None,
+        'peak_rss_mb': _peak_rss() / MB
+    }
+
+
+def _servers(stack: ExitStack, root: Path, modes: list[str], rate: int | None, latency: float) -> dict:
+    from benchmarks.servers import HttpServer, FtpServer, SftpServer
+
+    servers = {}
+    if {'stream', 'sliced', 'm3u8'} & set(modes):
+        servers['http'] = stack.enter_context(HttpServer(root, rate=rate, latency=latency))
+    if 'ftp' in modes:
+        try:
+            servers['ftp'] = stack.enter_context(FtpServer(root))
+        except ImportError:
+            print('pyftpdlib is not installed, skipping ftp', file=sys.stderr)
+    if 'sftp' in modes:
+        servers['sftp'] = stack.enter_context(SftpServer(root))
+    return servers
+
+
+def _uri(servers: dict, mode: str, name: str) -> str | None:
+    if mode == 'm3u8':
+        return servers['http'].url(f'{name}-hls/index.m3u8')
+    server = servers.get('http' if mode in ('stream', 'sliced') else mode)
+    return server.url(name) if server else None
+
+
+def run(sizes: list[int], modes: list[str], repeat: int = 1, rate: int = None, latency: float = 0,
+        workdir: Path = None) -> dict:
+    """
+    Run every mode against every file size
+
+    :param sizes: File sizes in MB
+    :param modes: Download modes
+    :param repeat: Number of runs of each case
+    :param rate: Rate of each server connection in bytes per second
+    :param latency: Delay in seconds before each HTTP response
+    :param workdir: Directory for the served and downloaded files, a temporary one by default
+    :return: Benchmark report
+    """
+    from benchmarks.servers import make_file, make_hls
+    from yundownload import __version__
+
+    temporary = workdir is None
+    workdir = Path(workdir or tempfile.mkdtemp(prefix='yundownload-benchmark-'))
+    root, downloads = workdir / 'serve', workdir / 'downloads'
+    root.mkdir(parents=True, exist_ok=True)
+    results = []
+    with ExitStack() as stack:
+        servers = _servers(stack, root, modes, rate, latency)
+        for size in sizes:
+            name = f'{size}mb.bin'
+            make_file(root / name, size * MB)
+            if 'm3u8' in modes:
+                make_hls(root, f'{name}-hls', size * MB)
+            for mode in modes:
+                uri = _uri(servers, mode, name)
+                if uri is None:
+                    continue
+                for attempt in range(repeat):
+                    shutil.rmtree(downloads, ignore_errors=True)
+                    suffix = '.mp4' if mode == 'm3u8' else '.bin'
+                    case = {'mode': mode, 'size': size * MB, 'uri': uri,
+                            'save_path': str(downloads / f'{mode}-{size}mb{suffix}')}
+                    process = subprocess.run(
+                        [sys.executable, '-m', 'benchmarks.run', '--case', json.dumps(case)],
+                        capture_output=True, text=True, cwd=Path(__file__).resolve().parent.parent
+                    )
+                    if process.returncode:
+                        measurement = {'result': 'ERROR', 'error': process.stderr.strip().splitlines()[-1:]}
+                    else:
+                        measurement = json.loads(process.stdout.strip().splitlines()[-1])
+                    results.append({'mode': mode, 'size_mb': size, 'run': attempt, **measurement})
+                    print(f"{mode:>6} {size:>6} MB  {measurement.get('mb_per_s', 0):8.1f} MB/s  "
+                          f"{measurement['result']}", file=sys.stderr)
+    shutil.rmtree(workdir if temporary else downloads, ignore_errors=True)
+    return {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'server': {'rate': rate, 'latency': latency},
+        'results': results
+    }
+
+
+def compare(report: dict, baseline: dict) -> list[dict]:
+    """
+    Throughput and CPU of each case relative to a baseline report
+
+    :param report: Current report
+    :param baseline: Report of an earlier run
+    :return: One row per case found in both reports
+    """
+
+    def best(results: list[dict]) -> dict:
+        cases = {}
+        for item in results:
+            if item['result'] not in ('SUCCESS', 'EXIST'):
+                continue
+            key = (item['mode'], item['size_mb'])
+            if key not in cases or item['mb_per_s'] > cases[key]['mb_per_s']:
+                cases[key] = item
+        return cases
+
+    current, previous = best(report['results']), best(baseline['results'])
+    rows = []
+    for key in sorted(current.keys() & previous.keys()):
+        now, before = current[key], previous[key]
+        rows.append({
+            'mode': key[0],
+            'size_mb': key[1],
+            'mb_per_s': now['mb_per_s'],
+            'speedup': now['mb_per_s'] / before['mb_per_s'] if before['mb_per_s'] else None,
+            'cpu_ratio': now['cpu_seconds'] / before['cpu_seconds'] if before['cpu_seconds'] else None,
+            'rss_ratio': now['peak_rss_mb'] / before['peak_rss_mb'] if before['peak_rss_mb'] else None
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 128], help='file sizes in MB')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each case')
+    parser.add_argument('--rate', type=int, help='rate of each server connection in bytes per second')
+    parser.add_argument('--latency', type=float, default=0, help='delay in seconds before each HTTP response')
+    parser.add_argument('--workdir', type=Path, help='directory for the served and downloaded files')
+    parser.add_argument('--output', type=Path, help='write the report to this JSON file')
+    parser.add_argument('--compare', type=Path, help='JSON report of an earlier run to compare with')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    report = run(args.sizes, args.modes, args.repeat, args.rate, args.latency, args.workdir)
+    if args.compare:
+        report['comparison'] = compare(report, json.loads(args.compare.read_text()))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import asyncio
+import random
+
+from yundownload.utils.assembly import OrderedAssembler
+from yundownload.utils.writer import WriteBehind
+
+
+def test_parts_are_appended_in_order(tmp_path):
+    path = tmp_path / 'out'
+    parts = [bytes([index]) * random.Random(index).randint(1, 5000) for index in range(40)]
+    recorded = []
+    peak = {'ahead': 0}
+
+    async def main():
+        writer = WriteBehind(max_pending=8 * 1024)
+        fd = writer.open(path, truncate=True)
+        assembler = OrderedAssembler(writer, fd, window=4,
+                                     on_complete=lambda index, size: recorded.append((index, size)))
+        rng = random.Random(0)
+
+        async def part(index: int):
+            await assembler.reserve(index)
+            peak['ahead'] = max(peak['ahead'], index - assembler.head)
+            data = parts[index]
+            for offset in range(0, len(data), 1000):
+                await asyncio.sleep(rng.random() / 1000)
+                await assembler.append(index, data[offset:offset + 1000])
+            await assembler.complete(index)
+
+        await asyncio.gather(*(part(index) for index in reversed(range(len(parts)))))
+        await writer.close_file(fd)
+        await writer.aclose()
+
+    asyncio.run(main())
+    assert path.read_bytes() == b''.join(parts)
+    assert peak['ahead'] < 4
+    sizes = [sum(map(len, parts[:index + 1])) for index in range(len(parts))]
+    assert recorded == list(enumerate(sizes))
+
+
+def test_resume_at_position(tmp_path):
+    path = tmp_path / 'out'
+    path.write_bytes(b'abc')
+
+    async def main():
+        writer = WriteBehind()
+        fd = writer.open(path)
+        assembler = OrderedAssembler(writer, fd, head=3, position=3)
+        await assembler.append(4, b'ef')
+        await assembler.complete(4)
+        await assembler.append(3, b'd')
+        await assembler.complete(3)
+        assert (assembler.head, assembler.position, assembler.buffered) == (5, 6, 0)
+        await writer.close_file(fd)
+        await writer.aclose()
+
+    asyncio.run(main())
+    assert path.read_bytes() == b'abcdef'
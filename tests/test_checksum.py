@@ -0,0 +1,32 @@
+import base64
+import hashlib
+
+from yundownload.utils.checksum import Checksum
+
+
+def test_crc32c():
+    checksum = Checksum('crc32c', 'E3069283')
+    checksum.update(b'1234')
+    checksum.update(b'56789')
+    assert checksum.verify()
+
+
+def test_update_from_file(tmp_path):
+    data = bytes(range(256)) * 100
+    path = tmp_path / 'file.bin'
+    path.write_bytes(data)
+    checksum = Checksum('sha256', hashlib.sha256(data).hexdigest())
+    checksum.update(data[:1000])
+    checksum.update_from_file(path, len(data))
+    assert checksum.position == len(data)
+    assert checksum.verify()
+
+
+def test_from_headers():
+    md5 = base64.b64encode(hashlib.md5(b'data').digest()).decode()
+    sha256 = base64.b64encode(hashlib.sha256(b'data').digest()).decode()
+    checksum = Checksum.from_headers({'Content-MD5': md5, 'Repr-Digest': f'sha-256=:{sha256}:'})
+    assert checksum.algorithm == 'sha256'
+    assert checksum.expected == hashlib.sha256(b'data').hexdigest()
+    assert Checksum.from_headers({'Digest': f'MD5={md5}'}).algorithm == 'md5'
+    assert Checksum.from_headers({}) is None
@@ -0,0 +1,35 @@
+from yundownload import Downloader, Resources, Result
+from yundownload.network.base import BaseProtocolHandler
+
+
+class TouchProtocolHandler(BaseProtocolHandler):
+
+    @staticmethod
+    def check_protocol(uri: str) -> bool:
+        return uri.startswith('touch://')
+
+    def download(self, resources: 'Resources'):
+        resources.save_path.touch()
+        return Result.SUCCESS
+
+    def close(self):
+        pass
+
+
+def test_map_bounds_in_flight(tmp_path):
+    consumed = []
+
+    def resources():
+        for i in range(20):
+            consumed.append(i)
+            yield Resources(uri=f'touch://{i}', save_path=tmp_path / f'{i}.txt', retry=1)
+
+    with Downloader(max_workers=2) as d:
+        d.lock_protocol(TouchProtocolHandler)
+        finished = []
+        for worker_future in d.map(resources(), max_in_flight=3):
+            assert len(consumed) - len(finished) <= 3
+            finished.append(worker_future)
+    assert len(finished) == 20
+    assert all(worker_future.finish() for worker_future in finished)
+    assert len(list(tmp_path.iterdir())) == 20
@@ -0,0 +1,81 @@
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from yundownload import Resources, Result
+from yundownload.core.engine import AsyncDownloadEngine
+from yundownload.network.base import BaseProtocolHandler
+
+
+class TouchProtocolHandler(BaseProtocolHandler):
+    """
+    Creates the save path, ``sleep://<seconds>/...`` waits first, ``crash://`` kills the worker
+    """
+
+    @staticmethod
+    def check_protocol(uri: str) -> bool:
+        return True
+
+    def download(self, resources: 'Resources'):
+        if resources.uri.startswith('crash://'):
+            os._exit(1)
+        if resources.uri.startswith('sleep://'):
+            time.sleep(float(resources.uri[len('sleep://'):].split('/')[0]))
+        resources.save_path.touch()
+        return Result.SUCCESS
+
+    def close(self):
+        pass
+
+
+def _submit(engine: AsyncDownloadEngine, uri: str, save_path):
+    return engine.run_download(TouchProtocolHandler, Resources(uri, save_path, retry=1))
+
+
+def test_engine_dispatches_to_workers(tmp_path):
+    engine = AsyncDownloadEngine(max_workers=2, concurrency=4, batch_size=2)
+    try:
+        futures = [_submit(engine, f'touch://{i}', tmp_path / f'{i}.txt') for i in range(20)]
+        assert all(future.result(timeout=30) == Result.SUCCESS for future in futures)
+    finally:
+        engine.shutdown()
+    assert len(list(tmp_path.iterdir())) == 20
+
+
+def test_engine_cancel_before_dispatch(tmp_path):
+    engine = AsyncDownloadEngine(max_workers=1, concurrency=1, batch_size=1)
+    try:
+        busy = _submit(engine, 'sleep://1/busy', tmp_path / 'busy.txt')
+        waiting = _submit(engine, 'touch://waiting', tmp_path / 'waiting.txt')
+        assert waiting.cancel()
+        assert busy.result(timeout=30) == Result.SUCCESS
+    finally:
+        engine.shutdown()
+    assert waiting.cancelled()
+    assert not (tmp_path / 'waiting.txt').exists()
+
+
+def test_engine_shutdown_finishes_pending_jobs(tmp_path):
+    engine = AsyncDownloadEngine(max_workers=1, concurrency=1, batch_size=1)
+    futures = [_submit(engine, f'sleep://0.1/{i}', tmp_path / f'{i}.txt') for i in range(5)]
+    engine.shutdown()
+    assert [future.result(timeout=0) for future in futures] == [Result.SUCCESS] * 5
+    with pytest.raises(RuntimeError):
+        _submit(engine, 'touch://late', tmp_path / 'late.txt')
+
+
+def test_engine_worker_crash_breaks_the_engine(tmp_path):
+    engine = AsyncDownloadEngine(max_workers=1, concurrency=1, batch_size=1)
+    try:
+        crashed = _submit(engine, 'crash://', tmp_path / 'crash.txt')
+        waiting = _submit(engine, 'touch://waiting', tmp_path / 'waiting.txt')
+        with pytest.raises(BrokenProcessPool):
+            crashed.result(timeout=30)
+        with pytest.raises(BrokenProcessPool):
+            waiting.result(timeout=30)
+        with pytest.raises(BrokenProcessPool):
+            _submit(engine, 'touch://late', tmp_path / 'late.txt')
+    finally:
+        engine.shutdown()
@@ -0,0 +1,142 @@
+import asyncio
+import math
+import multiprocessing
+import os
+import statistics
+import time
+
+import pytest
+
+from yundownload import Downloader, Resources
+from yundownload.utils.equilibrium import (
+    ConcurrencyRegistry,
+    DynamicConcurrencyController,
+    DynamicSemaphore,
+    HostPermits,
+    HostSemaphore
+)
+
+
+def test_resources_of_one_host_share_a_semaphore():
+    registry = ConcurrencyRegistry()
+
+    async def main():
+        first = registry.semaphore(Resources('http://example.com/a', 'a'))
+        second = registry.semaphore(Resources('http://EXAMPLE.com/b', 'b'))
+        other = registry.semaphore(Resources('http://example.org/a', 'a'))
+        return first, second, other
+
+    first, second, other = asyncio.run(main())
+    assert first is second
+    assert first is not other
+
+
+def test_resources_with_other_limits_get_their_own_semaphore():
+    registry = ConcurrencyRegistry()
+
+    async def main():
+        default = registry.semaphore(Resources('http://example.com/a', 'a'))
+        narrow = registry.semaphore(Resources('http://example.com/b', 'b', max_concurrency=2))
+        return default, narrow
+
+    default, narrow = asyncio.run(main())
+    assert default is not narrow
+    assert (default.max_target, narrow.max_target) == (30, 2)
+
+
+def test_shared_host_permits_are_limited_to_their_processes():
+    with pytest.raises(ValueError):
+        Downloader(max_workers=HostPermits.max_processes + 1, share_host_concurrency=True)
+
+
+def test_host_permits_cap_all_holders():
+    permits = HostPermits()
+    try:
+        assert permits.try_acquire('host', 2)
+        assert permits.try_acquire('host', 2)
+        assert not permits.try_acquire('host', 2)
+        assert permits.try_acquire('other', 2)
+        permits.release('host')
+        assert permits.in_use('host') == 1
+        assert permits.try_acquire('host', 2)
+    finally:
+        permits.close()
+
+
+def _hold(permits: HostPermits, taken, seconds: float, crash: bool):
+    permits.try_acquire('host', 1)
+    taken.set()
+    time.sleep(seconds)
+    if crash:
+        os._exit(1)
+    permits.release('host')
+
+
+def _wait_for_permit(permits: HostPermits, seconds: float, crash: bool) -> float:
+    taken = multiprocessing.Event()
+    holder = multiprocessing.Process(target=_hold, args=(permits, taken, seconds, crash))
+    holder.start()
+    try:
+        assert taken.wait(10)
+        assert not permits.try_acquire('host', 1)
+
+        async def main():
+            sem = HostSemaphore(DynamicConcurrencyController(min_concurrency=1), 'host', permits)
+            start = time.monotonic()
+            await asyncio.wait_for(sem.acquire(), 10)
+            waited = time.monotonic() - start
+            sem.release()
+            return waited
+
+        if crash:
+            holder.join()
+        return asyncio.run(main())
+    finally:
+        holder.join()
+
+
+def test_host_permits_wake_waiters_of_other_processes():
+    permits = HostPermits()
+    try:
+        # The waiter is woken by the release of the holder, not by the periodic recheck
+        assert _wait_for_permit(permits, 0.2, False) < 0.9
+        assert permits.in_use('host') == 0
+    finally:
+        permits.close()
+
+
+def test_host_permits_of_dead_processes_are_taken_back():
+    permits = HostPermits()
+    try:
+        assert _wait_for_permit(permits, 0, True) < 0.9
+        assert permits.in_use('host') == 0
+    finally:
+        permits.close()
+
+
+def test_controller_windows_match_a_full_recount():
+    dcc = DynamicConcurrencyController(window_size=50)
+    samples = [(0.01 * (i % 37 + 1), i % 7 != 0) for i in range(500)]
+    for response_time, success in samples:
+        dcc.record_result(response_time, success)
+
+    times = [response_time for response_time, _ in samples]
+    outcomes = [success for _, success in samples][-50:]
+    assert math.isclose(dcc.response_times.mean, statistics.mean(times[-50:]))
+    assert math.isclose(dcc.recent_response_times.mean, statistics.mean(times[-10:]))
+    assert dcc.calibration_window.median == statistics.median(times[-20:])
+    assert dcc.successes == sum(outcomes)
+    assert dcc.failures == len(outcomes) - sum(outcomes)
+
+
+def test_semaphore_shrinks_below_the_permits_in_use():
+    async def main():
+        sem = DynamicSemaphore(DynamicConcurrencyController(min_concurrency=4))
+        for _ in range(4):
+            await sem.acquire()
+        await sem.update(1)
+        for _ in range(4):
+            sem.release()
+        return sem.available_permits
+
+    assert asyncio.run(main()) == 1
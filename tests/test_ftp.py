@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import importlib.util
+import os
+import threading
+
+import pytest
+
+from benchmarks.servers import FtpServer, make_file
+from yundownload import Downloader, Resources, Result
+from yundownload.network import ftp as ftp_module
+from yundownload.network.ftp import FTPProtocolHandler
+from yundownload.network.pool import FtpSessionPool
+from yundownload.utils.checksum import Checksum
+from yundownload.utils.tools import convert_state_path
+
+needs_server = pytest.mark.skipif(importlib.util.find_spec('pyftpdlib') is None, reason='pyftpdlib is not installed')
+SIZE = 12 * 1024 * 1024
+
+
+def _download(resources: Resources) -> Result:
+    with Downloader() as d:
+        worker_future = d.submit(resources)
+        worker_future.wait()
+        return worker_future.state
+
+
+@needs_server
+def test_ftp_sliced_download(tmp_path):
+    root = tmp_path / 'serve'
+    root.mkdir()
+    make_file(root / 'a.bin', SIZE)
+    save_path = tmp_path / 'a.bin'
+    with FtpServer(root) as server:
+        assert _download(Resources(server.url('a.bin'), save_path, ftp_slice_threshold=1, retry=1)) == Result.SUCCESS
+    assert save_path.read_bytes() == (root / 'a.bin').read_bytes()
+    assert not convert_state_path(save_path).exists()
+
+
+@needs_server
+def test_ftp_sliced_download_continues_streamed_file(tmp_path):
+    root = tmp_path / 'serve'
+    root.mkdir()
+    make_file(root / 'a.bin', SIZE)
+    data = (root / 'a.bin').read_bytes()
+    save_path = tmp_path / 'a.bin'
+    save_path.write_bytes(data[:SIZE // 3])
+    with FtpServer(root) as server:
+        assert _download(Resources(server.url('a.bin'), save_path, ftp_slice_threshold=1, retry=1)) == Result.SUCCESS
+    assert save_path.read_bytes() == data
+
+
+@needs_server
+def test_ftp_sliced_download_hashes_ranges_as_they_complete(tmp_path, monkeypatch):
+    root = tmp_path / 'serve'
+    root.mkdir()
+    make_file(root / 'a.bin', SIZE)
+    digest = hashlib.sha256((root / 'a.bin').read_bytes()).hexdigest()
+    hashed = []
+    update_from_file = Checksum.update_from_file
+
+    def record(self, path, end: int):
+        hashed.append((self.position, end))
+        update_from_file(self, path, end)
+
+    monkeypatch.setattr(Checksum, 'update_from_file', record)
+    with FtpServer(root) as server:
+        resources = Resources(server.url('a.bin'), tmp_path / 'a.bin', ftp_slice_threshold=1, retry=1,
+                              checksum=digest)
+        assert FTPProtocolHandler().download(resources) == Result.SUCCESS
+    # The file is hashed in order while it downloads, not read again as a whole afterwards
+    assert len(hashed) > 1
+    assert hashed[0][0] == 0 and hashed[-1][1] == SIZE
+    assert all(end == start for (_, end), (start, _) in zip(hashed, hashed[1:]))
+
+
+class FakeSession:
+
+    def __init__(self, blocked: threading.Event = None):
+        self.broken = False
+        self.closed = False
+        self.noops = 0
+        self.blocked = blocked
+        self.pinged = threading.Event()
+
+    def voidcmd(self, cmd: str):
+        self.pinged.set()
+        if self.blocked is not None:
+            self.blocked.wait(10)
+        if self.broken:
+            raise EOFError
+        self.noops += 1
+        return '200 NOOP ok'
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+def test_ftp_session_pool_reuses_and_evicts():
+    pool = FtpSessionPool(max_idle=1)
+    key = pool.session_key('127.0.0.1', 21, 'anonymous', 'anonymous@')
+    opened = []
+
+    def connect():
+        opened.append(FakeSession())
+        return opened[-1]
+
+    first = pool.acquire(key, connect)
+    pool.release(first)
+    assert pool.acquire(key, connect) is first
+    second = pool.acquire(key, connect)
+    assert len(opened) == 2
+
+    pool.release(first)
+    pool.release(second)
+    assert second.closed and not first.closed
+
+    pool._keepalive()
+    assert first.noops == 1
+    first.broken = True
+    pool._keepalive()
+    assert first.closed
+    assert pool.acquire(key, connect) is opened[-1] and len(opened) == 3
+
+    pool.release(opened[-1], reusable=False)
+    assert opened[-1].closed
+    pool.close()
+
+
+def test_ftp_keepalive_leaves_other_sessions_available():
+    pool = FtpSessionPool(max_idle=2)
+    key = pool.session_key('127.0.0.1', 21, 'anonymous', 'anonymous@')
+    unblock = threading.Event()
+    slow, ready = FakeSession(unblock), FakeSession()
+    first = pool.acquire(key, lambda: slow)
+    second = pool.acquire(key, lambda: ready)
+    pool.release(first)
+    pool.release(second)
+
+    sweep = threading.Thread(target=pool._keepalive)
+    sweep.start()
+    try:
+        # The sweep is stuck in the NOOP of the first session, the second one is still handed out
+        assert slow.pinged.wait(10)
+        assert pool.acquire(key, FakeSession) is ready
+    finally:
+        unblock.set()
+        sweep.join()
+    assert [ftp for ftp, _ in pool._idle[key]] == [slow]
+    pool.close()
+
+
+@needs_server
+def test_ftp_mirror_skips_unchanged_files(tmp_path):
+    root = tmp_path / 'serve'
+    for name in ('a.bin', 'sub/b.bin', 'sub/deeper/c d.bin'):
+        make_file(root / name, 1024)
+    save_path = tmp_path / 'mirror'
+    with FtpServer(root) as server:
+        with Downloader() as d:
+            first = list(d.mirror(Resources(server.url(''), save_path, retry=1)))
+            assert len(first) == 3 and all(worker_future.finish() for worker_future in first)
+
+            (root / 'sub' / 'b.bin').write_bytes(b'changed')
+            os.utime(root / 'sub' / 'b.bin', (1, 1))
+            second = list(d.mirror(Resources(server.url(''), save_path, retry=1)))
+    assert [worker_future.resources.save_path for worker_future in second] == [save_path / 'sub' / 'b.bin']
+    for name in ('a.bin', 'sub/b.bin', 'sub/deeper/c d.bin'):
+        assert (save_path / name).read_bytes() == (root / name).read_bytes()
+
+
+@needs_server
+def test_ftp_download_after_listing_on_the_same_session(tmp_path, monkeypatch):
+    root = tmp_path / 'serve'
+    make_file(root / 'a.bin', 1024 * 1024)
+    pool = FtpSessionPool()
+    monkeypatch.setattr(ftp_module, 'ftp_pool', pool)
+    save_path = tmp_path / 'a.bin'
+    try:
+        with FtpServer(root) as server:
+            # The listing switches the session to ASCII mode before it goes back to the pool
+            assert [f.path for f in FTPProtocolHandler().walk(Resources(server.url(''), tmp_path, retry=1))] == ['a.bin']
+            listed = [ftp for idle in pool._idle.values() for ftp, _ in idle]
+            handler = FTPProtocolHandler()
+            assert handler.download(Resources(server.url('a.bin'), save_path, retry=1)) == Result.SUCCESS
+            assert [ftp for idle in pool._idle.values() for ftp, _ in idle] == listed
+    finally:
+        pool.close()
+    assert save_path.read_bytes() == (root / 'a.bin').read_bytes()
+
+
+@needs_server
+def test_ftp_sliced_download_opens_at_most_ftp_max_connections(tmp_path, monkeypatch):
+    root = tmp_path / 'serve'
+    root.mkdir()
+    make_file(root / 'a.bin', 4 * SIZE)
+    monkeypatch.setattr(ftp_module, 'ftp_pool', FtpSessionPool())
+    opened = []
+    open_session = FTPProtocolHandler._open_session
+
+    def count(self):
+        opened.append(self)
+        return open_session(self)
+
+    monkeypatch.setattr(FTPProtocolHandler, '_open_session', count)
+    try:
+        with FtpServer(root) as server:
+            resources = Resources(server.url('a.bin'), tmp_path / 'a.bin', ftp_slice_threshold=1,
+                                  min_concurrency=8, ftp_max_connections=2, retry=1)
+            assert FTPProtocolHandler().download(resources) == Result.SUCCESS
+    finally:
+        ftp_module.ftp_pool.close()
+    assert 1 <= len(opened) <= 2
+    assert (tmp_path / 'a.bin').read_bytes() == (root / 'a.bin').read_bytes()
+
+
+@needs_server
+def test_ftp_sliced_download_closes_sessions_of_cancelled_transfers(tmp_path, monkeypatch):
+    root = tmp_path / 'serve'
+    root.mkdir()
+    make_file(root / 'a.bin', SIZE)
+    released = []
+
+    class RecordingPool(FtpSessionPool):
+
+        def release(self, ftp, reusable=True):
+            released.append(reusable)
+            super().release(ftp, reusable)
+
+    monkeypatch.setattr(ftp_module, 'ftp_pool', RecordingPool())
+    started, finish = threading.Event(), threading.Event()
+
+    def fetch_range(self, ftp, byte_range, fd, loop):
+        started.set()
+        finish.wait(10)
+        return True
+
+    monkeypatch.setattr(FTPProtocolHandler, '_fetch_range', fetch_range)
+
+    async def main(resources: Resources):
+        task = asyncio.create_task(FTPProtocolHandler().adownload(resources))
+        assert await asyncio.to_thread(started.wait, 10)
+        task.cancel()
+        # The transfer thread only ends after the worker is cancelled
+        threading.Timer(0.1, finish.set).start()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    try:
+        with FtpServer(root) as server:
+            asyncio.run(main(Resources(server.url('a.bin'), tmp_path / 'a.bin', ftp_slice_threshold=1,
+                                       ftp_max_connections=2, retry=1)))
+    finally:
+        ftp_module.ftp_pool.close()
+    assert released and not any(released)
@@ -0,0 +1,93 @@
+import time
+
+import httpx
+
+from benchmarks.servers import HttpServer, make_file
+from yundownload import Resources, Result
+from yundownload.network import http
+from yundownload.network.http import HttpProtocolHandler
+from yundownload.network.pool import HttpClientPool
+from yundownload.utils import throttle
+from yundownload.utils.journal import DownloadJournal
+from yundownload.utils.throttle import BandwidthLimiter, Throttle
+from yundownload.utils.tools import convert_state_path, preallocate_file
+
+SIZE = 8 * 1024 * 1024
+
+
+def test_sliced_download_resumes_preallocated_file(tmp_path):
+    root = tmp_path / 'serve'
+    root.mkdir()
+    make_file(root / 'a.bin', SIZE)
+    data = (root / 'a.bin').read_bytes()
+    stat = (root / 'a.bin').stat()
+    save_path = tmp_path / 'a.bin'
+    resources = Resources('', save_path, http_slice_threshold=1, retry=1)
+
+    # An interrupted download left a preallocated file with the first half recorded as done
+    preallocate_file(save_path, SIZE)
+    with open(save_path, 'r+b') as f:
+        f.write(b'x' * (SIZE // 2))
+    journal = DownloadJournal(convert_state_path(save_path))
+    journal.open(SIZE, chunk=resources.http_sliced_chunk_size,
+                 etag=f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"', last_modified=None)
+    journal.add(0, SIZE // 2 - 1)
+    journal.close()
+
+    with HttpServer(root) as server:
+        resources = Resources(server.url('a.bin'), save_path, http_slice_threshold=1, retry=1)
+        handler = HttpProtocolHandler()
+        try:
+            assert handler.download(resources) == Result.SUCCESS
+        finally:
+            handler.close()
+    # Only the missing half was fetched
+    assert save_path.read_bytes() == b'x' * (SIZE // 2) + data[SIZE // 2:]
+    assert not convert_state_path(save_path).exists()
+
+
+def test_sliced_download_charges_every_byte(tmp_path, monkeypatch):
+    root = tmp_path / 'serve'
+    root.mkdir()
+    make_file(root / 'a.bin', SIZE)
+    charged = []
+
+    async def aconsume(self, nbytes: int, host: str = None):
+        charged.append(nbytes)
+
+    monkeypatch.setattr(Throttle, 'aconsume', aconsume)
+    with HttpServer(root) as server:
+        resources = Resources(server.url('a.bin'), tmp_path / 'a.bin', http_slice_threshold=1, retry=1)
+        handler = HttpProtocolHandler()
+        try:
+            assert handler.download(resources) == Result.SUCCESS
+        finally:
+            handler.close()
+    assert sum(charged) == SIZE
+
+
+def test_stream_download_is_held_to_the_rate_of_the_serving_host(tmp_path, monkeypatch):
+    body = bytes(256 * 1024)
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        if request.url.host == 'origin':
+            return httpx.Response(302, headers={'Location': 'http://mirror/a.bin'})
+        return httpx.Response(200, content=body, headers={'Content-Length': str(len(body))})
+
+    client_pool = HttpClientPool()
+    monkeypatch.setattr(client_pool, '_create_transport', lambda *args: httpx.MockTransport(handle))
+    monkeypatch.setattr(http, 'client_pool', client_pool)
+    limiter = BandwidthLimiter(host_rate={'mirror': 512 * 1024})
+    monkeypatch.setattr(throttle, '_limiter', limiter)
+    handler = HttpProtocolHandler()
+    try:
+        started = time.monotonic()
+        assert handler.download(Resources('http://origin/a.bin', tmp_path / 'a.bin', retry=1)) == Result.SUCCESS
+        elapsed = time.monotonic() - started
+    finally:
+        handler.close()
+        client_pool.close()
+        limiter.close()
+    # The bytes come from the redirect target, its bucket paces them and not the one of the origin
+    assert elapsed >= 0.35
+    assert (tmp_path / 'a.bin').read_bytes() == body
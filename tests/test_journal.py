@@ -0,0 +1,61 @@
+from yundownload.utils.journal import DownloadJournal, complement_ranges, merge_ranges
+
+
+def test_merge_and_complement():
+    merged = merge_ranges([(10, 19), (0, 4), (5, 9), (30, 39)])
+    assert merged == [(0, 19), (30, 39)]
+    assert complement_ranges(merged, 50) == [(20, 29), (40, 49)]
+
+
+def test_resume_from_journal(tmp_path):
+    journal = DownloadJournal(tmp_path / 'file.bin.ydstf')
+    assert journal.open(100, etag='"a"') == []
+    journal.add(0, 9)
+    journal.add(10, 19)
+    journal.add(50, 59)
+    journal.close()
+
+    journal = DownloadJournal(tmp_path / 'file.bin.ydstf')
+    assert journal.open(100, etag='"a"') == [(0, 19), (50, 59)]
+    journal.close()
+    assert len(journal.path.read_text().splitlines()) == 3
+
+
+def test_changed_remote_restarts(tmp_path):
+    journal = DownloadJournal(tmp_path / 'file.bin.ydstf')
+    journal.open(100, etag='"a"')
+    journal.add(0, 49)
+    journal.close()
+
+    journal = DownloadJournal(tmp_path / 'file.bin.ydstf')
+    assert journal.open(100, etag='"b"') == []
+    journal.remove()
+    assert not journal.path.exists()
+
+
+def test_positions_survive_compaction(tmp_path):
+    journal = DownloadJournal(tmp_path / 'video.mp4.ydstf')
+    journal.open(10, playlist='a')
+    journal.add(0, 0, 100)
+    journal.add(1, 1, 250)
+    journal.close()
+
+    journal = DownloadJournal(tmp_path / 'video.mp4.ydstf')
+    assert journal.open(10, playlist='a') == [(0, 1)]
+    assert journal.positions == {1: 250}
+    journal.close()
+    assert journal.path.read_text().splitlines()[1:] == ['0 1 250']
+
+
+def test_positions_stay_bounded(tmp_path):
+    journal = DownloadJournal(tmp_path / 'live.ts.ydstf')
+    journal.open(0, playlist='live', assembly='live')
+    for sequence in range(10000):
+        journal.add(sequence, sequence, (sequence + 1) * 188)
+        assert len(journal.positions) == 1
+    journal.close()
+
+    journal = DownloadJournal(tmp_path / 'live.ts.ydstf')
+    assert journal.open(0, playlist='live', assembly='live') == [(0, 9999)]
+    assert journal.positions == {9999: 10000 * 188}
+    journal.close()
@@ -0,0 +1,252 @@
+import asyncio
+import os
+
+import m3u8
+import pytest
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+from yundownload.network.m3u import M3U8ProtocolHandler, SegmentDecryptor, _CACHE_SIZE
+
+PLAYLIST = '''#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:7
+#EXT-X-KEY:METHOD=AES-128,URI="k1"
+#EXTINF:4,
+a.ts
+#EXT-X-KEY:METHOD=NONE
+#EXTINF:4,
+b.ts
+#EXT-X-KEY:METHOD=AES-128,URI="k2",IV=0x0000000000000000000000000000000A
+#EXTINF:4,
+c.ts
+#EXT-X-ENDLIST
+'''
+
+
+def test_parse_segments_derives_iv():
+    playlist = m3u8.M3U8(PLAYLIST, base_uri='http://host/video/')
+    first, second, third = M3U8ProtocolHandler.parse_segments(playlist)
+    assert first['encryption'] == {'method': 'AES-128', 'key_uri': 'http://host/video/k1', 'iv': (7).to_bytes(16, 'big')}
+    assert second['encryption'] is None
+    assert third['encryption']['key_uri'] == 'http://host/video/k2'
+    assert third['encryption']['iv'] == (10).to_bytes(16, 'big')
+
+
+@pytest.mark.parametrize('size', [0, 15, 16, 100000])
+def test_decryptor_streams_and_unpads(size):
+    key, iv, plain = os.urandom(16), os.urandom(16), os.urandom(size)
+    encrypted = AES.new(key, AES.MODE_CBC, iv).encrypt(pad(plain, AES.block_size))
+    decryptor = SegmentDecryptor(key, iv)
+    chunks = [decryptor.update(encrypted[offset:offset + 4099]) for offset in range(0, len(encrypted), 4099)]
+    assert b''.join(chunks) + decryptor.finalize() == plain
+
+
+def test_decryptor_rejects_wrong_key():
+    key, iv = b'k' * 16, b'i' * 16
+    encrypted = AES.new(key, AES.MODE_CBC, iv).encrypt(pad(b'segment', AES.block_size))
+    decryptor = SegmentDecryptor(bytes(16), iv)
+    decryptor.update(encrypted)
+    with pytest.raises(ValueError):
+        decryptor.finalize()
+
+
+def test_rotating_keys_are_not_kept_forever():
+    handler = M3U8ProtocolHandler()
+    fetched = []
+
+    async def fetch_key(client, key_uri):
+        fetched.append(key_uri)
+        return key_uri.encode().ljust(16, b'0')
+
+    async def main():
+        handler.fetch_key = fetch_key
+        for sequence in range(500):
+            # Every key is used by four segments in a row, like a stream rotating its keys
+            seg = {'encryption': {'method': 'AES-128', 'key_uri': f'k{sequence // 4}', 'iv': bytes(16)}}
+            await handler.segment_decryptor(None, seg)
+
+    asyncio.run(main())
+    assert len(fetched) == 125
+    assert len(handler._keys) <= _CACHE_SIZE
+
+
+def test_live_playlist_is_recorded_until_endlist(tmp_path, monkeypatch):
+    import asyncio
+
+    import httpx
+
+    from yundownload import Resources
+    from yundownload.utils.throttle import Throttle
+
+    windows = [(0, 3, False), (2, 5, False), (2, 5, False), (6, 8, True)]
+    polls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        name = request.url.path.rsplit('/', 1)[-1]
+        if name == 'index.m3u8':
+            first, end, endlist = windows[min(len(polls), len(windows) - 1)]
+            polls.append(first)
+            lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:2', f'#EXT-X-MEDIA-SEQUENCE:{first}']
+            for sequence in range(first, end):
+                lines += ['#EXTINF:2,', f'{sequence}.ts']
+            if endlist:
+                lines.append('#EXT-X-ENDLIST')
+            return httpx.Response(200, text='\n'.join(lines))
+        return httpx.Response(200, stream=httpx.ByteStream(name.encode() * 1000))
+
+    sleep = asyncio.sleep
+    monkeypatch.setattr(asyncio, 'sleep', lambda delay: sleep(0))
+    resources = Resources('http://live/index.m3u8', tmp_path / 'live.ts', m3u8_live=True)
+
+    async def main():
+        resources.update_semaphore()
+        m3u8_handler = M3U8ProtocolHandler()
+        m3u8_handler._throttle = Throttle(resources)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            playlist = await m3u8_handler.handle_variant_playlist(client, resources)
+            return await m3u8_handler.record_live(playlist, tmp_path / 'live.ts.ydstf', client, resources)
+
+    assert asyncio.run(main()).is_success()
+    assert len(polls) == 4
+    # Sequence 5 left the playlist before it was seen
+    expected = b''.join(f'{sequence}.ts'.encode() * 1000 for sequence in (0, 1, 2, 3, 4, 6, 7))
+    assert (tmp_path / 'live.ts').read_bytes() == expected
+    assert not (tmp_path / 'live.ts.ydstf').exists()
+
+
+FMP4_PLAYLIST = '''#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-MAP:URI="main.mp4",BYTERANGE="100@0"
+#EXTINF:4,
+#EXT-X-BYTERANGE:1000@100
+main.mp4
+#EXTINF:4,
+#EXT-X-BYTERANGE:1000
+main.mp4
+#EXTINF:4,
+#EXT-X-BYTERANGE:500@3000
+main.mp4
+#EXT-X-MAP:URI="other.mp4"
+#EXTINF:4,
+other.m4s
+#EXT-X-ENDLIST
+'''
+
+
+def test_byterange_clips_are_coalesced(tmp_path):
+    import asyncio
+    import re
+
+    import httpx
+
+    from yundownload import Resources
+    from yundownload.utils.assembly import OrderedAssembler
+    from yundownload.utils.throttle import Throttle
+    from yundownload.utils.writer import WriteBehind
+
+    resource = os.urandom(4000)
+    files = {'main.mp4': resource, 'other.mp4': b'init2', 'other.m4s': b'clip4'}
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        content = files[request.url.path.rsplit('/', 1)[-1]]
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', request.headers.get('Range', ''))
+        requests.append((request.url.path, request.headers.get('Range')))
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+            return httpx.Response(206, stream=httpx.ByteStream(content[start:end + 1]))
+        return httpx.Response(200, stream=httpx.ByteStream(content))
+
+    segments = M3U8ProtocolHandler.parse_segments(m3u8.M3U8(FMP4_PLAYLIST, base_uri='http://host/'))
+    assert [seg['byterange'] for seg in segments] == [(100, 1000), (1100, 1000), (3000, 500), None]
+    assert [seg['map_start'] for seg in segments] == [True, False, False, True]
+    assert M3U8ProtocolHandler.group_segments([0, 1, 2, 3], segments) == [[0, 1], [2], [3]]
+    resources = Resources('http://host/index.m3u8', tmp_path / 'video.mp4')
+    path = tmp_path / 'video.mp4'
+
+    async def main():
+        resources.update_semaphore()
+        m3u8_handler = M3U8ProtocolHandler()
+        m3u8_handler._throttle = Throttle(resources)
+        writer = WriteBehind()
+        fd = writer.open(path, truncate=True)
+        assembler = OrderedAssembler(writer, fd)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            for group in M3U8ProtocolHandler.group_segments([0, 1, 2, 3], segments):
+                await m3u8_handler.download_group(group, segments, client, resources.semaphore, assembler)
+        await writer.close_file(fd)
+        await writer.aclose()
+
+    asyncio.run(main())
+    assert path.read_bytes() == resource[:100] + resource[100:2100] + resource[3000:3500] + b'init2' + b'clip4'
+    assert sorted(requests, key=str) == sorted([
+        ('/main.mp4', 'bytes=0-99'), ('/main.mp4', 'bytes=100-2099'), ('/main.mp4', 'bytes=3000-3499'),
+        ('/other.mp4', None), ('/other.m4s', None)
+    ], key=str)
+
+
+def test_filter_variants():
+    master = m3u8.M3U8('''#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,CODECS="avc1.4d401e,mp4a.40.2"
+low.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=3000000,RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"
+mid.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=1920x1080,CODECS="hvc1.1.6.L120,mp4a.40.2"
+high.m3u8
+''')
+    uris = lambda variants: [variant.uri for variant in variants]
+    assert uris(M3U8ProtocolHandler.filter_variants(master.playlists, max_height=720)) == ['low.m3u8', 'mid.m3u8']
+    assert uris(M3U8ProtocolHandler.filter_variants(master.playlists, codecs='hvc1')) == ['high.m3u8']
+    assert uris(M3U8ProtocolHandler.filter_variants(master.playlists, codecs='avc1,mp4a')) == ['low.m3u8', 'mid.m3u8']
+
+
+def test_stream_assembly_starts_groups_within_the_window(tmp_path):
+    import httpx
+
+    from yundownload import Resources
+    from yundownload.utils.config import DEFAULT_M3U8_REORDER_WINDOW
+    from yundownload.utils.journal import DownloadJournal
+    from yundownload.utils.throttle import Throttle
+    from yundownload.utils.writer import WriteBehind
+
+    count = DEFAULT_M3U8_REORDER_WINDOW * 10
+    playlist = '#EXTM3U\n#EXT-X-TARGETDURATION:4\n' + ''.join(f'#EXTINF:4,\n{i}.ts\n' for i in range(count))
+    segments = M3U8ProtocolHandler.parse_segments(m3u8.M3U8(playlist, base_uri='http://host/'))
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == '/0.ts':
+            # The head is slow, the segments behind it pile up against the window
+            await asyncio.sleep(0.1)
+        return httpx.Response(200, stream=httpx.ByteStream(request.url.path.encode() * 10))
+
+    resources = Resources('http://host/index.m3u8', tmp_path / 'video.ts', m3u8_stream=True)
+    m3u8_handler = M3U8ProtocolHandler()
+    download_group = m3u8_handler.download_group
+    running = {'now': 0, 'peak': 0}
+
+    async def counted(*args):
+        running['now'] += 1
+        running['peak'] = max(running['peak'], running['now'])
+        try:
+            return await download_group(*args)
+        finally:
+            running['now'] -= 1
+
+    async def main():
+        resources.update_semaphore()
+        m3u8_handler.download_group = counted
+        m3u8_handler._throttle = Throttle(resources)
+        m3u8_handler._journal = DownloadJournal(tmp_path / 'video.ts.ydstf')
+        m3u8_handler._journal.open(count, playlist='p', assembly='stream')
+        m3u8_handler._writer = WriteBehind()
+        try:
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                return await m3u8_handler.assemble_segments(segments, [], client, resources)
+        finally:
+            await m3u8_handler._writer.aclose()
+            m3u8_handler._journal.close()
+
+    assert asyncio.run(main()).is_success()
+    assert running['peak'] <= DEFAULT_M3U8_REORDER_WINDOW
+    assert (tmp_path / 'video.ts').read_bytes() == b''.join(f'/{i}.ts'.encode() * 10 for i in range(count))
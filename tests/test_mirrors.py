@@ -0,0 +1,22 @@
+from yundownload.utils.mirrors import Mirror, MirrorSelector
+
+
+def test_assignment_follows_throughput():
+    fast, slow = Mirror('http://fast/file', primary=True), Mirror('http://slow/file')
+    selector = MirrorSelector([fast, slow], alpha=1)
+    assert (selector.acquire(), selector.acquire()) == (fast, slow)
+    selector.release(fast, 3000, 1)
+    selector.release(slow, 1000, 1)
+    assert (fast.rate, slow.rate) == (3000, 1000)
+    picked = [selector.acquire() for _ in range(8)]
+    assert picked.count(fast) == 6
+    assert picked.count(slow) == 2
+
+
+def test_drop():
+    first, second = Mirror('http://a/file'), Mirror('http://b/file')
+    selector = MirrorSelector([first, second])
+    assert selector.drop(first, 'size differs')
+    assert selector.acquire() is second
+    assert not selector.drop(second, 'failed')
+    assert selector.acquire() is None
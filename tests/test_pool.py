@@ -0,0 +1,126 @@
+import asyncio
+
+import httpx
+import pytest
+
+from benchmarks.servers import HttpServer, make_file
+from yundownload import Resources, Result
+from yundownload.network import pool
+from yundownload.network.http import HttpProtocolHandler
+from yundownload.network.pool import HttpClientPool, _StreamLimitedTransport
+
+needs_h2 = pytest.mark.skipif(not pool.H2_AVAILABLE, reason='h2 is not installed')
+
+
+class Body(httpx.AsyncByteStream):
+
+    async def __aiter__(self):
+        yield b'ok'
+
+
+class HoldingTransport(httpx.AsyncBaseTransport):
+    """
+    Answers once the test releases the requests, counting those in flight
+    """
+
+    def __init__(self, release: asyncio.Event):
+        self.release = release
+        self.active = 0
+        self.peak = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await self.release.wait()
+        self.active -= 1
+        return httpx.Response(200, stream=Body(), extensions={'http_version': b'HTTP/2'})
+
+
+def test_streams_are_spread_over_the_connections():
+    async def main():
+        release = asyncio.Event()
+        transports = [HoldingTransport(release) for _ in range(3)]
+        seen = []
+        transport = _StreamLimitedTransport(transports, 4, lambda request, response: seen.append(request))
+
+        async def get():
+            response = await transport.handle_async_request(httpx.Request('GET', 'https://host/file'))
+            await response.aread()
+            await response.aclose()
+
+        tasks = [asyncio.create_task(get()) for _ in range(20)]
+        await asyncio.sleep(0.05)
+        assert [t.active for t in transports] == [4, 4, 4]
+        release.set()
+        await asyncio.gather(*tasks)
+        assert [t.peak for t in transports] == [4, 4, 4]
+        assert len(seen) == 20
+        assert not transport._origins
+
+    asyncio.run(main())
+
+
+def test_leased_clients_do_not_share_cookies(monkeypatch):
+    sent = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        sent.append(request.headers.get('Cookie'))
+        return httpx.Response(200, headers={'Set-Cookie': 'session=first; Path=/'})
+
+    client_pool = HttpClientPool()
+    monkeypatch.setattr(client_pool, '_create_transport', lambda *args: httpx.MockTransport(handle))
+    first = Resources('http://host/a', 'a', http_cookies={'token': 'a'})
+    second = Resources('http://host/b', 'b')
+
+    async def get(resources: Resources) -> httpx.AsyncClient:
+        async with client_pool.client(resources) as client:
+            await client.get(resources.uri, **client_pool.request_options(resources))
+            return client
+
+    try:
+        assert client_pool.run(get(first)) is client_pool.run(get(second))
+        client_pool.run(get(first))
+    finally:
+        client_pool.close()
+    assert sent == ['token=a', None, 'token=a']
+
+
+@needs_h2
+def test_origin_without_h2_falls_back():
+    client_pool = HttpClientPool()
+    resources = Resources('https://host/file', 'file', http2=True)
+    assert client_pool.http2_enabled(resources)
+    assert client_pool.http2_negotiated(resources) is None
+
+    request = httpx.Request('GET', 'https://host/other')
+    client_pool._record_protocol(request, httpx.Response(200, extensions={'http_version': b'HTTP/1.1'}))
+    assert client_pool.http2_negotiated(resources) is False
+    assert not client_pool.http2_enabled(resources)
+    assert client_pool._client_key(resources)[-1] is False
+    assert client_pool.http2_enabled(Resources('https://host:8443/file', 'file', http2=True))
+
+
+@needs_h2
+def test_handler_leases_http1_client_after_fallback(tmp_path, monkeypatch):
+    root = tmp_path / 'serve'
+    root.mkdir()
+    make_file(root / 'a.bin', 1024 * 1024)
+    leased = []
+    lease = pool.client_pool.client
+
+    def client(resources, uri=None):
+        leased.append(pool.client_pool._client_key(resources, uri)[-1])
+        return lease(resources, uri)
+
+    monkeypatch.setattr(pool.client_pool, 'client', client)
+    with HttpServer(root) as server:
+        # Plain http never negotiates h2, the request goes out as HTTP/1.1
+        resources = Resources(server.url('a.bin'), tmp_path / 'a.bin', http2=True, retry=1)
+        handler = HttpProtocolHandler()
+        try:
+            assert handler.download(resources) == Result.SUCCESS
+        finally:
+            handler.close()
+        assert pool.client_pool.http2_negotiated(resources) is False
+    assert leased == [True, False]
+    assert (tmp_path / 'a.bin').read_bytes() == (root / 'a.bin').read_bytes()
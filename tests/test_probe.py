@@ -0,0 +1,26 @@
+from yundownload.network.probe import ProbeCache, ProbeInfo
+
+
+def test_sqlite_cache_is_shared(tmp_path):
+    headers = {'Content-Length': '100', 'ETag': '"a"', 'Server': 'test'}
+    ProbeCache(60, tmp_path / 'probe.db').put('GET http://host/file', ProbeInfo(headers, True))
+
+    info = ProbeCache(60, tmp_path / 'probe.db').get('GET http://host/file')
+    assert info.content_length == 100
+    assert info.accept_ranges
+    assert info.headers == {'Content-Length': '100', 'ETag': '"a"'}
+
+
+def test_expired_and_invalidated():
+    cache = ProbeCache(60)
+    cache.put('old', ProbeInfo({'Content-Length': '1'}, False, stored_at=0))
+    cache.put('new', ProbeInfo({'Content-Length': '1'}, False))
+    assert cache.get('old') is None
+    cache.invalidate('new')
+    assert cache.get('new') is None
+
+
+def test_disabled():
+    cache = ProbeCache(0)
+    cache.put('key', ProbeInfo({'Content-Length': '1'}, False))
+    assert cache.get('key') is None
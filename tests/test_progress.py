@@ -0,0 +1,73 @@
+import multiprocessing
+import time
+from concurrent.futures import Future
+
+from yundownload import Resources, Result
+from yundownload.utils.progress import Phase, ProgressBoard, ProgressPublisher, ProgressSlot
+from yundownload.utils.work import WorkerFuture
+
+
+def test_slots_are_allocated_and_released():
+    board = ProgressBoard()
+    try:
+        first, second = board.allocate(), board.allocate()
+        assert (first.name, first.index) != (second.name, second.index)
+        ProgressPublisher(first).publish(10, 100, 0, 0, Phase.DOWNLOADING)
+        assert board.read(first).progress == 0.1
+
+        board.release(first)
+        again = board.allocate()
+        assert (again.name, again.index) == (first.name, first.index)
+        snapshot = board.read(again)
+        assert (snapshot.current_size, snapshot.phase) == (0, Phase.PENDING)
+    finally:
+        board.close()
+
+
+def _publish(slot: ProgressSlot, count: int):
+    publisher = ProgressPublisher(slot)
+    for i in range(1, count + 1):
+        publisher.publish(i, 2 * i, 3 * i, 4 * i, Phase.DOWNLOADING)
+
+
+def test_reader_sees_consistent_snapshots_of_another_process():
+    board = ProgressBoard()
+    try:
+        slot = board.allocate()
+        writer = multiprocessing.Process(target=_publish, args=(slot, 50000))
+        writer.start()
+        reads = 0
+        while writer.is_alive() or not reads:
+            snapshot = board.read(slot)
+            i = snapshot.current_size
+            # Every field was written together, a torn read would mix two updates
+            assert (snapshot.total_size, snapshot.steps, snapshot.total) == (2 * i, 3 * i, 4 * i)
+            reads += 1
+        writer.join()
+        assert writer.exitcode == 0
+        assert board.read(slot).current_size == 50000
+    finally:
+        board.close()
+
+
+def test_finished_future_keeps_its_progress_after_the_slot_is_reused():
+    board = ProgressBoard()
+    try:
+        slot = board.allocate()
+        future = Future()
+        worker_future = WorkerFuture(future, None, Resources('http://host/a', 'a'), board, slot)
+        publisher = ProgressPublisher(slot)
+        publisher.publish(0, 100, 0, 0, Phase.DOWNLOADING)
+        time.sleep(0.15)
+        publisher.publish(100, 100, 0, 0, Phase.DONE)
+        assert worker_future.phase == Phase.DONE
+        speed = worker_future.speed
+        assert speed > 0
+
+        future.set_result(Result.SUCCESS)
+        reused = board.allocate()
+        assert (reused.name, reused.index) == (slot.name, slot.index)
+        ProgressPublisher(reused).publish(5, 1000, 0, 0, Phase.DOWNLOADING)
+        assert (worker_future.progress, worker_future.speed, worker_future.phase) == (1.0, speed, Phase.DONE)
+    finally:
+        board.close()
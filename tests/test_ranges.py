@@ -0,0 +1,48 @@
+from yundownload.utils.ranges import RangeScheduler
+
+
+def test_plan():
+    scheduler = RangeScheduler([(0, 99), (200, 249)], chunk_size=40, min_split_size=10)
+    assert scheduler.unfinished() == [(0, 39), (40, 79), (80, 99), (200, 239), (240, 249)]
+    assert scheduler.remaining == 150
+
+
+def test_steal_largest_range():
+    scheduler = RangeScheduler([(0, 99)], chunk_size=100, min_split_size=10)
+    first = scheduler.acquire()
+    first.pos = 20
+    stolen = scheduler.acquire()
+    assert (first.pos, first.end) == (20, 59)
+    assert (stolen.pos, stolen.end) == (60, 99)
+    assert scheduler.remaining == 80
+
+
+def test_no_split_below_min_size():
+    scheduler = RangeScheduler([(0, 99)], chunk_size=100, min_split_size=10)
+    first = scheduler.acquire()
+    first.pos = 85
+    assert scheduler.acquire() is None
+
+
+def test_release_requeues_unfinished_part():
+    scheduler = RangeScheduler([(0, 99)], chunk_size=100, min_split_size=10)
+    first = scheduler.acquire()
+    first.pos = 30
+    scheduler.release(first)
+    assert scheduler.unfinished() == [(30, 99)]
+    done = scheduler.acquire()
+    done.pos = done.end + 1
+    scheduler.release(done)
+    assert not scheduler
+
+
+def test_frontier():
+    scheduler = RangeScheduler([(10, 99)], chunk_size=30, min_split_size=10)
+    first = scheduler.acquire()
+    second = scheduler.acquire()
+    second.pos = second.end + 1
+    scheduler.release(second)
+    assert scheduler.frontier == 10
+    first.pos = first.end + 1
+    scheduler.release(first)
+    assert scheduler.frontier == 70
@@ -0,0 +1,41 @@
+import paramiko
+
+from benchmarks.servers import SftpServer, make_file
+from yundownload import Resources, Result
+from yundownload.network import sftp
+from yundownload.network.sftp import SFTPProtocolHandler
+
+SIZE = 24 * 1024 * 1024
+
+
+def _download(resources: Resources) -> Result:
+    handler = SFTPProtocolHandler()
+    try:
+        return handler.download(resources)
+    finally:
+        handler.close()
+
+
+def test_sftp_requests_at_most_a_window_ahead(tmp_path, monkeypatch):
+    root = tmp_path / 'serve'
+    root.mkdir()
+    make_file(root / 'a.bin', SIZE)
+    data = (root / 'a.bin').read_bytes()
+    save_path = tmp_path / 'a.bin'
+    # A resumed download asks for nothing before the part it has
+    save_path.write_bytes(data[:SIZE // 3])
+    requested = []
+    prefetch = paramiko.SFTPFile._start_prefetch
+
+    def recorded(self, chunks, *args):
+        requested.append((chunks[0][0], chunks[-1][0] + chunks[-1][1]))
+        return prefetch(self, chunks, *args)
+
+    monkeypatch.setattr(paramiko.SFTPFile, '_start_prefetch', recorded)
+    with SftpServer(root) as server:
+        assert _download(Resources(server.url('a.bin'), save_path, retry=1)) == Result.SUCCESS
+    assert save_path.read_bytes() == data
+    assert requested[0][0] == SIZE // 3 and requested[-1][1] == SIZE
+    # Each batch starts where the previous one ended and spans no more than a window
+    assert all(end - start <= sftp._READ_WINDOW for start, end in requested)
+    assert all(previous[1] == current[0] for previous, current in zip(requested, requested[1:]))
@@ -0,0 +1,22 @@
+from yundownload.utils.simulation import ServerModel, RateLimitCliff, simulate
+
+
+def test_simulation_is_deterministic():
+    first = simulate(ServerModel(), duration=60, seed=1)
+    second = simulate(ServerModel(), duration=60, seed=1)
+    assert first.to_dict(trace=True) == second.to_dict(trace=True)
+
+
+def test_controller_converges_on_a_steady_server():
+    report = simulate(ServerModel(latency=0.05, capacity=16), duration=120)
+    assert report.failures == 0
+    assert report.convergence_time is not None
+    assert report.oscillation < 0.1
+    # the server saturates at capacity / latency requests per second
+    assert report.throughput > 0.9 * 16 / 0.05
+
+
+def test_controller_backs_off_below_a_rate_limit():
+    report = simulate(RateLimitCliff(ServerModel(latency=0.05, capacity=32), limit=8), duration=120)
+    assert report.final_concurrency <= 8
+    assert report.failures < 0.5 * report.requests
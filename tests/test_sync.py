@@ -0,0 +1,27 @@
+from yundownload.utils.sync import RemoteFile, SyncIndex, walk_tree
+
+
+def test_walk_tree_lists_recursively():
+    tree = {
+        'root': [('a.bin', False, 1, 10.0), ('sub', True, 0, 0.0)],
+        'root/sub': [('b.bin', False, 2, 20.0), ('deeper', True, 0, 0.0)],
+        'root/sub/deeper': [('c.bin', False, 3, 30.0)]
+    }
+    files = sorted(walk_tree(tree.__getitem__, 'root', workers=2), key=lambda remote: remote.path)
+    assert [(remote.path, remote.size, remote.mtime) for remote in files] == [
+        ('a.bin', 1, 10.0), ('sub/b.bin', 2, 20.0), ('sub/deeper/c.bin', 3, 30.0)
+    ]
+
+
+def test_sync_index_persists(tmp_path):
+    index = SyncIndex(tmp_path / 'index')
+    index.put(RemoteFile('a/b.bin', 5, 1.5))
+    assert index.get('a/b.bin') == (5, 1.5)
+    index.close()
+
+    index = SyncIndex(tmp_path / 'index')
+    assert index.get('a/b.bin') == (5, 1.5)
+    assert index.get('missing') is None
+    index.put(RemoteFile('a/b.bin', 6, 2.5))
+    assert index.get('a/b.bin') == (6, 2.5)
+    index.close()
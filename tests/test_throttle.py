@@ -0,0 +1,22 @@
+from yundownload.utils.throttle import BandwidthLimiter
+
+
+def test_shared_buckets_pace_callers():
+    limiter = BandwidthLimiter(rate=1000, host_rate={'slow': 100, '*': 500}, burst=0)
+    try:
+        assert limiter.reserve('fast', 100, now=0) == 0.2
+        assert limiter.reserve('fast', 100, now=0) == 0.4
+        # the total bucket already holds 200 bytes of debt
+        assert limiter.reserve('slow', 50, now=0) == 0.5
+        assert limiter.reserve('slow', 50, now=10) == 0.5
+    finally:
+        limiter.close()
+
+
+def test_idle_bucket_does_not_save_up_beyond_burst():
+    limiter = BandwidthLimiter(rate=1000, burst=0.5)
+    try:
+        assert limiter.reserve('host', 500, now=100) == 0
+        assert limiter.reserve('host', 500, now=100) == 0.5
+    finally:
+        limiter.close()
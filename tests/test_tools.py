@@ -0,0 +1,64 @@
+import errno
+import os
+
+from yundownload.utils import tools
+from yundownload.utils.tools import copy_file
+
+
+def _concat(tmp_path, parts):
+    paths = []
+    for index, data in enumerate(parts):
+        path = tmp_path / f'{index}.ts'
+        path.write_bytes(data)
+        paths.append(path)
+    with open(tmp_path / 'out', 'wb') as dst:
+        for path in paths:
+            with open(path, 'rb') as src:
+                copy_file(src, dst, bytearray(7))
+    return (tmp_path / 'out').read_bytes()
+
+
+def test_copy_file_concatenates(tmp_path):
+    parts = [os.urandom(1000), b'', os.urandom(33)]
+    assert _concat(tmp_path, parts) == b''.join(parts)
+
+
+def test_copy_file_falls_back_to_a_buffer(tmp_path, monkeypatch):
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, 'cross-device')
+
+    monkeypatch.setattr(tools.os, 'copy_file_range', unsupported, raising=False)
+    monkeypatch.setattr(tools.os, 'sendfile', unsupported, raising=False)
+    parts = [os.urandom(1000), os.urandom(33)]
+    assert _concat(tmp_path, parts) == b''.join(parts)
+
+
+def test_preallocate_file_reserves_blocks(tmp_path):
+    path = tmp_path / 'file.bin'
+    tools.preallocate_file(path, 1024 * 1024)
+    assert path.stat().st_size == 1024 * 1024
+    if hasattr(os, 'posix_fallocate') and hasattr(path.stat(), 'st_blocks'):
+        assert path.stat().st_blocks * 512 >= 1024 * 1024
+
+
+def test_preallocate_file_keeps_data_and_shrinks(tmp_path):
+    path = tmp_path / 'file.bin'
+    path.write_bytes(b'abc' * 100)
+    tools.preallocate_file(path, 600)
+    assert path.read_bytes() == b'abc' * 100 + bytes(300)
+    tools.preallocate_file(path, 3)
+    assert path.read_bytes() == b'abc'
+
+
+def test_preallocate_file_falls_back_to_truncate(tmp_path, monkeypatch):
+    def unsupported(*args):
+        raise OSError(errno.EOPNOTSUPP, 'not supported')
+
+    monkeypatch.setattr(tools.os, 'posix_fallocate', unsupported, raising=False)
+    path = tmp_path / 'file.bin'
+    tools.preallocate_file(path, 4096)
+    assert path.stat().st_size == 4096
+
+    monkeypatch.delattr(tools.os, 'posix_fallocate')
+    tools.preallocate_file(path, 8192)
+    assert path.stat().st_size == 8192
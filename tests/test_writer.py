@@ -0,0 +1,39 @@
+import asyncio
+import os
+
+import pytest
+
+from yundownload.utils.writer import WriteBehind
+
+
+def test_interleaved_writes_land_in_place(tmp_path):
+    path = tmp_path / 'out'
+    data = os.urandom(64 * 1024)
+    recorded = []
+
+    async def main():
+        writer = WriteBehind(max_pending=16 * 1024, coalesce_size=32 * 1024, fsync='checkpoint')
+        fd = writer.open(path, truncate=True)
+        # two ranges written alternately, like two slice workers
+        for offset in range(0, 32 * 1024, 4096):
+            await writer.write(fd, offset, data[offset:offset + 4096])
+            await writer.write(fd, 32 * 1024 + offset, data[32 * 1024 + offset:32 * 1024 + offset + 4096])
+        writer.call_after(lambda: recorded.append(path.stat().st_size))
+        await writer.close_file(fd)
+        await writer.aclose()
+
+    asyncio.run(main())
+    assert path.read_bytes() == data
+    assert recorded == [len(data)]
+
+
+def test_write_error_is_raised(tmp_path):
+    async def main():
+        writer = WriteBehind()
+        fd = writer.open(tmp_path / 'out')
+        os.close(fd)
+        await writer.write(fd, 0, b'data')
+        await writer.flush()
+
+    with pytest.raises(IOError):
+        asyncio.run(main())
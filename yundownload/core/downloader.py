@@ -1,30 +1,54 @@
 from concurrent.futures import ProcessPoolExecutor, Future
-from typing import TYPE_CHECKING, Type
+from pathlib import Path
+from queue import SimpleQueue, Empty
+from typing import TYPE_CHECKING, Type, Iterable, Iterator
+from urllib.parse import quote
 
+from .engine import AsyncDownloadEngine
 from ..utils.work import WorkerFuture
 from ..network.base import BaseProtocolHandler
 from ..network.ftp import FTPProtocolHandler
 from ..network.http import HttpProtocolHandler
 from ..network.m3u import M3U8ProtocolHandler
 from ..network.sftp import SFTPProtocolHandler
+from ..utils.config import DEFAULT_SYNC_INDEX_NAME
 from ..utils.core import Result
+from ..utils.equilibrium import HostPermits, concurrency_registry
 from ..utils.exceptions import NotSupportedProtocolException
 from ..utils.logger import logger
+from ..utils.progress import ProgressBoard
+from ..utils.sync import RemoteFile, SyncIndex
+from ..utils.throttle import BandwidthLimiter, install_limiter
 from ..utils.tools import retry
 
 if TYPE_CHECKING:
     from ..core import Resources
+    from ..utils.progress import ProgressSlot
 
 
-def _run(protocols: Type['BaseProtocolHandler'], resources: 'Resources') -> 'Result':
+def _run(protocols: Type['BaseProtocolHandler'], resources: 'Resources', slot: 'ProgressSlot' = None) -> 'Result':
     """
     Run the download callback
 
     :param protocols: Protocol Matcher
     :param resources: Resource Object
+    :param slot: Progress slot the handler publishes to
     :return: Result
     """
-    return protocols()(resources)
+    handler = protocols()
+    handler.progress_slot = slot
+    return handler(resources)
+
+
+def _initialize_worker(limiter: 'BandwidthLimiter | None', host_permits: 'HostPermits | None'):
+    """
+    Install the state shared by the worker processes of a downloader
+
+    :param limiter: Bandwidth limiter
+    :param host_permits: Connection permits per host
+    """
+    install_limiter(limiter)
+    concurrency_registry.install(host_permits)
 
 
 class DownloadProcessPoolExecutor(ProcessPoolExecutor):
@@ -32,18 +56,23 @@ class DownloadProcessPoolExecutor(ProcessPoolExecutor):
     Download the process pool
     """
 
-    def __init__(self, max_workers: int = None, **kwargs):
+    def __init__(self, max_workers: int = None, limiter: 'BandwidthLimiter' = None,
+                 host_permits: 'HostPermits' = None, **kwargs):
+        if limiter is not None or host_permits is not None:
+            kwargs.update(initializer=_initialize_worker, initargs=(limiter, host_permits))
         super().__init__(max_workers, **kwargs)
 
-    def run_download(self, protocol: Type['BaseProtocolHandler'], resources: 'Resources') -> 'Future[Result]':
+    def run_download(self, protocol: Type['BaseProtocolHandler'], resources: 'Resources',
+                     slot: 'ProgressSlot' = None) -> 'Future[Result]':
         """
         提交下载任务
 
         :param protocol: Protocol Matcher
         :param resources: Resource Object
+        :param slot: Progress slot the handler publishes to
         :return: A Future object that returns the result
         """
-        return super().submit(_run, protocol, resources)
+        return super().submit(_run, protocol, resources, slot)
 
 
 class Downloader:
@@ -51,15 +80,42 @@ class Downloader:
     Downloader
     """
 
-    def __init__(self, max_workers: int = 1):
+    def __init__(self, max_workers: int = 1, worker_concurrency: int = None, batch_size: int = 16,
+                 rate_limit: int = None, host_rate_limit: int | dict[str, int] = None,
+                 share_host_concurrency: bool = False):
         """
         Downloader
 
         :param max_workers: Maximum number of processes
+        :param worker_concurrency: Number of resources each process downloads at once on one event loop,
+            by default each process downloads one resource at a time
+        :param batch_size: Maximum number of resources a process pulls at once (with worker_concurrency)
+        :param rate_limit: Total download rate limit of all processes in bytes per second
+        :param host_rate_limit: Download rate limit of each host in bytes per second,
+            or a dict of host names to rates where ``*`` is the rate of the other hosts
+        :param share_host_concurrency: Whether the downloads to one host in all processes draw their
+            connections from one adaptive limit instead of ramping up each on their own,
+            at most ``HostPermits.max_processes`` processes can share the limits
         """
+        if share_host_concurrency and max_workers > HostPermits.max_processes:
+            raise ValueError(f'share_host_concurrency supports at most {HostPermits.max_processes} processes, '
+                             f'got max_workers={max_workers}')
         self._protocols: list = [M3U8ProtocolHandler, HttpProtocolHandler, FTPProtocolHandler, SFTPProtocolHandler]
         self._lock_protocol = None
-        self._download_pool = DownloadProcessPoolExecutor(max_workers=max_workers)
+        # Created before the workers so that they share the resource tracker of this process
+        self._progress_board = ProgressBoard()
+        self._running: set['WorkerFuture'] = set()
+        self._capacity = max_workers * (worker_concurrency or 1)
+        self._limiter = None
+        if rate_limit or host_rate_limit:
+            self._limiter = BandwidthLimiter(rate_limit, host_rate_limit)
+        self._host_permits = HostPermits() if share_host_concurrency else None
+        if worker_concurrency:
+            self._download_pool = AsyncDownloadEngine(max_workers, worker_concurrency, batch_size,
+                                                      self._limiter, self._host_permits)
+        else:
+            self._download_pool = DownloadProcessPoolExecutor(max_workers=max_workers, limiter=self._limiter,
+                                                              host_permits=self._host_permits)
 
     def submit(self, resources: 'Resources') -> 'WorkerFuture':
         """
@@ -73,11 +129,138 @@ class Downloader:
         else:
             protocol = self._match_protocol(resources)
         resources.lock()
-        return WorkerFuture(
-            future=self._download_pool.run_download(protocol, resources),
+        slot = self._progress_board.allocate()
+        worker_future = WorkerFuture(
+            future=self._download_pool.run_download(protocol, resources, slot),
             protocol=protocol,
-            resources=resources
+            resources=resources,
+            progress_board=self._progress_board,
+            progress_slot=slot
         )
+        self._running.add(worker_future)
+        worker_future.add_done_callback(self._running.discard)
+        return worker_future
+
+    def map(self, resources: Iterable['Resources'], max_in_flight: int = None) -> Iterator['WorkerFuture']:
+        """
+        Download resources from an iterable, yielding the tasks as they finish
+
+        Resources are pulled from the iterable only when a task finishes, so no more than
+        max_in_flight resources are submitted at once however long the iterable is.
+        Tasks still waiting in the pool are cancelled if the generator is closed early.
+
+        :param resources: Iterable of resource objects, it is consumed lazily
+        :param max_in_flight: Maximum number of unfinished tasks, twice the total concurrency by default
+        :return: Finished tasks in completion order
+        """
+        max_in_flight = max_in_flight or 2 * self._capacity
+        finished: SimpleQueue['WorkerFuture'] = SimpleQueue()
+        in_flight: set['WorkerFuture'] = set()
+        iterator = iter(resources)
+        try:
+            while True:
+                for item in iterator:
+                    worker_future = self.submit(item)
+                    in_flight.add(worker_future)
+                    worker_future.add_done_callback(finished.put)
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    return
+                worker_future = finished.get()
+                in_flight.discard(worker_future)
+                yield worker_future
+        finally:
+            for worker_future in in_flight:
+                worker_future.cancel()
+
+    def mirror(self, resources: 'Resources', max_in_flight: int = None,
+               index_path: str | Path = None) -> Iterator['WorkerFuture']:
+        """
+        Mirror a remote directory tree, e.g. ``ftp://host/dir/`` or ``sftp://host/dir/``, into the save path
+
+        The tree is listed recursively and its files are downloaded concurrently like ``map``, each with
+        the options of the resource. The size and modification time of every downloaded file are kept
+        in a sqlite index, files that still match their entry are skipped without a transfer, files
+        that changed are downloaded again.
+
+        :param resources: Resource object of the directory, its save path is the local directory
+        :param max_in_flight: Maximum number of unfinished tasks, twice the total concurrency by default
+        :param index_path: Path of the index, ``.ydsync`` in the save path by default
+        :return: Finished tasks of the transferred files in completion order
+        """
+        protocol = self._lock_protocol or self._match_protocol(resources)
+        handler = protocol()
+        index = SyncIndex(index_path or resources.save_path / DEFAULT_SYNC_INDEX_NAME)
+        base = resources.uri.rstrip('/')
+        scheduled: dict[str, RemoteFile] = {}
+        counts = {'unchanged': 0, 'transferred': 0}
+
+        def changed() -> Iterator['Resources']:
+            for remote in handler.walk(resources):
+                save_path = resources.save_path / remote.path
+                recorded = index.get(remote.path)
+                if recorded is not None and save_path.exists():
+                    if tuple(recorded) == (remote.size, remote.mtime) and save_path.stat().st_size == remote.size:
+                        counts['unchanged'] += 1
+                        continue
+                    # The local copy is out of date, it must not be taken for a partial download
+                    save_path.unlink()
+                scheduled[str(save_path)] = remote
+                yield resources.derive(f'{base}/{quote(remote.path)}', save_path)
+
+        try:
+            for worker_future in self.map(changed(), max_in_flight):
+                remote = scheduled.pop(str(worker_future.resources.save_path))
+                try:
+                    finished = not worker_future.cancelled() and worker_future.finish()
+                except Exception:
+                    finished = False
+                if finished:
+                    index.put(remote)
+                    counts['transferred'] += 1
+                yield worker_future
+        finally:
+            index.close()
+            handler.close()
+            logger.info(f"Mirror of {resources.uri}: {counts['transferred']} files transferred, "
+                        f"{counts['unchanged']} unchanged")
+
+    @staticmethod
+    def as_completed(worker_futures: Iterable['WorkerFuture'], timeout: float = None) -> Iterator['WorkerFuture']:
+        """
+        Yield the submitted tasks as they finish
+
+        :param worker_futures: Tasks returned by submit
+        :param timeout: Maximum time in seconds to wait for the next task
+        :return: Finished tasks in completion order
+        """
+        finished: SimpleQueue['WorkerFuture'] = SimpleQueue()
+        pending = set(worker_futures)
+        for worker_future in pending:
+            worker_future.add_done_callback(finished.put)
+        while pending:
+            try:
+                worker_future = finished.get(timeout=timeout)
+            except Empty:
+                raise TimeoutError(f'{len(pending)} tasks are not finished') from None
+            pending.discard(worker_future)
+            yield worker_future
+
+    def stats(self) -> list[dict]:
+        """
+        Snapshot of the progress of the unfinished tasks
+
+        :return: One dict per task with the uri, save path, phase, sizes, progress and speed
+        """
+        return [
+            {
+                'uri': worker_future.resources.uri,
+                'save_path': str(worker_future.resources.save_path),
+                **worker_future.snapshot.to_dict()
+            }
+            for worker_future in list(self._running)
+        ]
 
     def lock_protocol(self, protocol: BaseProtocolHandler):
         """
@@ -129,6 +312,11 @@ class Downloader:
 
     def close(self):
         self._download_pool.shutdown()
+        self._progress_board.close()
+        if self._limiter is not None:
+            self._limiter.close()
+        if self._host_permits is not None:
+            self._host_permits.close()
 
     def __enter__(self):
         return self
@@ -0,0 +1,254 @@
+import asyncio
+import itertools
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import connection
+from typing import TYPE_CHECKING, Type
+
+from ..network.pool import client_pool
+from ..utils.logger import logger
+from ..utils.equilibrium import concurrency_registry
+from ..utils.throttle import install_limiter
+
+if TYPE_CHECKING:
+    from multiprocessing.queues import Queue
+    from ..core import Resources
+    from ..network.base import BaseProtocolHandler
+    from ..utils.core import Result
+    from ..utils.equilibrium import HostPermits
+    from ..utils.progress import ProgressSlot
+    from ..utils.throttle import BandwidthLimiter
+
+
+def _engine_worker(worker_id: int, inbox: 'Queue', jobs: 'Queue', concurrency: int, batch_size: int,
+                   limiter: 'BandwidthLimiter' = None, host_permits: 'HostPermits' = None):
+    """
+    Worker process entry, runs the engine loop on the event loop of the client pool
+
+    :param worker_id: Worker index
+    :param inbox: Queue the parent reads requests and results from
+    :param jobs: Queue the parent sends job batches of this worker to
+    :param concurrency: Maximum number of resources downloaded at once
+    :param batch_size: Maximum number of jobs requested at once
+    :param limiter: Bandwidth limiter shared by the workers
+    :param host_permits: Connection permits per host shared by the workers
+    """
+    install_limiter(limiter)
+    concurrency_registry.install(host_permits)
+    try:
+        client_pool.run(_engine_loop(worker_id, inbox, jobs, concurrency, batch_size))
+    finally:
+        client_pool.close()
+
+
+async def _engine_loop(worker_id: int, inbox: 'Queue', jobs: 'Queue', concurrency: int, batch_size: int):
+    loop = asyncio.get_running_loop()
+    running: set[asyncio.Task] = set()
+    while True:
+        free = concurrency - len(running)
+        if free <= 0:
+            await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            continue
+        inbox.put(('request', worker_id, min(free, batch_size)))
+        batch = await loop.run_in_executor(None, jobs.get)
+        if batch is None:
+            break
+        for job in batch:
+            task = asyncio.create_task(_engine_job(inbox, *job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    if running:
+        await asyncio.wait(running)
+
+
+async def _engine_job(inbox: 'Queue', job_id: int, protocol: Type['BaseProtocolHandler'], resources: 'Resources',
+                      slot: 'ProgressSlot'):
+    try:
+        handler = protocol()
+        handler.progress_slot = slot
+        result = await handler.acall(resources)
+    except Exception as e:
+        inbox.put(('result', job_id, None, e))
+    else:
+        inbox.put(('result', job_id, result, None))
+
+
+class AsyncDownloadEngine:
+    """
+    Download engine whose worker processes each multiplex many resources on one long-lived event loop
+
+    Workers pull jobs from the parent in batches whenever they have free slots, so the number of
+    concurrent downloads is ``max_workers * concurrency`` without a process per download.
+    A worker that dies unexpectedly breaks the engine like a broken process pool: its jobs and the
+    jobs not handed out yet fail with ``BrokenProcessPool`` and no new jobs are accepted.
+    """
+
+    def __init__(self, max_workers: int = 1, concurrency: int = 64, batch_size: int = 16,
+                 limiter: 'BandwidthLimiter' = None, host_permits: 'HostPermits' = None):
+        """
+        Asynchronous download engine
+
+        :param max_workers: Number of worker processes
+        :param concurrency: Maximum number of resources each worker downloads at once
+        :param batch_size: Maximum number of jobs a worker pulls at once
+        :param limiter: Bandwidth limiter shared by the workers
+        :param host_permits: Connection permits per host shared by the workers
+        """
+        context = multiprocessing.get_context()
+        self._inbox = context.Queue()
+        self._job_queues = [context.Queue() for _ in range(max_workers)]
+        self._pending: deque[tuple[int, Type['BaseProtocolHandler'], 'Resources', 'ProgressSlot']] = deque()
+        self._demand: dict[int, int] = {}
+        self._futures: dict[int, Future] = {}
+        # Worker each dispatched and unfinished job was handed to
+        self._owners: dict[int, int] = {}
+        self._broken: str | None = None
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._workers = [
+            context.Process(
+                target=_engine_worker,
+                args=(worker_id, self._inbox, self._job_queues[worker_id], concurrency, batch_size, limiter,
+                      host_permits),
+                daemon=True
+            )
+            for worker_id in range(max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+        self._monitor = threading.Thread(target=self._watch, daemon=True)
+        self._monitor.start()
+
+    def run_download(self, protocol: Type['BaseProtocolHandler'], resources: 'Resources',
+                     slot: 'ProgressSlot' = None) -> 'Future[Result]':
+        """
+        Submit a download task
+
+        :param protocol: Protocol Matcher
+        :param resources: Resource Object
+        :param slot: Progress slot the handler publishes to
+        :return: A Future object that returns the result
+        """
+        future = Future()
+        with self._lock:
+            if self._broken is not None:
+                raise BrokenProcessPool(self._broken)
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new downloads after shutdown')
+            job_id = next(self._job_ids)
+            self._futures[job_id] = future
+            self._pending.append((job_id, protocol, resources, slot))
+            self._dispatch()
+        return future
+
+    def _dispatch(self):
+        """
+        Hand pending jobs to the workers waiting for a batch, must be called with the lock held
+        """
+        for worker_id, size in list(self._demand.items()):
+            batch = []
+            while self._pending and len(batch) < size:
+                job = self._pending.popleft()
+                if self._futures[job[0]].set_running_or_notify_cancel():
+                    batch.append(job)
+                else:
+                    self._futures.pop(job[0])
+            if batch:
+                del self._demand[worker_id]
+                for job in batch:
+                    self._owners[job[0]] = worker_id
+                self._job_queues[worker_id].put(batch)
+            elif self._shutdown:
+                del self._demand[worker_id]
+                self._job_queues[worker_id].put(None)
+
+    def _collect(self):
+        """
+        Receive batch requests and results from the workers
+        """
+        while True:
+            message = self._inbox.get()
+            if message[0] == 'request':
+                _, worker_id, size = message
+                with self._lock:
+                    self._demand[worker_id] = size
+                    self._dispatch()
+            elif message[0] == 'result':
+                _, job_id, result, error = message
+                with self._lock:
+                    self._owners.pop(job_id, None)
+                    future = self._futures.pop(job_id, None)
+                if future is None:
+                    # Already failed because its worker died
+                    continue
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+            else:
+                break
+
+    def _watch(self):
+        """
+        Wait for the worker processes to exit and break the engine if one exits unexpectedly
+        """
+        workers = {worker.sentinel: worker_id for worker_id, worker in enumerate(self._workers)}
+        while workers:
+            for sentinel in connection.wait(list(workers)):
+                worker_id = workers.pop(sentinel)
+                worker = self._workers[worker_id]
+                worker.join()
+                with self._lock:
+                    if worker.exitcode == 0 and self._shutdown:
+                        continue
+                    self._break(worker_id, worker.exitcode)
+
+    def _break(self, worker_id: int, exitcode: int):
+        """
+        Fail the jobs of a dead worker and the jobs not handed out yet, must be called with the lock held
+        """
+        worker = self._workers[worker_id]
+        self._broken = (f'download engine worker {worker.pid} exited unexpectedly with code {exitcode}, '
+                        f'the engine does not accept new downloads')
+        logger.error(self._broken)
+        self._demand.pop(worker_id, None)
+        failed = [job_id for job_id, owner in self._owners.items() if owner == worker_id]
+        failed += [job[0] for job in self._pending]
+        self._pending.clear()
+        for job_id in failed:
+            self._owners.pop(job_id, None)
+            future = self._futures.pop(job_id, None)
+            if future is None or not future.running() and not future.set_running_or_notify_cancel():
+                # Cancelled before it was handed out
+                continue
+            future.set_exception(BrokenProcessPool(self._broken))
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stop accepting jobs and let the workers exit once the pending jobs are finished
+
+        :param wait: Wait for the workers to exit
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            self._dispatch()
+        if not wait:
+            return
+        for worker in self._workers:
+            worker.join()
+            if worker.exitcode:
+                logger.error(f'download engine worker {worker.pid} exited with code {worker.exitcode}')
+        self._inbox.put(('stop',))
+        self._collector.join()
+        for future in self._futures.values():
+            if not future.done():
+                future.set_exception(RuntimeError('download engine worker exited before the job finished'))
+        self._futures.clear()
@@ -1,7 +1,10 @@
+import copy
 from pathlib import Path
 from typing import Union, Literal, Dict, Optional
 
 from yundownload.utils import DynamicConcurrencyController, DynamicSemaphore
+from yundownload.utils.config import DEFAULT_FTP_MAX_CONNECTIONS
+from yundownload.utils.equilibrium import concurrency_registry
 
 
 class Resources:
@@ -21,10 +24,23 @@ class Resources:
                  http_verify: bool = False,
                  http_slice_threshold: int = 2048 * 1024 * 1024,
                  http_sliced_chunk_size: int = 2048 * 1024 * 1024,
+                 http_mirrors: list[str] = None,
                  ftp_timeout: int = 30,
                  ftp_port: int = 21,
+                 ftp_slice_threshold: int = 128 * 1024 * 1024,
+                 ftp_max_connections: int = DEFAULT_FTP_MAX_CONNECTIONS,
                  sftp_port: int = 22,
                  http_stream: bool = False,
+                 m3u8_stream: bool = False,
+                 m3u8_live: bool = False,
+                 m3u8_live_duration: float = None,
+                 m3u8_variant: Literal['max', 'min', 'throughput'] = 'max',
+                 m3u8_max_height: int = None,
+                 m3u8_codecs: str = None,
+                 http2: bool = False,
+                 checksum: str = None,
+                 checksum_algorithm: Literal['md5', 'sha1', 'sha256', 'crc32c'] = 'sha256',
+                 rate_limit: int = None,
                  metadata: dict = None,
                  retry: int = 3,
                  retry_delay: int | tuple[int, int] = 10,
@@ -46,9 +62,27 @@ class Resources:
         :param http_auth: HTTP protocol authentication is requested (Valid for M3U8 protocol)
         :param http_slice_threshold: HTTP protocol sharding threshold
         :param http_sliced_chunk_size: HTTP protocol sharding chunk size
+        :param http_mirrors: Uris of mirrors serving the same file, sliced downloads fetch ranges from all of them
         :param ftp_timeout: FTP request timeout period
         :param ftp_port: FTP protocol request port
+        :param ftp_slice_threshold: FTP files from this size are fetched in ranges over several connections
+            when the server supports REST, the connections follow the adaptive concurrency settings
+        :param ftp_max_connections: Most logged-in connections a sliced FTP download opens, servers often
+            limit the connections of a client to a few
         :param sftp_port: SFTP request port
+        :param m3u8_stream: Append the segments to the output in playlist order while downloading,
+            instead of saving them as separate files and merging them at the end
+        :param m3u8_live: Record a live playlist, reloading it for new segments until EXT-X-ENDLIST
+        :param m3u8_live_duration: Maximum recording time of a live playlist in seconds, unlimited by default
+        :param m3u8_variant: Variant of a master playlist to download: the highest bitrate, the lowest one or
+            the highest one the measured throughput sustains
+        :param m3u8_max_height: Only consider variants up to this vertical resolution, e.g. 720
+        :param m3u8_codecs: Only consider variants using these comma-separated codec prefixes, e.g. avc1
+        :param http2: Multiplex the requests over a few HTTP/2 connections if the server negotiates h2
+            (Valid for M3U8 protocol, requires the h2 package)
+        :param checksum: Expected digest of the file in hex, verified while downloading (HTTP, FTP and SFTP)
+        :param checksum_algorithm: Checksum algorithm
+        :param rate_limit: Download rate limit of this resource in bytes per second
         :param metadata: Custom metadata (for adapting custom protocols)
         :param retry: Number of retries
         :param retry_delay: Retry interval
@@ -66,6 +100,7 @@ class Resources:
 
         # http protocol and part m3u8 protocol
         self.http_stream = http_stream
+        self.http2 = http2
         self.http_method = http_method
         self.http_params = http_params
         self.http_headers = http_headers
@@ -77,14 +112,46 @@ class Resources:
         self.http_verify = http_verify
         self.http_slice_threshold = http_slice_threshold
         self.http_sliced_chunk_size = http_sliced_chunk_size
+        self.http_mirrors = list(http_mirrors) if http_mirrors else []
+
+        self.m3u8_stream = m3u8_stream
+        self.m3u8_live = m3u8_live
+        self.m3u8_live_duration = m3u8_live_duration
+        self.m3u8_variant = m3u8_variant
+        self.m3u8_max_height = m3u8_max_height
+        self.m3u8_codecs = m3u8_codecs
 
         self.ftp_timeout = ftp_timeout
         self.ftp_port = ftp_port
+        self.ftp_slice_threshold = ftp_slice_threshold
+        self.ftp_max_connections = ftp_max_connections
 
         self.sftp_port = sftp_port
 
+        self.checksum = checksum
+        self.checksum_algorithm = checksum_algorithm
+        self.rate_limit = rate_limit
+
         self.metadata = metadata if metadata else {}
 
+    def derive(self, uri: str, save_path: Union[str | Path]) -> 'Resources':
+        """
+        Resource with the options of this one for another uri, e.g. a file of a mirrored directory
+
+        :param uri: Resource path
+        :param save_path: The path where the resource is saved
+        :return: Unlocked resource object
+        """
+        resources = copy.copy(self)
+        object.__setattr__(resources, '_set_lock', True)
+        resources.uri = uri
+        resources.save_path = Path(save_path)
+        resources.dcc = DynamicConcurrencyController(self.dcc.min_concurrency, self.dcc.max_concurrency,
+                                                     self.dcc.window_size)
+        resources.semaphore = None
+        resources.metadata = dict(self.metadata)
+        return resources
+
     def lock(self):
         """
         Lock the resource object
@@ -92,7 +159,10 @@ class Resources:
         self._set_lock = False
 
     def update_semaphore(self):
-        self.semaphore = DynamicSemaphore(self.dcc)
+        """
+        Take the semaphore of the host of the resource, shared with the other downloads to the same host
+        """
+        self.semaphore = concurrency_registry.semaphore(self)
 
     def __setattr__(self, key, value):
         if self._set_lock or key in ('dcc', 'semaphore'):
@@ -2,4 +2,6 @@ from yundownload.network.base import BaseProtocolHandler
 from yundownload.network.http import HttpProtocolHandler
 from yundownload.network.ftp import FTPProtocolHandler
 from yundownload.network.sftp import SFTPProtocolHandler
-from yundownload.network.m3u import M3U8ProtocolHandler
\ No newline at end of file
+from yundownload.network.m3u import M3U8ProtocolHandler
+from yundownload.network.pool import HttpClientPool, client_pool
+from yundownload.network.probe import ProbeCache, ProbeInfo, probe_cache
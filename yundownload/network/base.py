@@ -1,17 +1,22 @@
+import asyncio
 import os
 import time
 from abc import ABC, abstractmethod
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Iterator
 
-from yundownload.utils import retry
+from yundownload.utils import retry, retry_async
 from yundownload.utils.core import Environment
 
 from yundownload.utils.tools import Interval
 from yundownload.utils import Result
+from yundownload.utils.checksum import Checksum
+from yundownload.utils.throttle import Throttle
 from yundownload.utils.logger import logger
+from yundownload.utils.progress import Phase, ProgressPublisher, ProgressSlot
 
 if TYPE_CHECKING:
     from yundownload.core import Resources
+    from yundownload.utils.sync import RemoteFile
 
 
 class BaseProtocolHandler(ABC):
@@ -28,11 +33,48 @@ class BaseProtocolHandler(ABC):
         self._total = 0
         self._steps = 0
         self.resources = None
-        self.timer = Interval(int(os.getenv(Environment.LOG_EVERY, 5)), self._print)
+        self.phase = Phase.PENDING
+        self.progress_slot: ProgressSlot | None = None
+        self._checksum: Checksum | None = None
+        self._throttle: Throttle | None = None
+        self._publisher: ProgressPublisher | None = None
+        self._log_every = int(os.getenv(Environment.LOG_EVERY, 5))
+        self._last_print = time.monotonic()
+        self.timer = Interval(float(os.getenv(Environment.PROGRESS_EVERY, 1)), self._tick)
 
     def _print(self):
+        self._last_print = time.monotonic()
         logger.resource_p2s(self.resources, self.progress, self.speed)
 
+    def _publish(self):
+        """
+        Publish the progress to the parent process if the job has a progress slot
+        """
+        if self.progress_slot is None:
+            return
+        if self._publisher is None:
+            self._publisher = ProgressPublisher(self.progress_slot)
+        self._publisher.publish(self.current_size, self._total_size, self._steps, self._total, self.phase)
+
+    def _tick(self):
+        self._publish()
+        if time.monotonic() - self._last_print >= self._log_every:
+            self._print()
+
+    def _verify_checksum(self, resources: 'Resources') -> 'Result':
+        """
+        Compare the digest computed while downloading with the expected one, a corrupt file is removed
+
+        :param resources: Resource object
+        :return: SUCCESS if there is nothing to verify or the digest matches, FAILURE otherwise
+        """
+        if self._checksum is None or self._checksum.verify():
+            return Result.SUCCESS
+        logger.error(f'{self._checksum.algorithm} checksum mismatch: {resources.uri} '
+                     f'expected {self._checksum.expected} got {self._checksum.hexdigest()}')
+        resources.save_path.unlink(missing_ok=True)
+        return Result.FAILURE
+
     @property
     def progress(self) -> float:
         """
@@ -84,7 +126,9 @@ class BaseProtocolHandler(ABC):
         :return: Result object
         """
         logger.resource_start(resources)
+        result = Result.FAILURE
         try:
+            self.phase = Phase.PROBING
             self.timer.start()
             self.resources = resources
             result = retry(
@@ -101,10 +145,50 @@ class BaseProtocolHandler(ABC):
             logger.resource_error(resources, e)
         finally:
             self.timer.cancel()
+            self.phase = Phase.FAILED if result.is_failure() else Phase.DONE
+            self._publish()
             self._print()
 
         return result
 
+    async def acall(self, resources: 'Resources') -> 'Result':  # noqa
+        """
+        Invoke the download method on the running event loop
+
+        :param resources: Resource object
+        :return: Result object
+        """
+        logger.resource_start(resources)
+        result = Result.FAILURE
+        self.phase = Phase.PROBING
+        ticker = asyncio.create_task(self._tick_every(self.timer.interval))
+        try:
+            self.resources = resources
+            self._flush()
+            result = await retry_async(
+                retry_count=resources.retry,
+                retry_delay=resources.retry_delay
+            )(self.adownload)(resources)
+            if result.is_success():
+                logger.resource_result(resources, result)
+            elif result.is_exist():
+                logger.resource_exist(resources)
+        except Exception as e:
+            result = Result.FAILURE
+            logger.resource_error(resources, e)
+        finally:
+            ticker.cancel()
+            self.phase = Phase.FAILED if result.is_failure() else Phase.DONE
+            self._publish()
+            self._print()
+
+        return result
+
+    async def _tick_every(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self._tick()
+
     def _flush(self):
         """
         Flush the current status
@@ -125,6 +209,27 @@ class BaseProtocolHandler(ABC):
         self._flush()
         pass
 
+    async def adownload(self, resources: 'Resources') -> 'Result':  # noqa
+        """
+        Download resources without blocking the event loop
+
+        Protocols built on blocking libraries run ``download`` in a thread,
+        asynchronous protocols override this method.
+        """
+        return await asyncio.to_thread(self.download, resources)
+
+    def walk(self, resources: 'Resources') -> Iterator['RemoteFile']:
+        """
+        List the files of the directory tree the resource uri points to
+
+        Protocols that can list directories override this method, ``Downloader.mirror`` downloads
+        the files it yields.
+
+        :param resources: Resource object of the directory
+        :return: Files with paths relative to the directory
+        """
+        raise NotImplementedError(f'{self.__class__.__name__} cannot list directories')
+
     @abstractmethod
     def close(self):
         """
@@ -1,12 +1,29 @@
-from ftplib import FTP, error_perm, error_reply
+import asyncio
+import calendar
+import os
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ftplib import FTP, error_perm, error_reply, all_errors
 from pathlib import Path
+from typing import Callable, Iterator
 from urllib.parse import urlparse, unquote
 
 from yundownload.core.resources import Resources
 from yundownload.network.base import BaseProtocolHandler
+from yundownload.network.pool import client_pool, ftp_pool
+from yundownload.utils.checksum import Checksum
+from yundownload.utils.config import DEFAULT_CHUNK_SIZE, DEFAULT_SLICED_CHUNK_SIZE, DEFAULT_MIN_SPLIT_SIZE, \
+    DEFAULT_JOURNAL_INTERVAL
 from yundownload.utils.core import Result
-from yundownload.utils.exceptions import ConnectionException, AuthException
+from yundownload.utils.exceptions import ConnectionException, AuthException, DownloadException
+from yundownload.utils.journal import DownloadJournal, complement_ranges
 from yundownload.utils.logger import logger
+from yundownload.utils.progress import Phase
+from yundownload.utils.sync import RemoteFile, walk_tree
+from yundownload.utils.ranges import ByteRange, RangeScheduler
+from yundownload.utils.throttle import Throttle
+from yundownload.utils.tools import convert_state_path, preallocate_file
 
 
 class FTPProtocolHandler(BaseProtocolHandler):
@@ -15,6 +32,15 @@ class FTPProtocolHandler(BaseProtocolHandler):
         self.ftp = None
         self.support_rest = False
         self.support_size = False
+        self.features: set[str] = set()
+        self._login_args: tuple = ()
+        self._session_key: tuple = ()
+        self._remote_path = ''
+        self._scheduler: RangeScheduler | None = None
+        self._journal: DownloadJournal | None = None
+        self._stopping = False
+        self._hash_event: asyncio.Event | None = None
+        self._hash_stop = False
 
     @staticmethod
     def check_protocol(uri: str) -> bool:
@@ -24,108 +50,491 @@ class FTPProtocolHandler(BaseProtocolHandler):
     def download(self, resources: "Resources"):
         return self._download(resources)
 
+    async def adownload(self, resources: "Resources") -> Result:
+        try:
+            result = await asyncio.to_thread(self._prepare, resources)
+            if result == Result.UNKNOWN:
+                if self._use_slices(resources):
+                    result = await self._sliced_download(resources)
+                else:
+                    result = await asyncio.to_thread(self._stream_download, resources)
+        except BaseException:
+            self._release(False)
+            raise
+        self._release(True)
+        return result
+
     def _download(self, resources: "Resources"):
-        """实现断点续传的流式下载"""
+        """实现断点续传的流式下载，服务器支持 REST 的大文件通过多个连接分段下载"""
+        try:
+            result = self._prepare(resources)
+            if result == Result.UNKNOWN:
+                if self._use_slices(resources):
+                    result = client_pool.run(self._sliced_download(resources))
+                else:
+                    result = self._stream_download(resources)
+        except BaseException:
+            self._release(False)
+            raise
+        self._release(True)
+        return result
+
+    def _prepare(self, resources: "Resources") -> Result:
+        """
+        Lease a logged-in session, get the size of the remote file and check the local file
+
+        :return: Result.UNKNOWN if the file has to be downloaded
+        """
         uri = resources.uri
         local_path = resources.save_path
 
-        parsed = urlparse(uri)
-        host = parsed.hostname
-        port = parsed.port or resources.ftp_port or 21
-        username = parsed.username or "anonymous"
-        password = parsed.password or "anonymous@"
-        remote_path = unquote(parsed.path)
-
-        if remote_path.startswith('/'):
-            # 某些FTP服务器不需要前导斜杠
-            remote_path = remote_path[1:]
+        remote_path = self._parse_uri(resources)
         if not remote_path:
             logger.error(f"Empty remote path in URI: {uri}")
             return Result.FAILURE
 
-        self._connect(host, port, resources.ftp_timeout)
-        self._login(username, password)
+        self._remote_path = remote_path
+        self.ftp = ftp_pool.acquire(self._session_key, self._open_session)
+        # A pooled session may come back from a listing in ASCII mode, SIZE and RETR need binary mode
+        self.ftp.voidcmd("TYPE I")
+        self._detect_capabilities()
 
         logger.info(f"Login success to {uri}")
 
         file_size = self._get_remote_size(remote_path)
-
-        prepare = self._prepare_local_file(local_path, file_size)
         self._total_size = file_size
-        if prepare == Result.EXIST:
-            return Result.EXIST
+        journal_path = convert_state_path(local_path)
+        if journal_path.exists():
+            if self._use_slices(resources):
+                return Result.UNKNOWN
+            # The preallocated file of an unfinished sliced download cannot be continued by streaming
+            logger.info(f"FTP sliced download is continued by streaming, restart download: {local_path}")
+            local_path.unlink(missing_ok=True)
+            journal_path.unlink()
+        return self._prepare_local_file(local_path, file_size)
+
+    def _parse_uri(self, resources: "Resources") -> str:
+        """
+        Take the login of the resource uri
+
+        :return: Remote path
+        """
+        parsed = urlparse(resources.uri)
+        host = parsed.hostname
+        port = parsed.port or resources.ftp_port or 21
+        username = parsed.username or "anonymous"
+        password = parsed.password or "anonymous@"
+        self._login_args = (host, port, username, password, resources.ftp_timeout)
+        self._session_key = ftp_pool.session_key(host, port, username, password)
+        # 某些FTP服务器不需要前导斜杠
+        return unquote(parsed.path).lstrip('/')
+
+    def walk(self, resources: "Resources") -> Iterator[RemoteFile]:
+        """
+        List the directory tree with MLSD over pooled sessions, several directories at once
+        """
+        root = self._parse_uri(resources).rstrip('/')
+        return walk_tree(self._list_dir, root)
+
+    def _list_dir(self, path: str) -> list[tuple[str, bool, int, float]]:
+        ftp = ftp_pool.acquire(self._session_key, self._open_session)
+        try:
+            entries = []
+            for name, facts in ftp.mlsd(path):
+                kind = facts.get('type', '').lower()
+                if kind in ('file', 'dir'):
+                    size = int(facts.get('size', 0))
+                    entries.append((name, kind == 'dir', size, self._mlsd_time(facts.get('modify'))))
+        except error_perm as e:
+            ftp_pool.release(ftp)
+            raise DownloadException(f"FTP listing of {path or '/'} failed, the server needs to support MLSD: {e}")
+        except BaseException:
+            ftp_pool.release(ftp, reusable=False)
+            raise
+        ftp_pool.release(ftp)
+        return entries
+
+    @staticmethod
+    def _mlsd_time(value: str | None) -> float:
+        """
+        Timestamp of an MLSD time value, YYYYMMDDHHMMSS[.sss] in UTC
+        """
+        if not value:
+            return 0.0
+        seconds, _, fraction = value.partition('.')
+        timestamp = calendar.timegm(time.strptime(seconds[:14], '%Y%m%d%H%M%S'))
+        return timestamp + float(f'0.{fraction}') if fraction.isdigit() else float(timestamp)
+
+    def _use_slices(self, resources: "Resources") -> bool:
+        return (self.support_rest and hasattr(os, 'pwrite') and resources.ftp_max_connections > 1
+                and resources.dcc.max_concurrency > 1
+                and self._total_size >= max(resources.ftp_slice_threshold, 2 * DEFAULT_MIN_SPLIT_SIZE))
+
+    def _stream_download(self, resources: "Resources") -> Result:
+        uri = resources.uri
+        local_path = resources.save_path
+        remote_path = self._remote_path
+        self.phase = Phase.DOWNLOADING
+        self._checksum = Checksum.from_resources(resources)
+        self._throttle = Throttle(resources)
 
         with open(local_path, "ab" if self.support_rest else "wb") as f:
             self.current_size += local_path.stat().st_size
             start_pos = f.tell()
+            if self._checksum is not None:
+                self._checksum.update_from_file(local_path, start_pos)
 
             if self.support_rest and start_pos > 0:
                 logger.info(f"FTP download resuming from {uri}")
-                self.ftp.voidcmd(f"REST {start_pos}")
 
-            def write_chunk(data: bytes):
+            def write_chunk(data: memoryview):
                 f.write(data) # noqa
                 self.current_size += len(data)
+                if self._checksum is not None:
+                    self._checksum.update(data)
+                self._throttle.consume(len(data))
 
             logger.info(f"FTP download started from {uri}")
-            resp = self.ftp.retrbinary(f"RETR {remote_path}", write_chunk, rest=start_pos)
+            resp = self._retrbinary(f"RETR {remote_path}", write_chunk, rest=start_pos,
+                                    blocksize=self._throttle.chunk_size(DEFAULT_CHUNK_SIZE))
 
             if not resp.startswith("226"):
                 logger.error(f"The FTP transfer did not complete {uri}")
                 return Result.FAILURE
 
-            return Result.SUCCESS
+        return self._verify_checksum(resources)
 
-    def close(self):
-        """关闭连接"""
-        if self.ftp:
+    def _retrbinary(self, cmd: str, callback: Callable[[memoryview], None], blocksize: int, rest: int = None) -> str:
+        """
+        FTP.retrbinary that receives into one reusable buffer instead of a new bytes per block
+
+        :param cmd: RETR command
+        :param callback: Called with a view of each block, only valid until it returns
+        :param blocksize: Maximum block size
+        :param rest: Offset to start the transfer at
+        :return: Final response of the server
+        """
+        buffer = bytearray(blocksize)
+        view = memoryview(buffer)
+        with self.ftp.transfercmd(cmd, rest) as conn:
+            while n := conn.recv_into(buffer):
+                callback(view[:n])
+            if isinstance(conn, ssl.SSLSocket):
+                conn.unwrap()
+        return self.ftp.voidresp()
+
+    async def _sliced_download(self, resources: "Resources") -> Result:
+        """
+        Download ranges of the file over several logged-in connections at once
+
+        Every connection fetches a range with ``REST offset`` and ``RETR``, and aborts the transfer once
+        the range is complete. The number of connections follows the adaptive concurrency of the host up
+        to ``ftp_max_connections``, idle connections split the largest unfinished range like the sliced
+        HTTP download.
+        """
+        resources.update_semaphore()
+        local_path = resources.save_path
+        size = self._total_size
+        self.phase = Phase.DOWNLOADING
+        self._checksum = Checksum.from_resources(resources)
+        self._throttle = Throttle(resources)
+        self._journal = DownloadJournal(convert_state_path(local_path))
+        local_size = local_path.stat().st_size if local_path.exists() else 0
+        streamed = not self._journal.path.exists() and 0 < local_size < size
+        if local_size != size:
+            self._journal.remove()
+        completed = self._journal.open(size, chunk=DEFAULT_SLICED_CHUNK_SIZE,
+                                       modified=self._modified(self._remote_path))
+        if streamed:
+            # Continue after the part an earlier streaming download left
+            completed = [(0, local_size - 1)]
+            self._journal.add(*completed[0])
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        preallocate_file(local_path, size)
+        self._scheduler = RangeScheduler(complement_ranges(completed, size), DEFAULT_SLICED_CHUNK_SIZE,
+                                         DEFAULT_MIN_SPLIT_SIZE)
+        self.current_size += size - self._scheduler.remaining
+        self._stopping = False
+        sessions = [self.ftp]
+        idle = [self.ftp]
+        unclean: set[FTP] = set()
+        self.ftp = None
+        fd = os.open(local_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        workers = min(resources.ftp_max_connections, resources.semaphore.max_target)
+        executor = ThreadPoolExecutor(workers, thread_name_prefix='yundownload-ftp')
+        hasher = None
+        if self._checksum is not None:
+            self._hash_event = asyncio.Event()
+            self._hash_stop = False
+            hasher = asyncio.create_task(self._sliced_hash(resources))
+        tasks = [
+            asyncio.create_task(self._sliced_worker(resources, executor, fd, sessions, idle, unclean))
+            for _ in range(workers)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            self._stopping = True
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            # Transfers of cancelled workers stop at their next block, the file is closed after them
+            await asyncio.to_thread(executor.shutdown)
+            for ftp in sessions:
+                ftp_pool.release(ftp, reusable=ftp not in unclean)
+            try:
+                if hasher is not None:
+                    self._hash_stop = True
+                    self._hash_event.set()
+                    await hasher
+            finally:
+                os.close(fd)
+                self._journal.close()
+        if self._scheduler:
+            return Result.FAILURE
+        self._journal.remove()
+        logger.info(f"FTP sliced download success: {local_path}")
+        return self._verify_checksum(resources)
+
+    async def _sliced_hash(self, resources: "Resources"):
+        """
+        Hash the file in order as the ranges complete
+
+        The bytes below the frontier of the scheduler are already in the file and are read back from the
+        page cache, parts kept from an earlier attempt are read the same way once the frontier passes them.
+        """
+        while True:
+            await self._hash_event.wait()
+            self._hash_event.clear()
+            frontier = self._scheduler.frontier
+            if frontier is None:
+                frontier = self._total_size
+            elif self._hash_stop:
+                # The download failed, the checksum starts over with the next attempt
+                return
+            if frontier > self._checksum.position:
+                await asyncio.to_thread(self._checksum.update_from_file, resources.save_path, frontier)
+            if self._hash_stop and self._scheduler.frontier is None and self._checksum.position >= self._total_size:
+                return
+
+    async def _sliced_worker(self, resources: "Resources", executor: ThreadPoolExecutor, fd: int,
+                             sessions: list[FTP], idle: list[FTP], unclean: set[FTP]):
+        """
+        Keep downloading ranges over one connection until there is nothing left to take or split
+
+        A connection that cannot be opened while others are running ends the worker quietly, servers
+        often limit the connections of a client. The connection of a worker cancelled during a transfer
+        is put into ``unclean``, its transfer may not have ended in step and it is closed afterwards.
+        """
+        loop = asyncio.get_running_loop()
+        sem = resources.semaphore
+        ftp = None
+        try:
+            while True:
+                async with sem:
+                    byte_range = self._scheduler.acquire()
+                    if byte_range is None:
+                        return
+                    started = time.monotonic()
+                    try:
+                        if ftp is None:
+                            if idle:
+                                ftp = idle.pop()
+                            else:
+                                try:
+                                    ftp = await loop.run_in_executor(executor, ftp_pool.acquire, self._session_key,
+                                                                     self._open_session)
+                                except Exception as e:
+                                    sem.record_result(success=False)
+                                    if sessions:
+                                        logger.warning(f"FTP connection refused, continue with {len(sessions)}: {e}")
+                                        return
+                                    raise
+                                sessions.append(ftp)
+                        try:
+                            reusable = await loop.run_in_executor(executor, self._fetch_range, ftp, byte_range,
+                                                                  fd, loop)
+                        except asyncio.CancelledError:
+                            unclean.add(ftp)
+                            ftp = None
+                            raise
+                        if not reusable:
+                            sessions.remove(ftp)
+                            ftp_pool.release(ftp, reusable=False)
+                            ftp = None
+                    except Exception:
+                        sem.record_result(success=False)
+                        if ftp is not None:
+                            # The session is in an unknown state after a failed transfer
+                            sessions.remove(ftp)
+                            ftp_pool.release(ftp, reusable=False)
+                            ftp = None
+                        raise
+                    finally:
+                        self._scheduler.release(byte_range)
+                    sem.record_result(time.monotonic() - started, True)
+                    await sem.adaptive_update()
+        finally:
+            if ftp is not None:
+                idle.append(ftp)
+
+    def _fetch_range(self, ftp: FTP, byte_range: ByteRange, fd: int, loop: asyncio.AbstractEventLoop) -> bool:
+        """
+        Fetch a range into the file, runs in a worker thread
+
+        :return: Whether the connection can be used for the next range
+        """
+        logger.info(f"FTP sliced download {self._remote_path} {byte_range.pos}-{byte_range.end}")
+        blocksize = self._throttle.chunk_size(DEFAULT_CHUNK_SIZE)
+        buffer = bytearray(blocksize)
+        view = memoryview(buffer)
+        recorded = byte_range.pos
+        ftp.voidcmd("TYPE I")
+        conn = ftp.transfercmd(f"RETR {self._remote_path}", byte_range.pos)
+        try:
+            while byte_range.remaining and not self._stopping:
+                n = conn.recv_into(buffer, min(blocksize, byte_range.remaining))
+                if not n:
+                    break
+                # The tail of the range may have been handed to another worker meanwhile
+                n = min(n, byte_range.remaining)
+                os.pwrite(fd, view[:n], byte_range.pos)
+                byte_range.pos += n
+                loop.call_soon_threadsafe(self._advance, n)
+                if byte_range.pos - recorded >= DEFAULT_JOURNAL_INTERVAL:
+                    loop.call_soon_threadsafe(self._journal.add, recorded, byte_range.pos - 1)
+                    recorded = byte_range.pos
+                self._throttle.consume(n)
+        finally:
+            loop.call_soon_threadsafe(self._journal.add, recorded, byte_range.pos - 1)
+        reusable = self._end_transfer(ftp, conn, byte_range.pos < self._total_size)
+        if byte_range.remaining and not self._stopping:
+            raise IOError(f"range ended early at {byte_range.pos}, expected {byte_range.end}: {self._remote_path}")
+        return reusable
+
+    @staticmethod
+    def _end_transfer(ftp: FTP, conn, abort: bool) -> bool:
+        """
+        Close the data connection, aborting the transfer if the file was not read to its end
+
+        Servers answer the abort differently, a NOOP is sent afterwards and the replies before its
+        own are skipped so the connection is in step again.
+
+        :return: Whether the connection can be used further
+        """
+        try:
+            conn.close()
+            if not abort:
+                ftp.voidresp()
+                return True
             try:
-                self.ftp.quit()
-            except Exception:
+                ftp.abort()
+            except (error_reply, error_perm):
                 pass
+            ftp.putcmd('NOOP')
+            while not ftp.getline().startswith('200'):
+                pass
+            return True
+        except all_errors as e:
+            logger.warning(f"FTP connection is out of step after a transfer, reconnect: {e}")
+            return False
+
+    def _advance(self, nbytes: int):
+        self.current_size += nbytes
+        if self._hash_event is not None:
+            self._hash_event.set()
+
+    def _open_session(self) -> FTP:
+        """
+        Open a logged-in connection with the login of the resource
+
+        The transfer type is not kept, a session is switched to binary mode before every download.
+        """
+        host, port, username, password, timeout = self._login_args
+        ftp = self._connect(host, port, timeout)
+        try:
+            self._login(ftp, username, password)
+        except BaseException:
+            ftp.close()
+            raise
+        return ftp
+
+    def _release(self, reusable: bool):
+        """
+        Give the session back to the pool, a session left in an unknown state is closed
+        """
+        if self.ftp is not None:
+            ftp_pool.release(self.ftp, reusable)
             self.ftp = None
 
-    def _connect(self, host: str, port: int, timeout: int):
+    def _modified(self, remote_path: str) -> str | None:
+        """
+        Modification time of the remote file, a resumed download restarts when it changed
+        """
+        if 'MDTM' not in self.features:
+            return None
+        try:
+            return self.ftp.voidcmd(f"MDTM {remote_path}")[4:].strip()
+        except all_errors:
+            return None
+
+    def close(self):
+        """关闭连接"""
+        self._release(False)
+
+    @staticmethod
+    def _connect(host: str, port: int, timeout: int) -> FTP:
         """建立FTP连接"""
-        self.ftp = FTP()
+        ftp = FTP()
         try:
-            self.ftp.connect(host, port, timeout=timeout)
-            self._detect_capabilities()
+            ftp.connect(host, port, timeout=timeout)
         except Exception as e:
             raise ConnectionException(f"FTP connection failed: {e}")
+        return ftp
 
-    def _login(self, username: str, password: str):
+    @staticmethod
+    def _login(ftp: FTP, username: str, password: str):
         """用户认证"""
         try:
-            resp = self.ftp.login(username, password)
+            resp = ftp.login(username, password)
             if "230" not in resp:
                 raise AuthException("FTP authentication failed")
         except error_perm as e:
             raise AuthException(f"Authentication error: {e}")
 
     def _detect_capabilities(self):
-        """检测服务器能力"""
+        """检测服务器能力，需要在登录之后进行，结果按服务器与登录缓存"""
+        cached = ftp_pool.capabilities(self._session_key)
+        if cached is not None:
+            self.features, self.support_rest, self.support_size = cached
+            return
         try:
-            # 检测REST支持
-            self.ftp.voidcmd("REST 0")
-            self.support_rest = True
-        except error_perm:
-            self.support_rest = False
+            # FEAT 的每一行是一个扩展命令，例如 "REST STREAM"、"SIZE"
+            lines = self.ftp.sendcmd("FEAT").splitlines()[1:-1]
+            self.features = {line.strip().split(' ')[0].upper() for line in lines if line.strip()}
+        except (error_perm, error_reply):
+            self.features = set()
 
-        try:
-            # 检测SIZE支持
-            self.ftp.voidcmd("TYPE I")
-            self.ftp.size("")
-            self.support_size = True
-        except error_perm:
-            self.support_size = False
+        self.support_rest = 'REST' in self.features
+        if not self.support_rest:
+            try:
+                # 检测REST支持
+                self.ftp.voidcmd("REST 0")
+                self.support_rest = True
+            except error_perm:
+                self.support_rest = False
+
+        self.support_size = 'SIZE' in self.features or not self.features
+        ftp_pool.cache_capabilities(self._session_key, (self.features, self.support_rest, self.support_size))
 
     def _get_remote_size(self, remote_path: str) -> int:
         """获取远程文件大小"""
         if self.support_size:
             try:
-                return self.ftp.size(remote_path)
-            except error_reply:
+                return self.ftp.size(remote_path) or 0
+            except (error_reply, error_perm):
                 pass
         return 0
 
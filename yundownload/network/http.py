@@ -1,16 +1,25 @@
 import asyncio
-from pathlib import Path
+import time
 from typing import TYPE_CHECKING
 
-import aiofiles
 import httpx
 
 from yundownload.network.base import BaseProtocolHandler
-from yundownload.utils.config import DEFAULT_HEADERS, DEFAULT_CHUNK_SIZE
+from yundownload.network.pool import client_pool
+from yundownload.network.probe import ProbeInfo, probe_cache
+from yundownload.utils.checksum import Checksum
+from yundownload.utils.config import DEFAULT_CHUNK_SIZE, DEFAULT_MIN_SPLIT_SIZE, DEFAULT_JOURNAL_INTERVAL
 from yundownload.utils.core import Result
 from yundownload.utils.equilibrium import DynamicSemaphore
+from yundownload.utils.exceptions import ChunkUnsupportedException, ResourceChangedException
+from yundownload.utils.journal import DownloadJournal, complement_ranges
 from yundownload.utils.logger import logger
-from yundownload.utils.tools import convert_slice_path
+from yundownload.utils.mirrors import Mirror, MirrorSelector
+from yundownload.utils.progress import Phase
+from yundownload.utils.ranges import RangeScheduler, ByteRange
+from yundownload.utils.throttle import Throttle
+from yundownload.utils.tools import convert_state_path, preallocate_file
+from yundownload.utils.writer import WriteBehind
 
 if TYPE_CHECKING:
     from yundownload.core.resources import Resources
@@ -20,111 +29,150 @@ class HttpProtocolHandler(BaseProtocolHandler):
 
     def __init__(self):
         super().__init__()
-        self.client: None | httpx.Client = None
         self.aclient: None | httpx.AsyncClient = None
+        self._request_options = {}
         self._method = 'GET'
+        self._chunk_size = DEFAULT_CHUNK_SIZE
+        self._http2 = False
         self._slice_threshold = None
         self.sliced_chunk_size = None
+        self._scheduler: None | RangeScheduler = None
+        self._journal: None | DownloadJournal = None
+        self._writer: None | WriteBehind = None
+        self._fd: None | int = None
+        self._mirrors: None | MirrorSelector = None
+        self._validators: dict[str, str | None] = {}
+        self._hash_event: None | asyncio.Event = None
+        self._hashing = False
+        self._hash_stop = False
 
     def download(self, resources: 'Resources'):
+        return client_pool.run(self.adownload(resources))
+
+    async def adownload(self, resources: 'Resources') -> Result:
         self._slice_threshold = resources.http_slice_threshold
         self._method = resources.http_method
         self.sliced_chunk_size = resources.http_sliced_chunk_size
-
-        # 创建基础配置
-        base_config = self._create_base_config(resources)
-
-        # 创建同步客户端
-        sync_config = base_config.copy()
-        sync_config['mounts'] = {
-            'http://': httpx.HTTPTransport(
-                proxy=resources.http_proxy.get('http'),
-            ),
-            'https://': httpx.HTTPTransport(
-                proxy=resources.http_proxy.get('https'),
-            )
-        }
-        sync_config['transport'] = httpx.HTTPTransport(retries=5)
-
-        self.client = httpx.Client(**sync_config)
-        self.client.params.merge(resources.http_params)
-        self.client.headers.update(resources.http_headers)
-        self.client.cookies.update(resources.http_cookies)
-
-        # 创建异步客户端
-        async_config = base_config.copy()
-        async_config['mounts'] = {
-            'http://': httpx.AsyncHTTPTransport(
-                proxy=resources.http_proxy.get('http'),
-            ),
-            'https://': httpx.AsyncHTTPTransport(
-                proxy=resources.http_proxy.get('https'),
-            )
-        }
-        async_config['transport'] = httpx.AsyncHTTPTransport(retries=5)
-
-        self.aclient = httpx.AsyncClient(**async_config)
+        self._throttle = Throttle(resources)
+        self._chunk_size = self._throttle.chunk_size(DEFAULT_CHUNK_SIZE)
         resources.update_semaphore()
-        return self._match_method(resources)
+        self._http2 = client_pool.http2_enabled(resources)
+        async with client_pool.client(resources) as self.aclient:
+            self._request_options = client_pool.request_options(resources)
+            result = Result.FAILURE
+            try:
+                result = await self._match_method(resources)
+            finally:
+                if result.is_failure() and self._probe_key(resources):
+                    # The cached probe may be the reason, the next attempt probes again
+                    probe_cache.invalidate(self._probe_key(resources))
+            return result
 
-    @staticmethod
-    def _create_base_config(resources: 'Resources'):
-        """
-        创建HTTP客户端的基础配置
-        
-        Args:
-            resources: 资源对象
-            
-        Returns:
-            包含基础配置的字典
-        """
-        return {
-            'timeout': resources.http_timeout,
-            'auth': resources.http_auth,
-            'headers': DEFAULT_HEADERS,
-            'follow_redirects': True,
-            'verify': resources.http_verify
-        }
+    def _stream(self, resources: 'Resources', url: str | httpx.URL = None, headers: dict = None, **kwargs):
+        """
+        Open a streaming request with the options of the resource
+
+        :param resources: Resource object
+        :param url: Request url, the resource uri by default
+        :param headers: Extra request headers
+        :return: Response stream context
+        """
+        options = dict(self._request_options)
+        options['headers'] = {**options.get('headers', {}), **(headers or {})}
+        if url is None:
+            url = resources.uri
+            kwargs.setdefault('data', resources.http_data)
+        else:
+            options.pop('params', None)
+        return self.aclient.stream(self._method, url, **options, **kwargs)
 
     @staticmethod
     def check_protocol(uri: str) -> bool:
         check_uri = uri.lower()
         return check_uri.startswith('http') or check_uri.startswith('https')
 
-    def _match_method(self, resources: 'Resources') -> Result:
+    @staticmethod
+    def _probe_key(resources: 'Resources') -> str | None:
+        """
+        Key of the resource in the probe cache, requests with a body are never cached
+        """
+        if resources.http_data:
+            return None
+        return f'{resources.http_method} {httpx.URL(resources.uri, params=resources.http_params)}'
+
+    async def _probe(self, resources: 'Resources') -> ProbeInfo:
+        """
+        Probe the size, validators and range support of the resource
+        """
         try:
-            test_response = self.client.head(resources.uri)
+            test_response = await self.aclient.head(resources.uri, **self._request_options)
             test_response.raise_for_status()
-            content_length = int(test_response.headers.get('Content-Length', 0))
-        except httpx.HTTPStatusError as e:
+        except httpx.HTTPStatusError:
+            async with self._stream(resources) as test_response:
+                test_response.raise_for_status()
+        return ProbeInfo(test_response.headers, await self._breakpoint_resumption(test_response))
+
+    async def _match_method(self, resources: 'Resources') -> Result:
+        probe_key = self._probe_key(resources)
+        if self._http2 and client_pool.http2_negotiated(resources) is None:
+            # The probe tells whether the origin negotiates h2
+            probe = None
+        else:
+            probe = probe_cache.get(probe_key) if probe_key else None
+        if probe is None:
             try:
-                with self.client.stream(self._method, resources.uri, data=resources.http_data) as test_response:
-                    test_response.raise_for_status()
-                    content_length = int(test_response.headers.get('Content-Length', 0))
-            except Exception as e2:
-                logger.error(e2, exc_info=True)
+                probe = await self._probe(resources)
+            except Exception as e:
+                logger.error(e, exc_info=True)
                 return Result.FAILURE
-        except Exception as e:
-            logger.error(e, exc_info=True)
-            return Result.FAILURE
+            if probe_key and probe.content_length:
+                probe_cache.put(probe_key, probe)
+        else:
+            logger.info(f'probe cache hit: {resources.uri}')
+        content_length = probe.content_length
 
-        if resources.save_path.exists():
+        state_path = convert_state_path(resources.save_path)
+        if resources.save_path.exists() and not state_path.exists():
             if resources.save_path.stat().st_size == content_length:
                 return Result.EXIST
             elif resources.save_path.stat().st_size > content_length:
                 resources.save_path.unlink()
         resources.save_path.parent.mkdir(parents=True, exist_ok=True)
-        breakpoint_flag = self._breakpoint_resumption(test_response)
+        breakpoint_flag = probe.accept_ranges
         resources.metadata['_breakpoint_flag'] = breakpoint_flag
         self._total_size = content_length
+        self._validators = {
+            'etag': probe.headers.get('ETag'),
+            'last_modified': probe.headers.get('Last-Modified')
+        }
+        self._checksum = Checksum.from_resources(resources)
+        if self._checksum is None and probe.headers.get('Content-Encoding', 'identity') == 'identity':
+            self._checksum = Checksum.from_headers(probe.headers)
+        self.phase = Phase.DOWNLOADING
+        if self._http2 and not client_pool.http2_enabled(resources):
+            # The few connections of an HTTP/2 client would starve the slices over HTTP/1.1
+            self._http2 = False
+            async with client_pool.client(resources) as self.aclient:
+                return await self._transfer(resources, content_length, breakpoint_flag)
+        return await self._transfer(resources, content_length, breakpoint_flag)
+
+    async def _transfer(self, resources: 'Resources', content_length: int, breakpoint_flag: bool) -> Result:
+        """
+        Download the resource sliced or streamed, depending on the probe
+        """
+        state_path = convert_state_path(resources.save_path)
         if breakpoint_flag and content_length > self._slice_threshold and not resources.http_stream:
             logger.info(f'sliced download: {content_length} {resources.uri} to {resources.save_path}')
-            return asyncio.run(self._sliced_download(resources, content_length))
+            return await self._sliced_download(resources, content_length)
         else:
+            if state_path.exists():
+                # The preallocated file of an unfinished sliced download cannot be continued by streaming
+                resources.save_path.unlink(missing_ok=True)
+                state_path.unlink()
             logger.info(f'stream download: {resources.uri} to {resources.save_path}')
-            return self._stream_download(resources, content_length)
+            return await self._stream_download(resources, content_length)
 
-    def _stream_download(self, resources: 'Resources', content_length: int) -> Result:
+    async def _stream_download(self, resources: 'Resources', content_length: int) -> Result:
         headers = {}
         if resources.save_path.exists():
             file_size = resources.save_path.stat().st_size
@@ -135,106 +183,228 @@ class HttpProtocolHandler(BaseProtocolHandler):
                 resources.save_path.unlink()
             else:
                 headers['Range'] = f'bytes={file_size}-'
+                if_range = self._if_range()
+                if if_range:
+                    headers['If-Range'] = if_range
 
-        with self.client.stream(self._method,
-                                resources.uri,
-                                headers=headers,
-                                data=resources.http_data) as response:
+        async with self._stream(resources, headers=headers) as response:
             response.raise_for_status()
-            if resources.metadata.get('_breakpoint_flag', False):
+            if resources.metadata.get('_breakpoint_flag', False) and response.status_code == 206:
                 file_mode = 'ab'
             else:
+                # A full response replaces whatever was downloaded before
                 file_mode = 'wb'
-            with resources.save_path.open(file_mode) as f:
-                self.current_size += resources.save_path.stat().st_size
-                for chunk in response.iter_bytes(chunk_size=DEFAULT_CHUNK_SIZE):
-                    f.write(chunk)
+            offset = resources.save_path.stat().st_size if file_mode == 'ab' else 0
+            self.current_size += offset
+            if self._checksum is not None and offset:
+                await asyncio.to_thread(self._checksum.update_from_file, resources.save_path, offset)
+            writer = WriteBehind()
+            fd = writer.open(resources.save_path, truncate=file_mode == 'wb')
+            try:
+                async for chunk in response.aiter_bytes(chunk_size=self._chunk_size):
+                    await writer.write(fd, offset, chunk)
+                    offset += len(chunk)
                     self.current_size += len(chunk)
-        return Result.SUCCESS
+                    if self._checksum is not None:
+                        self._checksum.update(chunk)
+                    await self._throttle.aconsume(len(chunk), response.url.host)
+            finally:
+                await writer.close_file(fd)
+                await writer.aclose()
+        return self._verify_checksum(resources)
 
     async def _sliced_download(self, resources: 'Resources', content_length: int) -> Result:
-        path_template = convert_slice_path(resources.save_path)
-        chunks_path = []
-        tasks = []
-        for start in range(0, content_length, self.sliced_chunk_size):
-            end = start + self.sliced_chunk_size - 1
-            if end > (content_length - 1):
-                end = content_length - 1
-            slice_path = path_template(start)
-            tasks.append(
-                asyncio.create_task(
-                    self._sliced_chunked_download(resources, slice_path, start, end, resources.semaphore)
-                )
-            )
-            chunks_path.append(slice_path)
-        results = await asyncio.gather(*tasks)
-        if all(results):
-            self._merge_chunk(resources.save_path, chunks_path)
-            if not self.aclient.is_closed:
-                await self.aclient.aclose()
-            return Result.SUCCESS
-        return Result.FAILURE
-
-    async def _sliced_chunked_download(self, resources: 'Resources', save_path: Path, start: int, end: int,
-                                       sem: 'DynamicSemaphore') -> bool:
-        async with sem:
-            logger.info(f'start sliced download: {resources.uri} to {resources.save_path} {start}-{end}')
-            headers = {'Range': f'bytes={start}-{end}'}
-            if save_path.exists():
-                chunk_file_size = save_path.stat().st_size
-                if chunk_file_size == self.sliced_chunk_size:
-                    logger.info(f'slice exist skip download: {resources.uri} to {save_path}')
-                    self.current_size += save_path.stat().st_size
-                    return True
-                elif chunk_file_size > self.sliced_chunk_size:
-                    logger.info(f'slice size is larger than the slice size: {resources.uri} to {save_path}')
-                    save_path.unlink()
-                elif chunk_file_size == end - start + 1:
-                    logger.info(f'slice exist skip download: {resources.uri} to {save_path}')
-                    self.current_size += save_path.stat().st_size
-                    return True
-                else:
-                    file_start = start + chunk_file_size
-                    logger.info(f'slice breakpoint resumption: {resources.uri} to {save_path}')
-                    headers['Range'] = f'bytes={file_start}-{end}'
-                    if file_start == end:
-                        logger.info(f'slice exist skip download: {resources.uri} to {save_path}')
-                        self.current_size += save_path.stat().st_size
-                        return True
-            async with self.aclient.stream(self._method,
-                                           resources.uri,
-                                           headers=headers,
-                                           data=resources.http_data) as response:
+        self._journal = DownloadJournal(convert_state_path(resources.save_path))
+        if not resources.save_path.exists() or resources.save_path.stat().st_size != content_length:
+            self._journal.remove()
+        completed = self._journal.open(content_length, chunk=self.sliced_chunk_size, **self._validators)
+        preallocate_file(resources.save_path, content_length)
+        self._scheduler = RangeScheduler(
+            complement_ranges(completed, content_length),
+            self.sliced_chunk_size,
+            DEFAULT_MIN_SPLIT_SIZE
+        )
+        self.current_size += content_length - self._scheduler.remaining
+        self._mirrors = MirrorSelector([
+            Mirror(resources.uri, self._validators, primary=True),
+            *await self._probe_mirrors(resources, content_length)
+        ])
+        self._writer = WriteBehind()
+        self._fd = self._writer.open(resources.save_path)
+        hasher = None
+        if self._checksum is not None:
+            self._hash_event = asyncio.Event()
+            self._hash_stop = False
+            hasher = asyncio.create_task(self._sliced_hash(resources))
+        tasks = [
+            asyncio.create_task(self._sliced_worker(resources, resources.semaphore))
+            for _ in range(resources.semaphore.max_target)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            try:
+                if hasher is not None:
+                    self._hash_stop = True
+                    self._hash_event.set()
+                    await hasher
+            finally:
+                # The journal records queued behind the data are written before it is closed
+                await self._writer.close_file(self._fd)
+                await self._writer.aclose()
+                self._journal.close()
+        if self._scheduler:
+            return Result.FAILURE
+        self._journal.remove()
+        logger.info(f'sliced file success: {resources.save_path}')
+        return self._verify_checksum(resources)
+
+    async def _sliced_hash(self, resources: 'Resources'):
+        """
+        Hash the file in order as the ranges complete
+
+        The worker writing at the front of the file feeds the checksum directly, whatever other workers
+        wrote ahead of it is read back from the page cache once the front reaches it.
+        """
+        while True:
+            await self._hash_event.wait()
+            self._hash_event.clear()
+            frontier = self._scheduler.frontier
+            if frontier is None:
+                frontier = self._total_size
+            elif self._hash_stop:
+                # The download failed, the checksum starts over with the next attempt
+                return
+            if frontier > self._checksum.position:
+                # Everything below the frontier is queued, wait for it to reach the file
+                await self._writer.flush()
+                self._hashing = True
+                try:
+                    await asyncio.to_thread(self._checksum.update_from_file, resources.save_path, frontier)
+                finally:
+                    self._hashing = False
+            if self._hash_stop and self._scheduler.frontier is None and self._checksum.position >= self._total_size:
+                return
+
+    async def _probe_mirrors(self, resources: 'Resources', content_length: int) -> list[Mirror]:
+        """
+        Probe the mirrors of the resource, mirrors that fail or serve different content are left out
+        """
+
+        async def probe(uri: str) -> Mirror | None:
+            try:
+                response = await self.aclient.head(uri, headers=self._request_options.get('headers'),
+                                                   timeout=self._request_options.get('timeout'))
+                response.raise_for_status()
+            except Exception as e:
+                logger.warning(f'drop mirror {uri}: {e}')
+                return None
+            validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+            if int(response.headers.get('Content-Length', -1)) != content_length:
+                logger.warning(f'drop mirror {uri}: Content-Length {response.headers.get("Content-Length")} '
+                               f'differs from {content_length}')
+                return None
+            if validators['etag'] and self._validators.get('etag') and validators['etag'] != self._validators['etag']:
+                logger.warning(f'drop mirror {uri}: ETag {validators["etag"]} differs from {self._validators["etag"]}')
+                return None
+            return Mirror(uri, validators)
+
+        mirrors = await asyncio.gather(*(probe(uri) for uri in resources.http_mirrors or ()))
+        return [mirror for mirror in mirrors if mirror is not None]
+
+    async def _sliced_worker(self, resources: 'Resources', sem: 'DynamicSemaphore'):
+        """
+        Keep downloading ranges until there is nothing left to take or split
+
+        A mirror that fails is dropped and its range goes back to the scheduler for the other mirrors.
+        """
+        while True:
+            async with sem:
+                byte_range = self._scheduler.acquire()
+                if byte_range is None:
+                    return
+                mirror = self._mirrors.acquire()
+                if mirror is None:
+                    self._scheduler.release(byte_range)
+                    return
+                start, started = byte_range.pos, time.monotonic()
+                try:
+                    await self._sliced_chunked_download(resources, byte_range, sem, mirror)
+                except Exception as e:
+                    if (mirror.primary and isinstance(e, ResourceChangedException)) or not self._mirrors.drop(mirror, e):
+                        raise
+                finally:
+                    self._mirrors.release(mirror, byte_range.pos - start, time.monotonic() - started)
+                    self._scheduler.release(byte_range)
+
+    async def _sliced_chunked_download(self, resources: 'Resources', byte_range: 'ByteRange',
+                                       sem: 'DynamicSemaphore', mirror: 'Mirror'):
+        logger.info(f'start sliced download: {mirror.uri} to {resources.save_path} {byte_range.pos}-{byte_range.end}')
+        headers = {'Range': f'bytes={byte_range.pos}-{byte_range.end}'}
+        if_range = self._if_range(mirror.validators)
+        if if_range:
+            headers['If-Range'] = if_range
+        recorded = byte_range.pos
+        try:
+            async with self._stream(resources, url=None if mirror.primary else mirror.uri,
+                                    headers=headers) as response:
                 response: httpx.Response
                 if not response.is_success: sem.record_result(success=False)
                 response.raise_for_status()
-                async with aiofiles.open(save_path, 'ab') as f:
-                    self.current_size += save_path.stat().st_size
-                    async for chunk in response.aiter_bytes(chunk_size=DEFAULT_CHUNK_SIZE):
-                        await f.write(chunk)
-                        self.current_size += len(chunk)
-                sem.record_result(response.elapsed.total_seconds(), True)
-                await sem.adaptive_update()
-            logger.info(f'sliced download success: {resources.uri} to {save_path}')
-            return True
+                if response.status_code != 206:
+                    if if_range:
+                        raise ResourceChangedException(mirror.uri)
+                    raise ChunkUnsupportedException(mirror.uri)
+                async for chunk in response.aiter_bytes(chunk_size=self._chunk_size):
+                    # The tail of the range may have been handed to another worker meanwhile
+                    chunk = chunk[:byte_range.remaining]
+                    await self._writer.write(self._fd, byte_range.pos, chunk)
+                    if self._checksum is not None:
+                        self._feed_checksum(byte_range.pos, chunk)
+                    byte_range.pos += len(chunk)
+                    self.current_size += len(chunk)
+                    if byte_range.pos - recorded >= DEFAULT_JOURNAL_INTERVAL:
+                        # Recorded once the writer has put the bytes into the file
+                        self._writer.call_after(self._journal.add, recorded, byte_range.pos - 1)
+                        recorded = byte_range.pos
+                    await self._throttle.aconsume(len(chunk), response.url.host)
+                    if not byte_range.remaining:
+                        break
+        finally:
+            self._writer.call_after(self._journal.add, recorded, byte_range.pos - 1)
+        if byte_range.remaining:
+            raise IOError(f'range ended early at {byte_range.pos}, expected {byte_range.end}: {mirror.uri}')
+        sem.record_result(response.elapsed.total_seconds(), True)
+        await sem.adaptive_update()
+        logger.info(f'sliced download success: {mirror.uri} {byte_range.start}-{byte_range.end}')
 
-    @staticmethod
-    def _merge_chunk(save_path: Path, result: list[Path]):
-        with save_path.open('wb') as f:
-            for chunk_path in result:
-                with chunk_path.open('rb') as f_chunk:
-                    while True:
-                        chunk = f_chunk.read(DEFAULT_CHUNK_SIZE)
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                logger.info(f'merge chunk success: {save_path} to {chunk_path}')
-        for chunk_path in result:
-            chunk_path.unlink()
-            logger.info(f'delete chunk success: {chunk_path}')
-        logger.info(f'merge file success: {save_path}')
-
-    def _breakpoint_resumption(self, response):
+    def _feed_checksum(self, offset: int, chunk: bytes):
+        """
+        Hash a chunk written at the front of the file, otherwise wake up the in-order hasher
+        """
+        if not self._hashing and self._checksum.position == offset:
+            self._checksum.update(chunk)
+        else:
+            self._hash_event.set()
+
+    def _if_range(self, validators: dict[str, str | None] = None) -> str | None:
+        """
+        Validator for If-Range, weak ETags are not allowed there
+
+        :param validators: Validators of the source, those of the resource by default
+        """
+        validators = self._validators if validators is None else validators
+        etag = validators.get('etag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return validators.get('last_modified')
+
+    async def _breakpoint_resumption(self, response: httpx.Response) -> bool:
         if response.headers.get('Accept-Ranges') == 'bytes':
             return True
         else:
@@ -242,11 +412,11 @@ class HttpProtocolHandler(BaseProtocolHandler):
                 content = response.request.content
             except httpx.RequestNotRead:
                 content = None
-            with self.client.stream(self._method, response.request.url, content=content,
+            async with self._stream(None, url=response.request.url, content=content,
                                     headers={'Range': 'bytes=0-1'}) as test_response:
                 test_response.raise_for_status()
                 return (test_response.headers.get('Content-Range', '').startswith('bytes 0-1/') or
                         test_response.headers.get('Content-Length') == '2')
 
     def close(self):
-        self.client.close()
+        self.aclient = None
@@ -1,33 +1,141 @@
 import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from contextlib import AsyncExitStack
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Awaitable, Callable
 from urllib.parse import urlparse, urljoin
 from shutil import rmtree
 
-import aiofiles
 import m3u8
-from httpx import AsyncClient, Response, AsyncHTTPTransport
+from httpx import AsyncClient, Response
 
 from yundownload.network.base import BaseProtocolHandler
+from yundownload.network.pool import client_pool
+from yundownload.utils.assembly import OrderedAssembler
 from yundownload.utils.core import Result
+from yundownload.utils.exceptions import ConnectionException
+from yundownload.utils.journal import DownloadJournal
 from yundownload.utils.logger import logger
+from yundownload.utils.progress import Phase
+from yundownload.utils.throttle import Throttle
+from yundownload.utils.writer import WriteBehind
 
 if TYPE_CHECKING:
     from yundownload.core.resources import Resources
     from yundownload.utils.equilibrium import DynamicSemaphore
 
-from yundownload.utils import DEFAULT_CHUNK_SIZE
+from yundownload.utils import DEFAULT_CHUNK_SIZE, DEFAULT_M3U8_REORDER_WINDOW
+from yundownload.utils.tools import convert_state_path, copy_file
 from Crypto.Cipher import AES
 
 
+class SegmentDecryptor:
+    """
+    Incremental AES-128-CBC decryption of one segment
+
+    Data is decrypted in whole blocks as it arrives, the last block is held back until the segment
+    ends so that its PKCS7 padding can be removed.
+    """
+
+    def __init__(self, key: bytes, iv: bytes):
+        """
+        Segment decryptor
+
+        :param key: 16-byte key
+        :param iv: 16-byte initialization vector
+        """
+        self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        self._pending = b''
+
+    def update(self, data: bytes) -> bytes:
+        """
+        :param data: Next encrypted data
+        :return: Decrypted data available so far
+        """
+        data = self._pending + data
+        # Keep at least one block back for the padding
+        size = max(0, (len(data) - 1) // AES.block_size * AES.block_size)
+        self._pending = data[size:]
+        return self._cipher.decrypt(data[:size]) if size else b''
+
+    def finalize(self) -> bytes:
+        """
+        :return: Decrypted last block without padding
+        """
+        if len(self._pending) != AES.block_size:
+            raise ValueError(f'encrypted segment is not a multiple of {AES.block_size} bytes')
+        block = self._cipher.decrypt(self._pending)
+        self._pending = b''
+        padding = block[-1]
+        if not 1 <= padding <= AES.block_size or block[-padding:] != bytes([padding]) * padding:
+            raise ValueError('invalid PKCS7 padding, the key or the IV is wrong')
+        return block[:-padding]
+
+
+# Share of the measured throughput a variant may use, leaves room for fluctuations of the link
+_THROUGHPUT_HEADROOM = 0.8
+# Number of keys and initialization sections kept for the segments that follow
+_CACHE_SIZE = 32
+
+
+class _SegmentFiles:
+    """
+    Sink of the segment-file mode, every clip is written to a file of its own
+    """
+
+    def __init__(self, writer: WriteBehind, paths: list[Path], journal: DownloadJournal):
+        self.writer = writer
+        self.paths = paths
+        self.journal = journal
+        self._files: dict[int, list[int]] = {}
+
+    async def append(self, index: int, data: bytes):
+        file = self._files.get(index)
+        if file is None:
+            file = self._files[index] = [self.writer.open(self.paths[index], truncate=True), 0]
+        await self.writer.write(file[0], file[1], data)
+        file[1] += len(data)
+
+    async def complete(self, index: int):
+        file = self._files.pop(index, None)
+        if file is None:
+            self.paths[index].write_bytes(b'')
+        else:
+            await self.writer.close_file(file[0])
+        self.journal.add(index, index)
+
+    async def aclose(self):
+        """
+        Close the files of clips that failed
+        """
+        while self._files:
+            _, (fd, _) = self._files.popitem()
+            await self.writer.close_file(fd)
+
+
 class M3U8ProtocolHandler(BaseProtocolHandler):
+    def __init__(self):
+        super().__init__()
+        self._request_options = {}
+        self._keys: OrderedDict[str, asyncio.Future] = OrderedDict()
+        self._maps: OrderedDict[tuple, asyncio.Future] = OrderedDict()
+        self._media_uri: str | None = None
+        self._journal: DownloadJournal | None = None
+        self._writer: WriteBehind | None = None
+
     @staticmethod
     def check_protocol(uri: str) -> bool:
         parse = urlparse(uri)
         return parse.scheme in {'http', 'https'} and parse.path.endswith('.m3u8')
 
     def download(self, resources: 'Resources') -> 'Result':
-        return asyncio.run(self.download_segments(resources))
+        return client_pool.run(self.download_segments(resources))
+
+    async def adownload(self, resources: 'Resources') -> 'Result':
+        return await self.download_segments(resources)
 
     async def download_segments(self, resources: 'Resources') -> 'Result':
         """
@@ -37,165 +145,626 @@ class M3U8ProtocolHandler(BaseProtocolHandler):
         :return: Result
         """
         resources.update_semaphore()
-        if resources.save_path.exists():
+        self._throttle = Throttle(resources)
+        journal_path = convert_state_path(resources.save_path)
+        if resources.save_path.exists() and not journal_path.exists():
             return Result.EXIST
-        async with AsyncClient(
-                auth=resources.http_auth,
-                timeout=resources.http_timeout,
-                params=resources.http_params,
-                headers=resources.http_headers,
-                cookies=resources.http_cookies,
-                mounts={
-                    'http://': AsyncHTTPTransport(
-                        proxy=resources.http_proxy.get('http'),
-                    ),
-                    'https://': AsyncHTTPTransport(
-                        proxy=resources.http_proxy.get('https'),
-                    )
-                },
-                verify=resources.http_verify
-        ) as client:
+        async with AsyncExitStack() as stack:
+            http2 = client_pool.http2_enabled(resources)
+            client = await stack.enter_async_context(client_pool.client(resources))
+            self._request_options = client_pool.request_options(resources)
             final_playlist = await self.handle_variant_playlist(client, resources)
             segments = self.parse_segments(final_playlist)
-            tasks = []
+            if segments and http2 and not client_pool.http2_enabled(resources, segments[0]['uri']):
+                # The few connections of an HTTP/2 client would starve the segments over HTTP/1.1
+                client = await stack.enter_async_context(client_pool.client(resources, segments[0]['uri']))
+            if resources.m3u8_live:
+                return await self.record_live(final_playlist, journal_path, client, resources)
+            stream = resources.m3u8_stream
+            if any(seg['encryption'] and seg['encryption']['method'] != 'AES-128' for seg in segments):
+                logger.info("This is a encrypted m3u8, please decrypt it by yourself")
+            self._total = len(segments)
+            self.phase = Phase.DOWNLOADING
+            self._journal = DownloadJournal(journal_path)
+            playlist_id = hashlib.sha1('\n'.join(seg['uri'] for seg in segments).encode()).hexdigest()
+            if stream:
+                completed = self._journal.open(len(segments), playlist=playlist_id, assembly='stream')
+            else:
+                completed = self._journal.open(len(segments), playlist=playlist_id)
+            self._writer = WriteBehind()
+            if stream:
+                try:
+                    return await self.assemble_segments(segments, completed, client, resources)
+                finally:
+                    try:
+                        await self._writer.aclose()
+                    finally:
+                        self._journal.close()
+
             video_path = resources.save_path.parent / f"{resources.save_path.stem}"
             video_path.mkdir(parents=True, exist_ok=True)
-            self._total = len(segments)
-            segment_paths = []
-            for index, seg in enumerate(segments):
-                segment_path = video_path / f"{index}.ts"
-                tasks.append(
-                    asyncio.create_task(
-                        self.download_segment(index, seg, segment_path, client, resources.semaphore)
-                    )
-                )
-                segment_paths.append(segment_path)
+            completed_indexes = {index for start, end in completed for index in range(start, end + 1)}
+            segment_paths = [video_path / f"{index}.ts" for index in range(len(segments))]
+            pending = []
+            for index, segment_path in enumerate(segment_paths):
+                if index in completed_indexes and segment_path.exists():
+                    self._steps += 1
+                else:
+                    pending.append(index)
+            files = _SegmentFiles(self._writer, segment_paths, self._journal)
+            tasks = [
+                asyncio.create_task(self.download_group(group, segments, client, resources.semaphore, files))
+                for group in self.group_segments(pending, segments)
+            ]
 
-            results = await asyncio.gather(*tasks)
+            try:
+                results = await asyncio.gather(*tasks)
+            finally:
+                try:
+                    await files.aclose()
+                    await self._writer.aclose()
+                finally:
+                    self._journal.close()
 
             if all([r & (Result.SUCCESS | Result.EXIST) for r in results]):
-                if not segments[0]['encryption']:
-                    await self.merge_segments(segment_paths, resources.save_path)
-                elif segments[0]['encryption'] and segments[0]['encryption']['method'] == 'AES-128':
-                    key_resp = await client.get(segments[0]['encryption']['key_uri'])
-                    key_content = key_resp.content
-                    await self.merge_segments(segment_paths, resources.save_path, key_content, segments)
-
-                else:
-                    logger.info("This is a encrypted m3u8, please decrypt it by yourself")
+                self.phase = Phase.FINISHING
+                await self.merge_segments(segment_paths, resources.save_path)
+                self._journal.remove()
                 return Result.SUCCESS
             return Result.FAILURE
 
-    async def download_segment(self, index: int, seg: dict, save_path: Path, client: 'AsyncClient',
-                               sem: 'DynamicSemaphore') -> 'Result':
+    async def download_group(self, indexes: list[int], segments: list, client: 'AsyncClient',
+                             sem: 'DynamicSemaphore', sink: '_SegmentFiles | OrderedAssembler') -> 'Result':
         """
-        Download the clip
-        There is no encryption here, you can decrypt it by rewriting the method
-        and getting the value via seg['encryption'].
+        Download clips with one request, either a single clip or adjacent byte ranges of one resource
 
-        :param index: Slice index
-        :param seg: Fragment information
-        :param save_path: The path to save the clip
+        AES-128 clips are decrypted and the initialization section is put in front of the clips that
+        start a new EXT-X-MAP while downloading, the data of each clip goes to the sink.
+
+        :param indexes: Slice indexes, see group_segments
+        :param segments: Parsed segments
         :param client: Network connection pooling
         :param sem: Asynchronous semaphore
-        :return:
+        :param sink: Receives the data of each clip and is told when a clip is complete
+        :return: Result
         """
+        group = [segments[index] for index in indexes]
+        first, last = group[0], group[-1]
+        if isinstance(sink, OrderedAssembler):
+            await sink.reserve(indexes[-1])
+        decryptors = [await self.segment_decryptor(client, seg) for seg in group]
+        maps = [await self.segment_map(client, seg) if seg['map_start'] else None for seg in group]
+        lengths = [seg['byterange'][1] if seg['byterange'] else None for seg in group]
+        skip = 0
+        options = self._request_options
+        if first['byterange']:
+            options = self._range_options(first['byterange'][0], last['byterange'][0] + last['byterange'][1] - 1)
+        position = 0
+
+        async def begin():
+            if maps[position]:
+                await sink.append(indexes[position], maps[position])
+
+        async def finish():
+            if decryptors[position] is not None:
+                await sink.append(indexes[position], decryptors[position].finalize())
+            await sink.complete(indexes[position])
+            self._steps += 1
+
         async with sem:
-            logger.info(f"Downloading fragments #{index} encryption {bool(seg['encryption'])} from {seg['uri']}")
-            async with client.stream('GET', seg['uri']) as response:
+            logger.info(f"Downloading fragments #{indexes[0]}-#{indexes[-1]} "
+                        f"encryption {bool(first['encryption'])} from {first['uri']}")
+            started = time.monotonic()
+            async with client.stream('GET', first['uri'], **options) as response:
                 response: Response
                 if not response.is_success: sem.record_result(success=False)
                 response.raise_for_status()
-                if save_path.exists() and response.headers.get('Content-Length') == str(save_path.stat().st_size):
-                    sem.record_result(success=True)
-                    await sem.adaptive_update()
-                    return Result.EXIST
-                async with aiofiles.open(save_path, "wb") as f:
-                    async for chunk in response.aiter_bytes(chunk_size=DEFAULT_CHUNK_SIZE):
-                        await f.write(chunk)
-                        self.current_size += len(chunk)
-                sem.record_result(response.elapsed.total_seconds(), True)
+                if first['byterange'] and response.status_code != 206:
+                    # The server ignored the range and sends the whole resource
+                    skip = first['byterange'][0]
+                remaining = lengths[0]
+                await begin()
+                async for chunk in response.aiter_bytes(chunk_size=self._throttle.chunk_size(DEFAULT_CHUNK_SIZE)):
+                    self.current_size += len(chunk)
+                    await self._throttle.aconsume(len(chunk), response.url.host)
+                    if skip:
+                        chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+                    while chunk and position < len(group):
+                        part = chunk if remaining is None else chunk[:remaining]
+                        chunk = chunk[len(part):]
+                        data = decryptors[position].update(part) if decryptors[position] else part
+                        if data:
+                            await sink.append(indexes[position], data)
+                        if remaining is not None:
+                            remaining -= len(part)
+                            if not remaining:
+                                await finish()
+                                position += 1
+                                if position < len(group):
+                                    remaining = lengths[position]
+                                    await begin()
+                    if position == len(group):
+                        break
+                while position < len(group) and not remaining:
+                    await finish()
+                    position += 1
+                    if position < len(group):
+                        remaining = lengths[position]
+                        await begin()
+                if position < len(group):
+                    sem.record_result(success=False)
+                    raise ConnectionException(first['uri'])
+                sem.record_result(time.monotonic() - started, True)
                 await sem.adaptive_update()
-            logger.info(f"Download fragments #{index} success from {seg['uri']}")
-            self._steps += 1
-            return Result.SUCCESS
+        logger.info(f"Download fragments #{indexes[0]}-#{indexes[-1]} success from {first['uri']}")
+        return Result.SUCCESS
 
     @staticmethod
-    async def merge_segments(segment_paths: list[Path], save_path: Path, key_content: bytes = None, segments: list = None) -> None:
-        async with aiofiles.open(save_path, "wb") as f:
-            if key_content and segments:
-                for index, segment_path in enumerate(segment_paths):
-                    cipher = AES.new(key_content, AES.MODE_CBC, bytes.fromhex(segments[index]['encryption']['iv'][2:]))
-                    async with aiofiles.open(segment_path, "rb") as segment_file:
-                        while True:
-                            chunk = await segment_file.read(16384)
-                            if not chunk:
-                                break
-                            await f.write(cipher.decrypt(chunk))
-                    logger.info(f"Merge fragments #{segment_path} to {save_path}")
+    def group_segments(indexes: list[int], segments: list, limit: int = DEFAULT_M3U8_REORDER_WINDOW) -> list[list[int]]:
+        """
+        Group adjacent EXT-X-BYTERANGE clips of the same resource so each group is fetched with one
+        Range request, every other clip is a group of its own
 
-            else:
-                for segment_path in segment_paths:
-                    async with aiofiles.open(segment_path, "rb") as segment_file:
-                        chunk_size = DEFAULT_CHUNK_SIZE
-                        while True:
-                            chunk = await segment_file.read(chunk_size)
-                            if not chunk:
-                                break
-                            await f.write(chunk)
-                    logger.info(f"Merge fragments #{segment_path} to {save_path}")
+        :param indexes: Slice indexes to download in ascending order
+        :param segments: Parsed segments
+        :param limit: Maximum number of clips in a group
+        :return: Groups of slice indexes
+        """
+        groups: list[list[int]] = []
+        for index in indexes:
+            seg = segments[index]
+            if groups and seg['byterange'] and len(groups[-1]) < limit:
+                previous = segments[groups[-1][-1]]
+                if (groups[-1][-1] == index - 1 and previous['byterange'] and previous['uri'] == seg['uri']
+                        and sum(previous['byterange']) == seg['byterange'][0]):
+                    groups[-1].append(index)
+                    continue
+            groups.append([index])
+        return groups
+
+    async def assemble_segments(self, segments: list, completed: list[tuple[int, int]], client: 'AsyncClient',
+                                resources: 'Resources') -> 'Result':
+        """
+        Download the segments and append them to the output in playlist order
+
+        No segment files are written, the output grows while downloading and can be played from the
+        start. The journal records the appended prefix with the size of the output after it, a resume
+        truncates the output to that size and continues with the next segment.
 
+        :param segments: Parsed segments
+        :param completed: Completed segment ranges loaded from the journal
+        :param client: Network connection pooling
+        :param resources: Resource objects
+        :return: Result
+        """
+        head = position = 0
+        if completed and completed[0][0] == 0 and resources.save_path.exists():
+            size = self._journal.positions.get(completed[0][1])
+            if size is not None and resources.save_path.stat().st_size >= size:
+                head, position = completed[0][1] + 1, size
+        if head:
+            logger.info(f'Resume m3u8 at fragment #{head} ({position} bytes): {resources.save_path}')
+        self._steps += head
+        self.current_size += position
+        fd = self._writer.open(resources.save_path)
+        assembler = OrderedAssembler(
+            self._writer, fd, head, position,
+            on_complete=lambda index, size: self._journal.add(index, index, size)
+        )
+        tasks: set[asyncio.Task] = set()
+        failed: list[asyncio.Task] = []
+
+        def finished(task: asyncio.Task):
+            tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                failed.append(task)
+
+        try:
+            os.ftruncate(fd, position)
+            try:
+                for group in self.group_segments(list(range(head, len(segments))), segments, assembler.window):
+                    # A group starts once it is inside the window, about window tasks exist at once
+                    await self._admit(assembler, group[-1], tasks, failed)
+                    task = asyncio.create_task(
+                        self.download_group(group, segments, client, resources.semaphore, assembler)
+                    )
+                    task.add_done_callback(finished)
+                    tasks.add(task)
+                await asyncio.gather(*tasks)
+                if failed:
+                    failed[0].result()
+            except BaseException:
+                # Segments waiting for the window would wait for the failed one forever
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        finally:
+            await self._writer.close_file(fd)
+        self.phase = Phase.FINISHING
+        self._journal.remove()
+        logger.info(f"Assemble fragments success to {resources.save_path}")
+        return Result.SUCCESS
+
+    @staticmethod
+    async def _admit(assembler: OrderedAssembler, index: int, tasks: set[asyncio.Task], failed: list[asyncio.Task]):
+        """
+        Wait until a part is inside the window of the assembler, or raise the error of a failed group
+        """
+        reserve = asyncio.ensure_future(assembler.reserve(index))
+        try:
+            while True:
+                if failed:
+                    failed[0].result()
+                if reserve.done():
+                    return reserve.result()
+                await asyncio.wait({reserve, *tasks}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            reserve.cancel()
+
+    async def record_live(self, playlist: 'm3u8.M3U8', journal_path: Path, client: 'AsyncClient',
+                          resources: 'Resources') -> 'Result':
+        """
+        Record a live playlist into the output
+
+        The media playlist is reloaded every target duration, or half of it when nothing new
+        appeared, and the segments with media sequence numbers not seen yet are appended in order.
+        Recording stops at EXT-X-ENDLIST or after ``m3u8_live_duration`` seconds. Segments that left
+        the playlist before they were fetched are skipped. The journal records the last appended
+        sequence number, a resume continues after it.
+
+        :param playlist: Media playlist
+        :param journal_path: Journal path
+        :param client: Network connection pooling
+        :param resources: Resource objects
+        :return: Result
+        """
+        deadline = None if resources.m3u8_live_duration is None else time.monotonic() + resources.m3u8_live_duration
+        self.phase = Phase.DOWNLOADING
+        self._journal = DownloadJournal(journal_path)
+        completed = self._journal.open(0, playlist=self._media_uri, assembly='live')
+        head = position = None
+        if completed and resources.save_path.exists():
+            size = self._journal.positions.get(completed[-1][1])
+            if size is not None and resources.save_path.stat().st_size >= size:
+                head, position = completed[-1][1] + 1, size
+                logger.info(f'Resume live m3u8 after sequence #{head - 1} ({position} bytes): {resources.save_path}')
+        self._writer = WriteBehind()
+        fd = self._writer.open(resources.save_path)
+        tasks: set[asyncio.Task] = set()
+        failed: list[asyncio.Task] = []
+
+        def finished(task: asyncio.Task):
+            tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                failed.append(task)
+
+        assembler = None
+        last_map = None
+        try:
+            os.ftruncate(fd, position or 0)
+            while True:
+                segments = self.parse_segments(playlist)
+                if segments and assembler is None:
+                    if head is None or head < segments[0]['sequence']:
+                        head = segments[0]['sequence']
+                    assembler = OrderedAssembler(
+                        self._writer, fd, head, position or 0,
+                        on_complete=lambda index, size: self._journal.add(index, index, size)
+                    )
+                fresh = [seg for seg in segments if head is not None and seg['sequence'] >= head]
+                if fresh and fresh[0]['sequence'] > head:
+                    logger.warning(f'Live m3u8 skipped sequence #{head} to #{fresh[0]["sequence"] - 1}, '
+                                   f'they left the playlist before they were fetched: {self._media_uri}')
+                    for sequence in range(head, fresh[0]['sequence']):
+                        await assembler.complete(sequence)
+                by_sequence = {}
+                for seg in fresh:
+                    # Every reload starts a new playlist, the initialization section is only repeated when it changes
+                    seg['map_start'] = seg['map'] is not None and seg['map'] != last_map
+                    last_map = seg['map'] or last_map
+                    by_sequence[seg['sequence']] = seg
+                    self._total += 1
+                for group in self.group_segments(list(by_sequence), by_sequence, assembler.window if assembler else 1):
+                    task = asyncio.create_task(
+                        self.download_group(group, by_sequence, client, resources.semaphore, assembler)
+                    )
+                    task.add_done_callback(finished)
+                    tasks.add(task)
+                if fresh:
+                    head = fresh[-1]['sequence'] + 1
+                if failed:
+                    failed[0].result()
+                if playlist.is_endlist:
+                    logger.info(f'Live m3u8 ended: {self._media_uri}')
+                    break
+                delay = playlist.target_duration or 1
+                if not fresh:
+                    delay /= 2
+                if deadline is not None:
+                    delay = min(delay, deadline - time.monotonic())
+                    if delay <= 0:
+                        logger.info(f'Live m3u8 recording reached {resources.m3u8_live_duration}s: {self._media_uri}')
+                        break
+                await asyncio.sleep(delay)
+                playlist = await self.m3u8_load(client, self._media_uri, self._request_options)
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            try:
+                await self._writer.close_file(fd)
+                await self._writer.aclose()
+            finally:
+                self._journal.close()
+        self.phase = Phase.FINISHING
+        self._journal.remove()
+        logger.info(f"Live m3u8 recording success to {resources.save_path}")
+        return Result.SUCCESS
+
+    async def segment_decryptor(self, client: 'AsyncClient', seg: dict) -> SegmentDecryptor | None:
+        """
+        Decryptor of an AES-128 segment, a key is fetched once however many segments in a row use it
+
+        :param client: Network connection pooling
+        :param seg: Fragment information
+        :return: Decryptor, None if the segment is not encrypted with AES-128
+        """
+        encryption = seg['encryption']
+        if not encryption or encryption['method'] != 'AES-128':
+            return None
+        key_uri = encryption['key_uri']
+        key = await self._cached(self._keys, key_uri, lambda: self.fetch_key(client, key_uri))
+        return SegmentDecryptor(key, encryption['iv'])
+
+    @staticmethod
+    async def _cached(cache: OrderedDict, key, fetch: Callable[[], Awaitable[bytes]]) -> bytes:
+        """
+        Fetch a key or an initialization section once and share it with the segments using it
+
+        Only the most recently used entries are kept, a live stream rotating its keys for hours
+        must not keep every key it ever used.
+        """
+        future = cache.get(key)
+        if future is None:
+            future = cache[key] = asyncio.ensure_future(fetch())
+            while len(cache) > _CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            # Let the next segment try again
+            if cache.get(key) is future:
+                del cache[key]
+            raise
+
+    async def fetch_key(self, client: 'AsyncClient', key_uri: str) -> bytes:
+        """
+        Fetch an AES-128 key
+
+        :param client: Network connection pooling
+        :param key_uri: Key uri
+        :return: 16-byte key
+        """
+        response = await client.get(key_uri, **self._request_options)
+        response: Response
+        response.raise_for_status()
+        if len(response.content) != 16:
+            raise ValueError(f'AES-128 key must be 16 bytes, got {len(response.content)}: {key_uri}')
+        logger.info(f"Fetched key from {key_uri}")
+        return response.content
+
+    async def segment_map(self, client: 'AsyncClient', seg: dict) -> bytes:
+        """
+        Initialization section of a clip, fetched once however many segments in a row use it
+
+        :param client: Network connection pooling
+        :param seg: Fragment information
+        :return: Initialization section
+        """
+        init = seg['map']
+        key = (init['uri'], init['byterange'])
+        return await self._cached(self._maps, key, lambda: self.fetch_map(client, init))
+
+    async def fetch_map(self, client: 'AsyncClient', init: dict) -> bytes:
+        """
+        Fetch an EXT-X-MAP initialization section
+
+        :param client: Network connection pooling
+        :param init: Initialization section information
+        :return: Initialization section
+        """
+        options = self._request_options
+        if init['byterange']:
+            offset, length = init['byterange']
+            options = self._range_options(offset, offset + length - 1)
+        response = await client.get(init['uri'], **options)
+        response: Response
+        response.raise_for_status()
+        content = response.content
+        if init['byterange'] and response.status_code != 206:
+            content = content[offset:offset + length]
+        logger.info(f"Fetched initialization section from {init['uri']}")
+        return content
+
+    def _range_options(self, start: int, end: int) -> dict:
+        headers = {**(self._request_options.get('headers') or {}), 'Range': f'bytes={start}-{end}'}
+        return {**self._request_options, 'headers': headers}
+
+    @staticmethod
+    async def merge_segments(segment_paths: list[Path], save_path: Path) -> None:
+        await asyncio.to_thread(M3U8ProtocolHandler._concat_segments, segment_paths, save_path)
         for segment_path in segment_paths:
             segment_path.unlink()
             logger.info(f"Delete fragments #{segment_path}")
         rmtree(segment_paths[0].parent, ignore_errors=True)
         logger.info(f"Merge fragments success to {save_path}")
 
+    @staticmethod
+    def _concat_segments(segment_paths: list[Path], save_path: Path):
+        """
+        Concatenate the segments into the output file, copied by the kernel where possible
+        """
+        buffer = bytearray(DEFAULT_CHUNK_SIZE)
+        with open(save_path, 'wb') as f:
+            for segment_path in segment_paths:
+                with open(segment_path, 'rb') as segment_file:
+                    copy_file(segment_file, f, buffer)
+                logger.info(f"Merge fragments #{segment_path} to {save_path}")
+
     @staticmethod
     def parse_segments(playlist: m3u8.M3U8) -> list:
-        """Parse TS fragment information"""
+        """
+        Parse TS fragment information
+
+        A key without an IV uses the media sequence number of the segment as a big-endian 16-byte IV.
+        Byte ranges are resolved to (offset, length), a range without an offset continues the previous
+        range of the same resource. ``map_start`` marks the clips that start a new EXT-X-MAP, the
+        initialization section is put in front of them.
+        """
         segments = []
-        for seg in playlist.segments:
+        ends: dict[str, int] = {}
+        previous_map = None
+        for index, seg in enumerate(playlist.segments):
+            sequence = seg.media_sequence if seg.media_sequence is not None else (playlist.media_sequence or 0) + index
+            uri = urljoin(playlist.base_uri, seg.uri)
+            byterange = M3U8ProtocolHandler._parse_byterange(seg.byterange, ends.get(uri, 0))
+            if byterange:
+                ends[uri] = sum(byterange)
+            init = None
+            if seg.init_section is not None and seg.init_section.uri:
+                init = {
+                    'uri': urljoin(playlist.base_uri, seg.init_section.uri),
+                    'byterange': M3U8ProtocolHandler._parse_byterange(seg.init_section.byterange, 0)
+                }
             segment_info = {
                 'duration': seg.duration,
-                'uri': urljoin(playlist.base_uri, seg.uri),
+                'uri': uri,
+                'sequence': sequence,
+                'byterange': byterange,
+                'map': init,
+                'map_start': init is not None and init != previous_map,
                 'encryption': None
             }
+            previous_map = init or previous_map
 
-            if seg.key:
+            if seg.key and seg.key.method and seg.key.method != 'NONE':
+                if seg.key.iv:
+                    iv = bytes.fromhex(seg.key.iv[2:] if seg.key.iv[:2].lower() == '0x' else seg.key.iv).rjust(16, b'\0')
+                else:
+                    iv = sequence.to_bytes(16, 'big')
                 segment_info['encryption'] = {
                     'method': seg.key.method,
                     'key_uri': urljoin(playlist.base_uri, seg.key.uri) if seg.key.uri else None,
-                    'iv': seg.key.iv if seg.key.iv else None
+                    'iv': iv
                 }
 
             segments.append(segment_info)
         return segments
 
+    @staticmethod
+    def _parse_byterange(byterange: str | None, offset: int) -> tuple[int, int] | None:
+        if not byterange:
+            return None
+        length, _, start = byterange.partition('@')
+        return (int(start) if start else offset), int(length)
+
     async def handle_variant_playlist(self, client: 'AsyncClient', resources: 'Resources') -> 'm3u8.M3U8':
-        """Process the main playlist and select the sub-list with the highest bitrate"""
-        playlist = await self.m3u8_load(client, resources.uri)
+        """
+        Process the main playlist and select a sub-list
+
+        The variants are filtered by ``m3u8_max_height`` and ``m3u8_codecs`` first, then ``m3u8_variant``
+        picks the highest bitrate (``max``), the lowest (``min``) or the highest one the measured
+        throughput sustains (``throughput``).
+        """
+        playlist = await self.m3u8_load(client, resources.uri, self._request_options)
+        self._media_uri = resources.uri
         if not playlist.is_variant:
             return playlist
 
         logger.info(f'm3u8 contains {len(playlist.playlists)} bitrate: {resources.uri} to {resources.save_path}')
 
-        # Select the sub-playlist with the highest bandwidth
-        best_playlist = max(
-            playlist.playlists,
-            key=lambda p: p.stream_info.bandwidth
-        )
+        candidates = self.filter_variants(playlist.playlists, resources.m3u8_max_height, resources.m3u8_codecs)
+        if not candidates:
+            logger.warning(f'No variant matches the resolution and codecs, choosing from all: {resources.uri}')
+            candidates = list(playlist.playlists)
+        if resources.m3u8_variant == 'min':
+            best_playlist = min(candidates, key=lambda p: p.stream_info.bandwidth)
+        elif resources.m3u8_variant == 'throughput':
+            lowest = min(candidates, key=lambda p: p.stream_info.bandwidth)
+            throughput = await self.measure_throughput(client, urljoin(playlist.base_uri, lowest.uri))
+            if resources.rate_limit:
+                throughput = min(throughput, resources.rate_limit * 8)
+            sustained = [p for p in candidates if p.stream_info.bandwidth <= throughput * _THROUGHPUT_HEADROOM]
+            best_playlist = max(sustained, key=lambda p: p.stream_info.bandwidth) if sustained else lowest
+            logger.info(f'Measured throughput {throughput / 1e6:.1f}Mbps: {resources.uri}')
+        else:
+            # Select the sub-playlist with the highest bandwidth
+            best_playlist = max(candidates, key=lambda p: p.stream_info.bandwidth)
 
         logger.info(
             f'Selected sub-bitrate: {best_playlist.uri}, bindwidth: {best_playlist.stream_info.bandwidth}bps resolution: {best_playlist.stream_info.resolution} codecs: {best_playlist.stream_info.codecs}')
 
         # Load the child playlist
         sub_url = urljoin(playlist.base_uri, best_playlist.uri)
-        return await self.m3u8_load(client, sub_url)
+        self._media_uri = sub_url
+        return await self.m3u8_load(client, sub_url, self._request_options)
+
+    @staticmethod
+    def filter_variants(playlists: list, max_height: int = None, codecs: str = None) -> list:
+        """
+        Variants within a resolution that use the given codecs
+
+        :param playlists: Variant playlists
+        :param max_height: Maximum vertical resolution, variants without a resolution are kept
+        :param codecs: Comma-separated codec prefixes that must all be used, e.g. ``avc1`` or ``hvc1,mp4a``,
+            variants without codecs are kept
+        :return: Matching variants
+        """
+        matching = []
+        for variant in playlists:
+            info = variant.stream_info
+            if max_height and info.resolution and info.resolution[1] > max_height:
+                continue
+            if codecs and info.codecs:
+                used = [codec.strip() for codec in info.codecs.split(',')]
+                if not all(any(codec.startswith(prefix.strip()) for codec in used) for prefix in codecs.split(',')):
+                    continue
+            matching.append(variant)
+        return matching
+
+    async def measure_throughput(self, client: 'AsyncClient', uri: str) -> float:
+        """
+        Throughput of one connection, measured by downloading the first clip of a variant
+
+        :param client: Network connection pooling
+        :param uri: Uri of the variant playlist
+        :return: Throughput in bits per second
+        """
+        segments = self.parse_segments(await self.m3u8_load(client, uri, self._request_options))
+        if not segments:
+            return 0.0
+        seg = segments[0]
+        options = self._request_options
+        if seg['byterange']:
+            options = self._range_options(seg['byterange'][0], sum(seg['byterange']) - 1)
+        started = time.monotonic()
+        size = 0
+        async with client.stream('GET', seg['uri'], **options) as response:
+            response: Response
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(chunk_size=DEFAULT_CHUNK_SIZE):
+                size += len(chunk)
+        return size * 8 / max(time.monotonic() - started, 1e-3)
 
     @staticmethod
-    async def m3u8_load(client: 'AsyncClient', uri: str) -> 'm3u8.M3U8':
-        response = await client.get(uri)
+    async def m3u8_load(client: 'AsyncClient', uri: str, options: dict = None) -> 'm3u8.M3U8':
+        response = await client.get(uri, **(options or {}))
         response: Response
         response.raise_for_status()
         return m3u8.M3U8(response.text, base_uri=urljoin(str(response.url), "."))
@@ -0,0 +1,552 @@
+import asyncio
+import atexit
+import importlib.util
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from ftplib import FTP, all_errors
+from http.cookiejar import CookieJar
+from typing import TYPE_CHECKING, AsyncIterator, Coroutine, Any, Callable
+
+import httpx
+
+from yundownload.utils.config import (
+    DEFAULT_HEADERS,
+    DEFAULT_HTTP_MAX_CLIENTS,
+    DEFAULT_HTTP_MAX_CONNECTIONS,
+    DEFAULT_HTTP_KEEPALIVE_EXPIRY,
+    DEFAULT_HTTP2_MAX_CONNECTIONS,
+    DEFAULT_HTTP2_MAX_STREAMS,
+    DEFAULT_FTP_MAX_IDLE_SESSIONS,
+    DEFAULT_FTP_KEEPALIVE_EXPIRY,
+    DEFAULT_FTP_NOOP_INTERVAL
+)
+from yundownload.utils.logger import logger
+from yundownload.utils.tools import Interval
+
+if TYPE_CHECKING:
+    from yundownload.core.resources import Resources
+
+
+H2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+
+def _origin(url: str | httpx.URL) -> tuple:
+    url = httpx.URL(url)
+    return url.scheme, url.host, url.port
+
+
+class _NoCookieJar(CookieJar):
+    """
+    Cookie jar of the shared clients that never stores a cookie, so resources leasing the same client
+    cannot see each other's cookies. The cookies of a resource go with each of its requests.
+    """
+
+    def set_cookie(self, cookie):
+        pass
+
+    def extract_cookies(self, response, request):
+        pass
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """
+    Response body that gives its stream slot back once it is closed
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                self._release()
+                self._release = None
+
+
+class _OriginStreams:
+    """
+    Streams in flight to one origin, per connection of an HTTP/2 client
+    """
+    __slots__ = ('semaphore', 'active', 'users')
+
+    def __init__(self, connections: int, max_streams: int):
+        self.semaphore = asyncio.Semaphore(connections * max_streams)
+        self.active = [0] * connections
+        self.users = 0
+
+
+class _StreamLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    Transport that spreads the requests of an HTTP/2 client over several connections per origin,
+    each carrying at most ``max_streams`` requests at once, and reports the negotiated protocol of each origin
+
+    httpcore multiplexes every request to an origin over the first h2 connection of a pool until the
+    server limit is reached, so each connection is a transport of its own. A request goes to the
+    transport with the fewest requests in flight to its origin, and waits while all of them are full.
+    """
+
+    def __init__(self, transports: list[httpx.AsyncBaseTransport], max_streams: int, on_response):
+        self._transports = transports
+        self._max_streams = max_streams
+        self._origins: dict[tuple, _OriginStreams] = {}
+        self._on_response = on_response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        origin = _origin(request.url)
+        streams = self._origins.get(origin)
+        if streams is None:
+            streams = self._origins[origin] = _OriginStreams(len(self._transports), self._max_streams)
+        streams.users += 1
+        try:
+            await streams.semaphore.acquire()
+        except BaseException:
+            self._leave(origin, streams)
+            raise
+        # Fewer than connections * max_streams requests are in flight, the least loaded one has room
+        index = min(range(len(streams.active)), key=streams.active.__getitem__)
+        streams.active[index] += 1
+
+        def release():
+            streams.active[index] -= 1
+            streams.semaphore.release()
+            self._leave(origin, streams)
+
+        try:
+            response = await self._transports[index].handle_async_request(request)
+        except BaseException:
+            release()
+            raise
+        self._on_response(request, response)
+        response.stream = _ReleasingStream(response.stream, release)
+        return response
+
+    def _leave(self, origin: tuple, streams: _OriginStreams):
+        streams.users -= 1
+        if not streams.users and self._origins.get(origin) is streams:
+            del self._origins[origin]
+
+    async def aclose(self):
+        for transport in self._transports:
+            await transport.aclose()
+
+
+class HttpClientPool:
+    """
+    Per-process registry of long-lived HTTP clients
+
+    Clients are keyed by proxy, verify, auth and HTTP/2 settings so that downloads to the same host reuse
+    keep-alive connections. All clients are bound to one event loop owned by the pool, which lives
+    as long as the process. Idle clients beyond ``max_clients`` are closed in least recently used order.
+    Clients keep no cookies, the cookies of a resource are sent with each of its requests.
+
+    HTTP/2 clients open up to ``http2_max_connections`` connections per origin and multiplex up to
+    ``http2_max_streams`` requests over each of them.
+    Origins that do not negotiate h2 are remembered and served by HTTP/1.1 clients afterwards.
+    """
+
+    def __init__(self,
+                 max_clients: int = DEFAULT_HTTP_MAX_CLIENTS,
+                 max_connections: int = DEFAULT_HTTP_MAX_CONNECTIONS,
+                 keepalive_expiry: float = DEFAULT_HTTP_KEEPALIVE_EXPIRY,
+                 http2_max_connections: int = DEFAULT_HTTP2_MAX_CONNECTIONS,
+                 http2_max_streams: int = DEFAULT_HTTP2_MAX_STREAMS):
+        """
+        HTTP client pool
+
+        :param max_clients: Maximum number of idle clients kept open
+        :param max_connections: Maximum number of connections of each client
+        :param keepalive_expiry: Time in seconds an idle keep-alive connection is kept
+        :param http2_max_connections: Number of connections per origin of each HTTP/2 client
+        :param http2_max_streams: Maximum number of concurrent streams on each HTTP/2 connection
+        """
+        self.max_clients = max_clients
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.http2_max_connections = max(1, http2_max_connections)
+        self.http2_max_streams = http2_max_streams
+        self._http1_origins: set[tuple] = set()
+        self._http2_origins: set[tuple] = set()
+        self._h2_warned = False
+        self._clients: OrderedDict[tuple, httpx.AsyncClient] = OrderedDict()
+        self._leases: dict[tuple, int] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._pid = os.getpid()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """
+        The event loop all pooled clients are bound to
+        """
+        self._check_fork()
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
+    def run(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        """
+        Run a coroutine on the pool event loop
+
+        :param coro: Coroutine to run
+        :return: The result of the coroutine
+        """
+        return self.loop.run_until_complete(coro)
+
+    @asynccontextmanager
+    async def client(self, resources: 'Resources', uri: str = None) -> AsyncIterator[httpx.AsyncClient]:
+        """
+        Lease the shared client matching the resource settings
+
+        :param resources: Resource object
+        :param uri: Uri the client is mostly used for, the resource uri by default
+        :return: HTTP client
+        """
+        key = self._client_key(resources, uri)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            client = self._create_client(resources, key[-1])
+            self._clients[key] = client
+            logger.info(f'create http client: {len(self._clients)} clients in pool')
+        self._clients.move_to_end(key)
+        self._leases[key] = self._leases.get(key, 0) + 1
+        try:
+            yield client
+        finally:
+            if key in self._leases:
+                self._leases[key] -= 1
+            await self._evict()
+
+    @staticmethod
+    def request_options(resources: 'Resources') -> dict:
+        """
+        Request options that are specific to the resource and therefore not stored on the shared client
+
+        :param resources: Resource object
+        :return: Keyword arguments for the client request methods
+        """
+        headers = dict(resources.http_headers or {})
+        if resources.http_cookies:
+            headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in resources.http_cookies.items())
+        return {
+            'params': resources.http_params,
+            'headers': headers,
+            'timeout': resources.http_timeout
+        }
+
+    def http2_enabled(self, resources: 'Resources', uri: str = None) -> bool:
+        """
+        Whether requests of the resource go through an HTTP/2 client
+
+        :param resources: Resource object
+        :param uri: Request uri, the resource uri by default
+        :return: False if HTTP/2 was not requested, h2 is not installed or the origin only speaks HTTP/1.1
+        """
+        if not resources.http2:
+            return False
+        if not H2_AVAILABLE:
+            if not self._h2_warned:
+                self._h2_warned = True
+                logger.warning('http2 requested but the h2 package is not installed, use HTTP/1.1')
+            return False
+        return _origin(uri or resources.uri) not in self._http1_origins
+
+    def http2_negotiated(self, resources: 'Resources', uri: str = None) -> bool | None:
+        """
+        Protocol negotiated with the origin of the resource so far
+
+        :param resources: Resource object
+        :param uri: Request uri, the resource uri by default
+        :return: True for h2, False for HTTP/1.1, None if no response of the origin was seen yet
+        """
+        origin = _origin(uri or resources.uri)
+        if origin in self._http2_origins:
+            return True
+        if origin in self._http1_origins:
+            return False
+        return None
+
+    def _record_protocol(self, request: httpx.Request, response: httpx.Response):
+        origin = _origin(request.url)
+        if response.extensions.get('http_version') == b'HTTP/2':
+            self._http2_origins.add(origin)
+        elif origin not in self._http1_origins:
+            logger.info(f'h2 was not negotiated with {request.url.host}, fall back to HTTP/1.1')
+            self._http1_origins.add(origin)
+
+    def _client_key(self, resources: 'Resources', uri: str = None) -> tuple:
+        return (
+            resources.http_proxy.get('http'),
+            resources.http_proxy.get('https'),
+            resources.http_verify,
+            tuple(resources.http_auth) if resources.http_auth else None,
+            self.http2_enabled(resources, uri)
+        )
+
+    def _create_transport(self, proxy: str | None, verify: bool, http2: bool) -> httpx.AsyncBaseTransport:
+        if not http2:
+            return httpx.AsyncHTTPTransport(proxy=proxy, verify=verify, limits=self.limits, retries=5)
+        transports = [
+            httpx.AsyncHTTPTransport(proxy=proxy, verify=verify, http2=True, limits=self.limits, retries=5)
+            for _ in range(self.http2_max_connections)
+        ]
+        return _StreamLimitedTransport(transports, self.http2_max_streams, self._record_protocol)
+
+    def _create_client(self, resources: 'Resources', http2: bool) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            auth=resources.http_auth,
+            headers=DEFAULT_HEADERS,
+            cookies=_NoCookieJar(),
+            follow_redirects=True,
+            verify=resources.http_verify,
+            limits=self.limits,
+            mounts={
+                'http://': self._create_transport(resources.http_proxy.get('http'), resources.http_verify, http2),
+                'https://': self._create_transport(resources.http_proxy.get('https'), resources.http_verify, http2)
+            }
+        )
+
+    async def _evict(self):
+        """
+        Close the least recently used idle clients exceeding the pool size
+        """
+        idle = [key for key in self._clients if not self._leases.get(key)]
+        while len(self._clients) > self.max_clients and idle:
+            key = idle.pop(0)
+            client = self._clients.pop(key)
+            self._leases.pop(key, None)
+            await client.aclose()
+            logger.info(f'close idle http client: {len(self._clients)} clients in pool')
+
+    async def aclose(self):
+        """
+        Close all clients in the pool
+        """
+        clients = list(self._clients.values())
+        self._clients.clear()
+        self._leases.clear()
+        for client in clients:
+            await client.aclose()
+
+    def close(self):
+        """
+        Close all clients and the event loop of the pool
+        """
+        self._check_fork()
+        if self._loop is None or self._loop.is_closed():
+            return
+        if not self._loop.is_running():
+            self._loop.run_until_complete(self.aclose())
+            self._loop.close()
+        self._loop = None
+
+    def _check_fork(self):
+        """
+        A forked child inherits the registry of its parent, whose connections and loop it must not touch
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._clients = OrderedDict()
+            self._leases = {}
+            self._loop = None
+            self._http1_origins = set()
+            self._http2_origins = set()
+
+
+class FtpSessionPool:
+    """
+    Per-process pool of logged-in FTP sessions
+
+    Sessions are keyed by host, port and login. A session given back after a download stays idle for
+    the next file of the same server, which then skips connecting, logging in and probing the server,
+    whose capabilities are cached per key. A keep-alive thread sends NOOP to idle sessions so the server
+    does not drop them, sessions that fail it or stay idle longer than ``keepalive_expiry`` are closed.
+    Sessions are used by one thread at a time, the pool itself is thread-safe.
+    """
+
+    # A session idle for longer is checked with NOOP before it is handed out again
+    _VALIDATE_AFTER = 5
+
+    def __init__(self,
+                 max_idle: int = DEFAULT_FTP_MAX_IDLE_SESSIONS,
+                 keepalive_expiry: float = DEFAULT_FTP_KEEPALIVE_EXPIRY,
+                 noop_interval: float = DEFAULT_FTP_NOOP_INTERVAL):
+        """
+        FTP session pool
+
+        :param max_idle: Maximum number of idle sessions kept for each key
+        :param keepalive_expiry: Time in seconds an idle session is kept
+        :param noop_interval: Interval in seconds of the NOOP sent to idle sessions
+        """
+        self.max_idle = max_idle
+        self.keepalive_expiry = keepalive_expiry
+        self.noop_interval = noop_interval
+        self._idle: dict[tuple, list[tuple[FTP, float]]] = {}
+        self._leases: dict[FTP, tuple] = {}
+        self._capabilities: dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+        self._timer: Interval | None = None
+        self._pid = os.getpid()
+
+    @staticmethod
+    def session_key(host: str, port: int, username: str, password: str) -> tuple:
+        return host, port, username, password
+
+    def acquire(self, key: tuple, connect: Callable[[], FTP]) -> FTP:
+        """
+        Lease an idle session of the key, or a new one
+
+        :param key: Session key
+        :param connect: Opens a new logged-in session
+        :return: FTP session, to be given back with release
+        """
+        while True:
+            with self._lock:
+                self._check_fork()
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                ftp, since = idle.pop()
+            if time.monotonic() - since < self._VALIDATE_AFTER or self._noop(ftp):
+                with self._lock:
+                    self._leases[ftp] = key
+                return ftp
+        ftp = connect()
+        with self._lock:
+            self._leases[ftp] = key
+        logger.info(f'open ftp session: {key[0]}:{key[1]}')
+        return ftp
+
+    def release(self, ftp: FTP, reusable: bool = True):
+        """
+        Give a session back
+
+        :param ftp: Session returned by acquire
+        :param reusable: Whether the session is idle and in step with the server, it is closed otherwise
+        """
+        with self._lock:
+            self._check_fork()
+            key = self._leases.pop(ftp, None)
+            idle = self._idle.setdefault(key, []) if key is not None else None
+            keep = reusable and idle is not None and len(idle) < self.max_idle
+            if keep:
+                idle.append((ftp, time.monotonic()))
+                self._start()
+        if not keep:
+            self._quit(ftp, reusable)
+
+    def capabilities(self, key: tuple) -> Any:
+        """
+        Capabilities of the server cached for the key
+
+        :param key: Session key
+        :return: Cached value, None if the server was not probed yet
+        """
+        return self._capabilities.get(key)
+
+    def cache_capabilities(self, key: tuple, capabilities: Any):
+        """
+        Cache the probed capabilities of the server
+
+        :param key: Session key
+        :param capabilities: Probe result
+        """
+        self._capabilities[key] = capabilities
+
+    def _start(self):
+        if self._timer is None:
+            self._timer = Interval(self.noop_interval, self._keepalive)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _keepalive(self):
+        """
+        Send NOOP to the idle sessions, closing the expired and broken ones
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            sessions = [(key, item) for key, idle in self._idle.items() for item in idle]
+        for key, item in sessions:
+            # Only the session being checked is taken out, the others can be acquired meanwhile
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle or item not in idle:
+                    continue
+                idle.remove(item)
+            ftp, since = item
+            if now - since > self.keepalive_expiry:
+                self._quit(ftp, True)
+            elif self._noop(ftp):
+                self._restore(key, ftp, since)
+
+    def _restore(self, key: tuple, ftp: FTP, since: float):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((ftp, since))
+                return
+        self._quit(ftp, True)
+
+    @staticmethod
+    def _noop(ftp: FTP) -> bool:
+        try:
+            ftp.voidcmd('NOOP')
+            return True
+        except all_errors as e:
+            logger.info(f'evict broken ftp session: {e}')
+            ftp.close()
+            return False
+
+    @staticmethod
+    def _quit(ftp: FTP, graceful: bool):
+        if graceful:
+            try:
+                ftp.quit()
+                return
+            except all_errors:
+                pass
+        ftp.close()
+
+    def close(self):
+        """
+        Close all idle sessions and stop the keep-alive thread
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            sessions = [ftp for idle in self._idle.values() for ftp, _ in idle]
+            self._idle = {}
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        for ftp in sessions:
+            self._quit(ftp, True)
+
+    def _check_fork(self):
+        """
+        A forked child inherits the sessions of its parent, whose connections it must not use
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = {}
+            self._leases = {}
+            self._timer = None
+
+
+client_pool = HttpClientPool()
+atexit.register(client_pool.close)
+ftp_pool = FtpSessionPool()
+atexit.register(ftp_pool.close)
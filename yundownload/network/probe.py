@@ -0,0 +1,176 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Mapping
+
+from yundownload.utils.config import DEFAULT_PROBE_CACHE_TTL, DEFAULT_PROBE_CACHE_PATH
+from yundownload.utils.logger import logger
+
+# Response headers of the probe that the download depends on
+PROBE_HEADERS = (
+    'Content-Length',
+    'Content-Encoding',
+    'ETag',
+    'Last-Modified',
+    'Content-MD5',
+    'Digest',
+    'Repr-Digest',
+    'x-goog-hash'
+)
+
+
+class ProbeInfo:
+    """
+    Result of probing an HTTP resource
+    """
+    __slots__ = ('headers', 'accept_ranges', 'stored_at')
+
+    def __init__(self, headers: Mapping[str, str], accept_ranges: bool, stored_at: float = None):
+        """
+        Probe result
+
+        :param headers: Probe response headers, only PROBE_HEADERS are kept
+        :param accept_ranges: Whether the server answers range requests
+        :param stored_at: Time the probe was made
+        """
+        self.headers = {name: headers[name] for name in PROBE_HEADERS if headers.get(name) is not None}
+        self.accept_ranges = accept_ranges
+        self.stored_at = time.time() if stored_at is None else stored_at
+
+    @property
+    def content_length(self) -> int:
+        return int(self.headers.get('Content-Length', 0))
+
+    def __repr__(self):
+        return f'<ProbeInfo {self.content_length} {self.accept_ranges}>'
+
+
+class ProbeCache:
+    """
+    Cache of the HEAD and range probes of HTTP resources
+
+    A hit lets a repeated download skip the probe round-trips and go straight to the transfer, the
+    cached validators are sent with If-Range so a changed resource is never mixed with the old one.
+    Entries live in memory and, if a path is given, in a sqlite database shared by processes and runs.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_PROBE_CACHE_TTL, path: str | Path | None = DEFAULT_PROBE_CACHE_PATH):
+        """
+        Probe cache
+
+        :param ttl: Time in seconds an entry stays valid, 0 disables the cache
+        :param path: Optional sqlite database path
+        """
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self._entries: dict[str, ProbeInfo] = {}
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._pid = os.getpid()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _connect(self) -> sqlite3.Connection | None:
+        if self.path is None:
+            return None
+        if self._pid != os.getpid():
+            # sqlite connections must not be shared with a forked child
+            self._pid = os.getpid()
+            self._db = None
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS probe ('
+                             'key TEXT PRIMARY KEY, headers TEXT, accept_ranges INTEGER, stored_at REAL)')
+        return self._db
+
+    def get(self, key: str) -> ProbeInfo | None:
+        """
+        Look up a fresh entry
+
+        :param key: Resource key
+        :return: Probe result, None on a miss or an expired entry
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            info = self._entries.get(key)
+            if info is None:
+                info = self._load(key)
+            if info is None:
+                return None
+            if time.time() - info.stored_at > self.ttl:
+                self._entries.pop(key, None)
+                return None
+            self._entries[key] = info
+            return info
+
+    def _load(self, key: str) -> ProbeInfo | None:
+        try:
+            db = self._connect()
+            if db is None:
+                return None
+            row = db.execute('SELECT headers, accept_ranges, stored_at FROM probe WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f'probe cache read failed: {e}')
+            return None
+        if row is None:
+            return None
+        return ProbeInfo(json.loads(row[0]), bool(row[1]), row[2])
+
+    def put(self, key: str, info: ProbeInfo):
+        """
+        Store a probe result
+
+        :param key: Resource key
+        :param info: Probe result
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = info
+            try:
+                db = self._connect()
+                if db is not None:
+                    db.execute('INSERT OR REPLACE INTO probe VALUES (?, ?, ?, ?)',
+                               (key, json.dumps(info.headers), int(info.accept_ranges), info.stored_at))
+            except sqlite3.Error as e:
+                logger.warning(f'probe cache write failed: {e}')
+
+    def invalidate(self, key: str):
+        """
+        Drop an entry, e.g. when the resource turned out to have changed
+
+        :param key: Resource key
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            try:
+                db = self._connect()
+                if db is not None:
+                    db.execute('DELETE FROM probe WHERE key = ?', (key,))
+            except sqlite3.Error as e:
+                logger.warning(f'probe cache write failed: {e}')
+
+    def clear(self):
+        """
+        Drop every entry
+        """
+        with self._lock:
+            self._entries.clear()
+            try:
+                db = self._connect()
+                if db is not None:
+                    db.execute('DELETE FROM probe')
+            except sqlite3.Error as e:
+                logger.warning(f'probe cache write failed: {e}')
+
+
+probe_cache = ProbeCache()
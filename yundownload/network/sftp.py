@@ -1,6 +1,8 @@
 import os
+import stat
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Iterator
 from urllib.parse import urlparse, unquote
 
 import paramiko
@@ -8,11 +10,18 @@ from paramiko.ssh_exception import SSHException
 
 from yundownload.core.resources import Resources
 from yundownload.network.base import BaseProtocolHandler
+from yundownload.utils.checksum import Checksum
 from yundownload.utils import retry
 from yundownload.utils.core import Result
 from yundownload.utils.exceptions import ConnectionException, AuthException
 from yundownload.utils.config import DEFAULT_CHUNK_SIZE
 from yundownload.utils.logger import logger
+from yundownload.utils.progress import Phase
+from yundownload.utils.sync import RemoteFile, walk_tree
+from yundownload.utils.throttle import Throttle
+
+# Most bytes requested ahead of what has been written to the file
+_READ_WINDOW = 8 * 1024 * 1024
 
 
 class SFTPProtocolHandler(BaseProtocolHandler):
@@ -32,46 +41,94 @@ class SFTPProtocolHandler(BaseProtocolHandler):
 
     def _download(self, resources: "Resources"):
         """实现 SFTP 断点续传下载"""
-        uri = resources.uri
         local_path = resources.save_path
-
-        parsed = urlparse(uri)
-        host = parsed.hostname
-        port = parsed.port or resources.sftp_port or 22
-        username = parsed.username or "anonymous"
-        password = parsed.password or ""
-        remote_path = unquote(parsed.path)
-
-        self._connect(host, port)
-        self._login(username, password)
-
-        logger.info(f"Login success to {uri}")
+        remote_path = self._open(resources)
 
         file_stat = self.sftp.stat(remote_path)
         file_size = file_stat.st_size
 
+        self._total_size = file_size
         prepare_result = self._prepare_local_file(local_path, file_size)
         if prepare_result & Result.EXIST:
             return Result.EXIST
+        self.phase = Phase.DOWNLOADING
 
         start_pos = local_path.stat().st_size if local_path.exists() else 0
-
+        self._checksum = Checksum.from_resources(resources)
+        if self._checksum is not None:
+            self._checksum.update_from_file(local_path, start_pos)
+        self._throttle = Throttle(resources)
+        chunk_size = self._throttle.chunk_size(DEFAULT_CHUNK_SIZE)
+
+        # The read requests of a window are pipelined, the next window is only asked for once this one
+        # is written, so the buffered data stays bounded and the throttle paces the network
+        window = max(chunk_size, min(_READ_WINDOW, chunk_size * 8))
         with self.sftp.open(remote_path, 'rb') as remote_file:
-            remote_file.seek(start_pos)
-
             with open(local_path, 'ab' if start_pos > 0 else 'wb') as local_file:
-                while True:
-                    data = remote_file.read(DEFAULT_CHUNK_SIZE)
-                    if not data:
+                position = start_pos
+                while position < file_size:
+                    end = min(file_size, position + window)
+                    chunks = [(offset, min(chunk_size, end - offset)) for offset in range(position, end, chunk_size)]
+                    for data in remote_file.readv(chunks, max_concurrent_prefetch_requests=64):
+                        local_file.write(data)
+                        position += len(data)
+                        self.current_size += len(data)
+                        if self._checksum is not None:
+                            self._checksum.update(data)
+                        self._throttle.consume(len(data))
+                    if position < end:
+                        # The remote file is shorter than it was
                         break
 
-                    local_file.write(data)
-                    self.current_size += len(data)
-
         if local_path.stat().st_size != file_size:
             raise IOError("File size mismatch after download")
 
-        return Result.SUCCESS
+        return self._verify_checksum(resources)
+
+    def _open(self, resources: "Resources") -> str:
+        """
+        Connect and log in with the login of the resource uri
+
+        :return: Remote path
+        """
+        parsed = urlparse(resources.uri)
+        host = parsed.hostname
+        port = parsed.port or resources.sftp_port or 22
+        username = parsed.username or "anonymous"
+        password = parsed.password or ""
+
+        self._connect(host, port)
+        self._login(username, password)
+
+        logger.info(f"Login success to {resources.uri}")
+        return unquote(parsed.path)
+
+    def walk(self, resources: "Resources") -> Iterator[RemoteFile]:
+        """
+        List the directory tree with listdir_attr, each listing thread on its own channel of the connection
+        """
+        root = self._open(resources).rstrip('/') or '/'
+        local = threading.local()
+        clients = []
+        lock = threading.Lock()
+
+        def list_dir(path: str) -> list[tuple[str, bool, int, float]]:
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = paramiko.SFTPClient.from_transport(self.transport)
+                with lock:
+                    clients.append(client)
+            entries = []
+            for attr in client.listdir_attr(path):
+                if stat.S_ISDIR(attr.st_mode) or stat.S_ISREG(attr.st_mode):
+                    entries.append((attr.filename, stat.S_ISDIR(attr.st_mode), attr.st_size, float(attr.st_mtime)))
+            return entries
+
+        try:
+            yield from walk_tree(list_dir, root)
+        finally:
+            for client in clients:
+                client.close()
 
     def close(self):
         """关闭连接"""
@@ -1,21 +1,49 @@
 from .logger import logger
-from .tools import convert_slice_path, retry, retry_async
+from .tools import convert_slice_path, convert_state_path, preallocate_file, retry, retry_async
 from .exceptions import (
     DownloadException,
     ChunkUnsupportedException,
     NotSupportedProtocolException,
     ConnectionException,
-    AuthException
+    AuthException,
+    ResourceChangedException
 )
 from .work import WorkerFuture
+from .progress import Phase, ProgressBoard, ProgressSnapshot
+from .ranges import ByteRange, RangeScheduler
+from .journal import DownloadJournal
+from .mirrors import Mirror, MirrorSelector
+from .throttle import BandwidthLimiter
+from .writer import WriteBehind
+from .assembly import OrderedAssembler
+from .sync import RemoteFile, SyncIndex, walk_tree
 from .config import (
     DEFAULT_HEADERS,
     DEFAULT_CHUNK_SIZE,
     DEFAULT_SLICED_CHUNK_SIZE,
+    DEFAULT_MIN_SPLIT_SIZE,
+    DEFAULT_JOURNAL_INTERVAL,
     DEFAULT_TIMEOUT,
     DEFAULT_MAX_RETRY,
     DEFAULT_RETRY_DELAY,
     DEFAULT_SLICED_FILE_SUFFIX,
+    DEFAULT_HTTP_MAX_CLIENTS,
+    DEFAULT_HTTP_MAX_CONNECTIONS,
+    DEFAULT_HTTP_KEEPALIVE_EXPIRY,
+    DEFAULT_HTTP2_MAX_CONNECTIONS,
+    DEFAULT_HTTP2_MAX_STREAMS,
+    DEFAULT_PROBE_CACHE_TTL,
+    DEFAULT_PROBE_CACHE_PATH,
+    DEFAULT_WRITE_BUFFER_SIZE,
+    DEFAULT_WRITE_COALESCE_SIZE,
+    DEFAULT_FSYNC_POLICY,
+    DEFAULT_M3U8_REORDER_WINDOW,
+    DEFAULT_FTP_MAX_IDLE_SESSIONS,
+    DEFAULT_FTP_KEEPALIVE_EXPIRY,
+    DEFAULT_FTP_NOOP_INTERVAL,
+    DEFAULT_FTP_MAX_CONNECTIONS,
+    DEFAULT_SYNC_LIST_WORKERS,
+    DEFAULT_SYNC_INDEX_NAME,
 )
 from .core import Result
 from .equilibrium import DynamicSemaphore, DynamicConcurrencyController
\ No newline at end of file
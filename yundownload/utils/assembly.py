@@ -0,0 +1,96 @@
+import asyncio
+from typing import Callable
+
+from ..utils.config import DEFAULT_M3U8_REORDER_WINDOW
+from ..utils.writer import WriteBehind
+
+
+class OrderedAssembler:
+    """
+    Appends numbered parts to a file in order while they are downloaded out of order
+
+    The data of the part at the head goes to the writer as soon as it arrives, the parts behind it
+    are held in memory until the head is complete. Downloads reserve a place before they start, at
+    most ``window`` parts ahead of the head, which bounds the memory held for reordering.
+    """
+
+    def __init__(self, writer: WriteBehind, fd: int, head: int = 0, position: int = 0,
+                 window: int = DEFAULT_M3U8_REORDER_WINDOW, on_complete: Callable[[int, int], None] = None):
+        """
+        Ordered assembler
+
+        :param writer: Writer of the output
+        :param fd: File descriptor of the output returned by the writer
+        :param head: First part to append
+        :param position: Offset in the output the head is appended at
+        :param window: Maximum number of parts downloaded at once, counted from the head
+        :param on_complete: Called with a part and the output size after it once the part is written
+        """
+        self.writer = writer
+        self.fd = fd
+        self.head = head
+        self.position = position
+        self.window = max(1, window)
+        self.on_complete = on_complete
+        self._chunks: dict[int, list[bytes]] = {}
+        self._complete: set[int] = set()
+        self._moved = asyncio.Condition()
+        self._lock = asyncio.Lock()
+
+    @property
+    def buffered(self) -> int:
+        """
+        Number of bytes held in memory
+        """
+        return sum(len(chunk) for chunks in self._chunks.values() for chunk in chunks)
+
+    async def reserve(self, index: int):
+        """
+        Wait until a part is within the window
+
+        :param index: Part number
+        """
+        async with self._moved:
+            await self._moved.wait_for(lambda: index < self.head + self.window)
+
+    async def append(self, index: int, data: bytes):
+        """
+        Add data of a part
+
+        :param index: Part number
+        :param data: Next data of the part, it must not be modified afterwards
+        """
+        self._chunks.setdefault(index, []).append(data)
+        if index == self.head:
+            await self._drain()
+
+    async def complete(self, index: int):
+        """
+        Mark a part as complete, appending it and the complete parts behind it if it is the head
+
+        :param index: Part number
+        """
+        self._complete.add(index)
+        await self._drain()
+
+    async def _drain(self):
+        async with self._lock:
+            moved = False
+            while True:
+                chunks = self._chunks.pop(self.head, None)
+                if chunks:
+                    for chunk in chunks:
+                        await self.writer.write(self.fd, self.position, chunk)
+                        self.position += len(chunk)
+                    # More data of the head may have arrived while waiting for the writer
+                    continue
+                if self.head not in self._complete:
+                    break
+                self._complete.discard(self.head)
+                if self.on_complete is not None:
+                    self.writer.call_after(self.on_complete, self.head, self.position)
+                self.head += 1
+                moved = True
+            if moved:
+                async with self._moved:
+                    self._moved.notify_all()
@@ -0,0 +1,168 @@
+import base64
+import binascii
+import hashlib
+from pathlib import Path
+from typing import Mapping
+
+from ..utils.config import DEFAULT_CHUNK_SIZE
+from ..utils.logger import logger
+
+try:
+    import crc32c as _crc32c
+except ImportError:  # pragma: no cover
+    _crc32c = None
+
+SUPPORTED_ALGORITHMS = ('md5', 'sha1', 'sha256', 'crc32c')
+# Preferred order when the server advertises several digests
+_HEADER_PREFERENCE = ('sha256', 'sha1', 'md5', 'crc32c')
+_HEADER_ALGORITHMS = {
+    'sha-256': 'sha256',
+    'sha256': 'sha256',
+    'sha': 'sha1',
+    'sha-1': 'sha1',
+    'sha1': 'sha1',
+    'md5': 'md5',
+    'crc32c': 'crc32c'
+}
+
+
+def _crc32c_table() -> list[int]:
+    table = []
+    for n in range(256):
+        crc = n
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+class Crc32c:
+    """
+    CRC-32C (Castagnoli) with the hashlib interface
+
+    Uses the ``crc32c`` package when it is installed, a table driven implementation otherwise.
+    """
+    name = 'crc32c'
+    _table: list[int] | None = None
+
+    def __init__(self):
+        self._crc = 0
+        if _crc32c is None and Crc32c._table is None:
+            logger.warning('crc32c package is not installed, falling back to a slow pure python crc32c')
+            Crc32c._table = _crc32c_table()
+
+    def update(self, data: bytes):
+        if _crc32c is not None:
+            self._crc = _crc32c.crc32c(data, self._crc)
+            return
+        crc = self._crc ^ 0xFFFFFFFF
+        table = self._table
+        for byte in data:
+            crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+        self._crc = crc ^ 0xFFFFFFFF
+
+    def digest(self) -> bytes:
+        return self._crc.to_bytes(4, 'big')
+
+    def hexdigest(self) -> str:
+        return self.digest().hex()
+
+
+class Checksum:
+    """
+    Digest computed incrementally while the data is written
+    """
+
+    def __init__(self, algorithm: str, expected: str):
+        """
+        Streaming checksum
+
+        :param algorithm: One of md5, sha1, sha256 and crc32c
+        :param expected: Expected digest in hex
+        """
+        self.algorithm = algorithm.lower().replace('-', '')
+        if self.algorithm not in SUPPORTED_ALGORITHMS:
+            raise ValueError(f'unsupported checksum algorithm: {algorithm}')
+        self.expected = expected.strip().lower()
+        self._hash = Crc32c() if self.algorithm == 'crc32c' else hashlib.new(self.algorithm)
+        self.position = 0
+
+    @classmethod
+    def from_resources(cls, resources) -> 'Checksum | None':
+        """
+        Checksum requested on the resource
+
+        :param resources: Resource object
+        :return: Checksum, None if the resource has no expected digest
+        """
+        if not resources.checksum:
+            return None
+        return cls(resources.checksum_algorithm, resources.checksum)
+
+    @classmethod
+    def from_headers(cls, headers: Mapping[str, str]) -> 'Checksum | None':
+        """
+        Checksum advertised by the server for the whole representation
+
+        Supports ``Content-MD5``, ``Digest``, ``Repr-Digest`` and ``x-goog-hash``.
+
+        :param headers: Response headers
+        :return: Checksum, None if the server sent no usable digest
+        """
+        digests = {}
+        for header in ('Digest', 'Repr-Digest', 'x-goog-hash'):
+            for item in headers.get(header, '').split(','):
+                name, _, value = item.strip().partition('=')
+                algorithm = _HEADER_ALGORITHMS.get(name.strip().lower())
+                if algorithm and value:
+                    digests.setdefault(algorithm, value.strip().strip(':'))
+        if headers.get('Content-MD5'):
+            digests.setdefault('md5', headers['Content-MD5'].strip())
+        for algorithm in _HEADER_PREFERENCE:
+            if algorithm in digests:
+                try:
+                    expected = base64.b64decode(digests[algorithm], validate=True).hex()
+                except binascii.Error:
+                    continue
+                logger.info(f'use {algorithm} digest sent by the server: {expected}')
+                return cls(algorithm, expected)
+        return None
+
+    def update(self, data: bytes):
+        """
+        Feed the next bytes in order
+
+        :param data: Data following the bytes already hashed
+        """
+        self._hash.update(data)
+        self.position += len(data)
+
+    def update_from_file(self, path: Path, end: int):
+        """
+        Hash the bytes of the file from the current position up to end (exclusive)
+
+        :param path: File path
+        :param end: Offset to stop at
+        """
+        if end <= self.position:
+            return
+        buffer = memoryview(bytearray(min(DEFAULT_CHUNK_SIZE, end - self.position)))
+        with path.open('rb', buffering=0) as f:
+            f.seek(self.position)
+            while self.position < end:
+                n = f.readinto(buffer[:end - self.position])
+                if not n:
+                    raise IOError(f'unexpected end of file while hashing: {path}')
+                self.update(buffer[:n])
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def verify(self) -> bool:
+        """
+        :return: Whether the data hashed so far matches the expected digest
+        """
+        return self.hexdigest() == self.expected
+
+    def __repr__(self):
+        return f'<Checksum {self.algorithm} {self.expected}>'
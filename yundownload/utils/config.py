@@ -8,7 +8,26 @@ DEFAULT_HEADERS = {
 }
 DEFAULT_CHUNK_SIZE = int(os.getenv(Environment.DEFAULT_CHUNK_SIZE, 1024 * 1024))
 DEFAULT_SLICED_CHUNK_SIZE = int(os.getenv(Environment.DEFAULT_SLICED_CHUNK_SIZE, 100 * 1024 * 1024))
+DEFAULT_MIN_SPLIT_SIZE = int(os.getenv(Environment.DEFAULT_MIN_SPLIT_SIZE, 4 * 1024 * 1024))
+DEFAULT_JOURNAL_INTERVAL = int(os.getenv(Environment.DEFAULT_JOURNAL_INTERVAL, 16 * 1024 * 1024))
 DEFAULT_TIMEOUT = int(os.getenv(Environment.DEFAULT_TIMEOUT, 60))
 DEFAULT_MAX_RETRY = int(os.getenv(Environment.DEFAULT_MAX_RETRY, 3))
 DEFAULT_RETRY_DELAY = int(os.getenv(Environment.DEFAULT_RETRY_DELAY, 3))
 DEFAULT_SLICED_FILE_SUFFIX = '.ydstf'
+DEFAULT_HTTP_MAX_CLIENTS = int(os.getenv(Environment.HTTP_MAX_CLIENTS, 8))
+DEFAULT_HTTP_MAX_CONNECTIONS = int(os.getenv(Environment.HTTP_MAX_CONNECTIONS, 100))
+DEFAULT_HTTP_KEEPALIVE_EXPIRY = float(os.getenv(Environment.HTTP_KEEPALIVE_EXPIRY, 30))
+DEFAULT_HTTP2_MAX_CONNECTIONS = int(os.getenv(Environment.HTTP2_MAX_CONNECTIONS, 4))
+DEFAULT_HTTP2_MAX_STREAMS = int(os.getenv(Environment.HTTP2_MAX_STREAMS, 32))
+DEFAULT_PROBE_CACHE_TTL = float(os.getenv(Environment.PROBE_CACHE_TTL, 0))
+DEFAULT_PROBE_CACHE_PATH = os.getenv(Environment.PROBE_CACHE_PATH)
+DEFAULT_WRITE_BUFFER_SIZE = int(os.getenv(Environment.WRITE_BUFFER_SIZE, 64 * 1024 * 1024))
+DEFAULT_WRITE_COALESCE_SIZE = int(os.getenv(Environment.WRITE_COALESCE_SIZE, 8 * 1024 * 1024))
+DEFAULT_FSYNC_POLICY = os.getenv(Environment.FSYNC_POLICY, 'never')
+DEFAULT_M3U8_REORDER_WINDOW = int(os.getenv(Environment.M3U8_REORDER_WINDOW, 16))
+DEFAULT_FTP_MAX_IDLE_SESSIONS = int(os.getenv(Environment.FTP_MAX_IDLE_SESSIONS, 8))
+DEFAULT_FTP_KEEPALIVE_EXPIRY = float(os.getenv(Environment.FTP_KEEPALIVE_EXPIRY, 120))
+DEFAULT_FTP_NOOP_INTERVAL = float(os.getenv(Environment.FTP_NOOP_INTERVAL, 30))
+DEFAULT_FTP_MAX_CONNECTIONS = int(os.getenv(Environment.FTP_MAX_CONNECTIONS, 3))
+DEFAULT_SYNC_LIST_WORKERS = int(os.getenv(Environment.SYNC_LIST_WORKERS, 4))
+DEFAULT_SYNC_INDEX_NAME = '.ydsync'
@@ -3,11 +3,30 @@ from enum import IntFlag
 
 class Environment:
     LOG_EVERY = 'YUNDOWNLOAD_LOG_EVERY'
+    PROGRESS_EVERY = 'YUNDOWNLOAD_PROGRESS_EVERY'
     DEFAULT_CHUNK_SIZE = 'YUNDOWNLOAD_DEFAULT_CHUNK_SIZE'
     DEFAULT_SLICED_CHUNK_SIZE = 'YUNDOWNLOAD_DEFAULT_SLICED_CHUNK_SIZE'
+    DEFAULT_MIN_SPLIT_SIZE = 'YUNDOWNLOAD_DEFAULT_MIN_SPLIT_SIZE'
+    DEFAULT_JOURNAL_INTERVAL = 'YUNDOWNLOAD_DEFAULT_JOURNAL_INTERVAL'
     DEFAULT_TIMEOUT = 'YUNDOWNLOAD_DEFAULT_TIMEOUT'
     DEFAULT_MAX_RETRY = 'YUNDOWNLOAD_DEFAULT_MAX_RETRY'
     DEFAULT_RETRY_DELAY = 'YUNDOWNLOAD_DEFAULT_RETRY_DELAY'
+    HTTP_MAX_CLIENTS = 'YUNDOWNLOAD_HTTP_MAX_CLIENTS'
+    HTTP_MAX_CONNECTIONS = 'YUNDOWNLOAD_HTTP_MAX_CONNECTIONS'
+    HTTP_KEEPALIVE_EXPIRY = 'YUNDOWNLOAD_HTTP_KEEPALIVE_EXPIRY'
+    HTTP2_MAX_CONNECTIONS = 'YUNDOWNLOAD_HTTP2_MAX_CONNECTIONS'
+    HTTP2_MAX_STREAMS = 'YUNDOWNLOAD_HTTP2_MAX_STREAMS'
+    PROBE_CACHE_TTL = 'YUNDOWNLOAD_PROBE_CACHE_TTL'
+    PROBE_CACHE_PATH = 'YUNDOWNLOAD_PROBE_CACHE_PATH'
+    WRITE_BUFFER_SIZE = 'YUNDOWNLOAD_WRITE_BUFFER_SIZE'
+    WRITE_COALESCE_SIZE = 'YUNDOWNLOAD_WRITE_COALESCE_SIZE'
+    FSYNC_POLICY = 'YUNDOWNLOAD_FSYNC_POLICY'
+    M3U8_REORDER_WINDOW = 'YUNDOWNLOAD_M3U8_REORDER_WINDOW'
+    FTP_MAX_IDLE_SESSIONS = 'YUNDOWNLOAD_FTP_MAX_IDLE_SESSIONS'
+    FTP_KEEPALIVE_EXPIRY = 'YUNDOWNLOAD_FTP_KEEPALIVE_EXPIRY'
+    FTP_NOOP_INTERVAL = 'YUNDOWNLOAD_FTP_NOOP_INTERVAL'
+    FTP_MAX_CONNECTIONS = 'YUNDOWNLOAD_FTP_MAX_CONNECTIONS'
+    SYNC_LIST_WORKERS = 'YUNDOWNLOAD_SYNC_LIST_WORKERS'
 
 
 class Result(IntFlag):
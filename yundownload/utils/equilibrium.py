@@ -1,29 +1,120 @@
 import asyncio
+import bisect
 import collections
 import math
-import statistics
+import multiprocessing
+import os
+import struct
+import threading
 import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Callable
+from urllib.parse import urlparse
 
 from ..utils.logger import logger
+from ..utils.shared import SlotTable, host_key
+
+if TYPE_CHECKING:
+    from ..core.resources import Resources
+
+# Processes that can hold host permits at once, each counts its permits in a column of every host slot
+_PERMIT_PROCESSES = 64
+_PERMIT_PIDS = struct.Struct(f'<{_PERMIT_PROCESSES}q')
+_PERMIT_PID = struct.Struct('<q')
+# host key, limit, mask of the processes waiting for a permit, followed by the permits of each process
+_PERMIT_SLOT = struct.Struct('<qqQ')
+_PERMIT_HOLDS = struct.Struct(f'<{_PERMIT_PROCESSES}i')
+_PERMIT_HOLD = struct.Struct('<i')
+_PERMIT_SLOTS = 1024
+# Waiting processes also retry this often without a wake-up, e.g. once the limit has grown
+_PERMIT_RECHECK = 1.0
+
+
+class _RollingWindow:
+    """
+    Fixed size window of samples with a running sum
+    """
+    __slots__ = ('values', 'total', '_evictions')
+
+    def __init__(self, size: int):
+        self.values = collections.deque(maxlen=size)
+        self.total = 0.0
+        self._evictions = 0
+
+    def push(self, value: float):
+        values = self.values
+        if len(values) == values.maxlen:
+            self.total -= values[0]
+            self._evictions += 1
+            if self._evictions >= values.maxlen:
+                # Rebuild the sum once per window so float rounding cannot drift
+                self._evictions = 0
+                self.total = math.fsum(values) - values[0]
+        values.append(value)
+        self.total += value
+
+    @property
+    def mean(self) -> float:
+        return self.total / len(self.values) if self.values else 0.0
+
+    def __len__(self):
+        return len(self.values)
+
+
+class _RollingMedian:
+    """
+    Median of the last samples, kept in a small sorted list
+    """
+    __slots__ = ('values', 'ordered')
+
+    def __init__(self, size: int):
+        self.values = collections.deque(maxlen=size)
+        self.ordered: list[float] = []
+
+    def push(self, value: float):
+        if len(self.values) == self.values.maxlen:
+            del self.ordered[bisect.bisect_left(self.ordered, self.values[0])]
+        self.values.append(value)
+        bisect.insort(self.ordered, value)
+
+    @property
+    def median(self) -> float:
+        ordered = self.ordered
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[middle]
+        return (ordered[middle - 1] + ordered[middle]) / 2 if ordered else 0.0
+
+    def __len__(self):
+        return len(self.values)
 
 
 class DynamicConcurrencyController:
     """
     Dynamic concurrency control classes
+
+    The sampling windows keep running sums, so recording a result and recalculating the concurrency
+    take constant time however large the window is.
     """
 
-    def __init__(self, min_concurrency=2, max_concurrency=30, window_size=100):
+    def __init__(self, min_concurrency=2, max_concurrency=30, window_size=100, clock=time.monotonic):
+        # 时钟，模拟时可替换为虚拟时钟
+        self.clock = clock
         # 并发控制参数
         self.min_concurrency = min_concurrency
         self.max_concurrency = max_concurrency
         self.current_concurrency = min_concurrency
-        self.last_adjustment = time.monotonic()
+        self.last_adjustment = self.clock()
 
         # 指标采样窗口
         self.window_size = window_size
-        self.response_times = collections.deque(maxlen=window_size)
-        self.successes = collections.deque(maxlen=window_size)
-        self.failures = collections.deque(maxlen=window_size)
+        self.response_times = _RollingWindow(window_size)
+        self.recent_response_times = _RollingWindow(10)
+        self.calibration_window = _RollingMedian(20)
+        # 1 为成功，0 为失败
+        self.outcomes = _RollingWindow(window_size)
+        self.recent_outcomes = _RollingWindow(10)
 
         # 状态跟踪
         self.base_response_time = None
@@ -37,14 +128,24 @@ class DynamicConcurrencyController:
         # 信号量
         self.semaphore = asyncio.Semaphore(min_concurrency)
 
+    @property
+    def successes(self) -> int:
+        """窗口内的成功次数"""
+        return round(self.outcomes.total)
+
+    @property
+    def failures(self) -> int:
+        """窗口内的失败次数"""
+        return len(self.outcomes) - self.successes
+
     def record_result(self, response_time: None, success=True):
         """记录每次请求的结果"""
         if response_time:
-            self.response_times.append(response_time)
-        if success:
-            self.successes.append(1)
-        else:
-            self.failures.append(1)
+            self.response_times.push(response_time)
+            self.recent_response_times.push(response_time)
+            self.calibration_window.push(response_time)
+        self.outcomes.push(1 if success else 0)
+        self.recent_outcomes.push(1 if success else 0)
 
         # 动态校准基准响应时间
         self._calibrate_base_response_time()
@@ -78,13 +179,9 @@ class DynamicConcurrencyController:
         return round(new_concurrency)
 
     def _calibrate_base_response_time(self):
-        """动态校准基准响应时间（使用statistics替代numpy）"""
+        """动态校准基准响应时间（最近 20 个样本的中位数）"""
         if len(self.response_times) > 20:
-            recent_rt = list(self.response_times)[-20:]
-            try:
-                new_base = statistics.median(recent_rt)
-            except statistics.StatisticsError:
-                new_base = recent_rt[len(recent_rt) // 2] if recent_rt else 0
+            new_base = self.calibration_window.median
 
             if self.base_response_time is None:
                 self.base_response_time = new_base
@@ -94,17 +191,16 @@ class DynamicConcurrencyController:
 
     def _calculate_success_rate(self):
         """计算加权成功率"""
-        total = len(self.successes) + len(self.failures)
-        if total == 0:
+        if not self.outcomes:
             return 1.0
-        recent_success = sum(list(self.successes)[-10:]) / 10 if len(self.successes) >= 10 else 1.0
-        historical_success = sum(self.successes) / total
+        recent_success = self.recent_outcomes.mean if len(self.recent_outcomes) >= 10 else 1.0
+        historical_success = self.outcomes.mean
         return 0.7 * recent_success + 0.3 * historical_success
 
     def _calculate_response_time_factor(self):
         """计算响应时间影响因子"""
         # EMA平滑处理响应时间
-        current_rt = statistics.mean(self.response_times) if self.response_times else 0
+        current_rt = self.response_times.mean
         self.ema_response = (self.ema_alpha * current_rt +
                              (1 - self.ema_alpha) * self.ema_response)
 
@@ -117,7 +213,7 @@ class DynamicConcurrencyController:
 
     def _calculate_load_factor(self):
         """计算系统负载因子"""
-        throughput = len(self.successes) / (time.monotonic() - self.last_adjustment + 1e-7)
+        throughput = self.successes / (self.clock() - self.last_adjustment + 1e-7)
         throughput_ratio = throughput / (self.last_throughput + 1e-7)
         self.last_throughput = throughput
 
@@ -126,13 +222,12 @@ class DynamicConcurrencyController:
     def _apply_adaptive_policies(self, concurrency):
         """应用自适应控制策略"""
         # 快速失败保护
-        if len(self.failures) > len(self.successes):
+        if self.failures > self.successes:
             return concurrency * 0.5
 
         # 响应时间突增保护
         if len(self.response_times) > 30:
-            recent_rt = statistics.mean(list(self.response_times)[-10:])
-            if recent_rt > 3 * self.base_response_time:
+            if self.recent_response_times.mean > 3 * self.base_response_time:
                 return concurrency * 0.7
 
         # 稳定性奖励
@@ -154,9 +249,9 @@ class DynamicConcurrencyController:
 
     def _linear_ramp_up(self):
         """冷启动阶段线性增长"""
-        if time.monotonic() - self.last_adjustment > 5.0:  # 每5秒增长一次
+        if self.clock() - self.last_adjustment > 5.0:  # 每5秒增长一次
             self.current_concurrency = min(self.current_concurrency + 1, self.max_concurrency)
-            self.last_adjustment = time.monotonic()
+            self.last_adjustment = self.clock()
         return self.current_concurrency
 
     def get_current_concurrency(self):
@@ -177,6 +272,7 @@ class DynamicSemaphore(asyncio.Semaphore):
         self._dcc = dcc
         super().__init__(value=initial_permits)
         self._target = initial_permits  # 当前目标并发数
+        self._excess = 0  # 缩容时仍被持有、释放时需收回的许可数
         self._lock = asyncio.Lock()  # 状态修改锁
 
     async def adaptive_update(self):
@@ -198,7 +294,10 @@ class DynamicSemaphore(asyncio.Semaphore):
 
             # 调整可用许可数量
             if delta > 0:
-                # 扩容：增加可用许可
+                # 扩容：先抵消尚未收回的许可，再增加可用许可
+                reclaimed = min(delta, self._excess)
+                self._excess -= reclaimed
+                delta -= reclaimed
                 self._value += delta
 
                 waiters = getattr(self, '_waiters', None)
@@ -210,8 +309,16 @@ class DynamicSemaphore(asyncio.Semaphore):
                     for _ in range(min(delta, waiters_count)):
                         self._wake_up_next()
             elif delta < 0:
-                # 缩容：减少可用许可（不影响已获取许可）
-                self._value = max(0, self._value + delta)
+                # 缩容：减少可用许可，不足的部分在已获取许可释放时收回
+                shrink = min(-delta, self._value)
+                self._value -= shrink
+                self._excess += -delta - shrink
+
+    def release(self):
+        if self._excess:
+            self._excess -= 1
+            return
+        super().release()
 
     @property
     def current_target(self):
@@ -223,5 +330,356 @@ class DynamicSemaphore(asyncio.Semaphore):
         """获取当前可用许可数"""
         return self._value
 
+    @property
+    def max_target(self):
+        """获取目标并发数上限"""
+        return self._dcc.max_concurrency
+
     def record_result(self, rt: float = None, success: bool = True):
         self._dcc.record_result(rt, success)
+
+
+def _host_of(uri: str) -> str:
+    parsed = urlparse(uri)
+    return f'{parsed.scheme}://{(parsed.hostname or "").lower()}:{parsed.port or ""}'
+
+
+def _alive(pid: int) -> bool:
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class HostPermits:
+    """
+    Connection permits per host shared by all worker processes of a downloader
+
+    Every process draws permits for a host from one slot in shared memory, the limit of the host is
+    the adaptive target last published by any process downloading from it. Each process counts its
+    permits in a column of its own, the permits of a process that died holding them are taken back
+    once the host runs out. A process waiting for a host marks itself in the slot and sleeps on its
+    doorbell semaphore, which the process giving a permit of the host back rings.
+    """
+    max_processes = _PERMIT_PROCESSES
+
+    def __init__(self):
+        if os.name == 'posix':
+            resource_tracker.ensure_running()
+        self._lock = multiprocessing.Lock()
+        self._doorbells = [multiprocessing.Semaphore(0) for _ in range(_PERMIT_PROCESSES)]
+        self._memory = SharedMemory(
+            create=True,
+            size=_PERMIT_PIDS.size + (_PERMIT_SLOT.size + _PERMIT_HOLDS.size) * _PERMIT_SLOTS
+        )
+        self._owner = True
+        self._attach()
+
+    def __getstate__(self):
+        return self._lock, self._doorbells, self._memory.name
+
+    def __setstate__(self, state):
+        self._lock, self._doorbells, name = state
+        self._memory = SharedMemory(name=name)
+        self._owner = False
+        self._attach()
+
+    def _attach(self):
+        self._hosts = SlotTable(self._memory.buf, _PERMIT_PIDS.size, _PERMIT_SLOT.size + _PERMIT_HOLDS.size,
+                                _PERMIT_SLOTS)
+        self._pid: int | None = None
+        self._index: int | None = None
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = set()
+        self._waiters_lock = threading.Lock()
+        self._watcher: threading.Thread | None = None
+        self._closed = False
+
+    def _claim(self) -> int | None:
+        """
+        Column of the calling process, claimed on first use, the lock is held by the caller
+
+        :return: None if every column belongs to a living process
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._index
+        if self._pid is not None:
+            # A forked child must not answer for the waiters and permits of its parent
+            self._waiters = set()
+            self._waiters_lock = threading.Lock()
+            self._watcher = None
+        self._pid = pid
+        self._index = None
+        for index, owner in enumerate(_PERMIT_PIDS.unpack_from(self._memory.buf, 0)):
+            if owner == 0 or owner == pid or not _alive(owner):
+                if owner:
+                    self._reclaim(index)
+                _PERMIT_PID.pack_into(self._memory.buf, index * _PERMIT_PID.size, pid)
+                self._index = index
+                break
+        else:
+            logger.warning(f'host permits are shared by {_PERMIT_PROCESSES} processes already, '
+                           f'process {pid} is not limited by the other processes')
+        return self._index
+
+    def _reclaim(self, index: int) -> int:
+        """
+        Take back the permits of a dead process, the lock is held by the caller
+
+        :param index: Column of the process
+        :return: Mask of the processes waiting for the hosts it held
+        """
+        buf = self._memory.buf
+        waiting = 0
+        held = 0
+        for offset in self._hosts.occupied():
+            hold_offset = offset + _PERMIT_SLOT.size + index * _PERMIT_HOLD.size
+            count, = _PERMIT_HOLD.unpack_from(buf, hold_offset)
+            if count:
+                held += count
+                _PERMIT_HOLD.pack_into(buf, hold_offset, 0)
+                key, limit, mask = _PERMIT_SLOT.unpack_from(buf, offset)
+                waiting |= mask
+                _PERMIT_SLOT.pack_into(buf, offset, key, limit, 0)
+        if held:
+            logger.warning(f'take back {held} host permits of dead process {_PERMIT_PIDS.unpack_from(buf, 0)[index]}')
+        _PERMIT_PID.pack_into(buf, index * _PERMIT_PID.size, 0)
+        return waiting
+
+    def _reclaim_dead(self, holds: tuple[int, ...], own: int) -> int:
+        """
+        Take back the permits of the dead processes among the holders of a host, the lock is held by the caller
+
+        :return: Mask of the processes waiting for the hosts they held
+        """
+        pids = _PERMIT_PIDS.unpack_from(self._memory.buf, 0)
+        waiting = 0
+        for index, count in enumerate(holds):
+            if count and index != own and pids[index] and not _alive(pids[index]):
+                waiting |= self._reclaim(index)
+        return waiting
+
+    def _ring(self, waiting: int):
+        index = 0
+        while waiting:
+            if waiting & 1:
+                self._doorbells[index].release()
+            waiting >>= 1
+            index += 1
+
+    def try_acquire(self, host: str, limit: int) -> bool:
+        """
+        Take a permit of the host if it has one left
+
+        :param host: Host key
+        :param limit: Adaptive limit of the calling process, it becomes the limit of the host
+        :return: Whether a permit was taken, a process that failed is woken once a permit comes back
+        """
+        buf = self._memory.buf
+        waiting = 0
+        try:
+            with self._lock:
+                index = self._claim()
+                offset = self._hosts.offset(host_key(host))
+                if index is None or offset is None:
+                    return True
+                holds_offset = offset + _PERMIT_SLOT.size
+                holds = _PERMIT_HOLDS.unpack_from(buf, holds_offset)
+                if sum(holds) >= limit:
+                    waiting = self._reclaim_dead(holds, index)
+                    holds = _PERMIT_HOLDS.unpack_from(buf, holds_offset)
+                key, _, mask = _PERMIT_SLOT.unpack_from(buf, offset)
+                if sum(holds) >= limit:
+                    _PERMIT_SLOT.pack_into(buf, offset, key, limit, mask | 1 << index)
+                    return False
+                _PERMIT_SLOT.pack_into(buf, offset, key, limit, mask & ~(1 << index))
+                _PERMIT_HOLD.pack_into(buf, holds_offset + index * _PERMIT_HOLD.size, holds[index] + 1)
+                return True
+        finally:
+            self._ring(waiting)
+
+    async def acquire(self, host: str, limit: Callable[[], int]):
+        """
+        Wait for a permit of the host
+
+        :param host: Host key
+        :param limit: Current adaptive limit of the calling process
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            waiter = (loop, loop.create_future())
+            with self._waiters_lock:
+                self._waiters.add(waiter)
+            try:
+                if self.try_acquire(host, limit()):
+                    return
+                self._watch()
+                await waiter[1]
+            finally:
+                with self._waiters_lock:
+                    self._waiters.discard(waiter)
+
+    def release(self, host: str):
+        """
+        Give a permit of the host back
+
+        :param host: Host key
+        """
+        buf = self._memory.buf
+        with self._lock:
+            index = self._claim()
+            offset = self._hosts.offset(host_key(host))
+            if index is None or offset is None:
+                return
+            hold_offset = offset + _PERMIT_SLOT.size + index * _PERMIT_HOLD.size
+            count, = _PERMIT_HOLD.unpack_from(buf, hold_offset)
+            _PERMIT_HOLD.pack_into(buf, hold_offset, max(0, count - 1))
+            key, limit, waiting = _PERMIT_SLOT.unpack_from(buf, offset)
+            if waiting:
+                _PERMIT_SLOT.pack_into(buf, offset, key, limit, 0)
+        self._ring(waiting)
+
+    def _watch(self):
+        """
+        Start the thread that wakes the waiters of this process when its doorbell rings
+        """
+        with self._waiters_lock:
+            if self._watcher is None and self._index is not None:
+                self._watcher = threading.Thread(target=self._wake_waiters, args=(self._doorbells[self._index],),
+                                                 name='yundownload-permits', daemon=True)
+                self._watcher.start()
+
+    def _wake_waiters(self, doorbell):
+        while not self._closed:
+            rung = doorbell.acquire(timeout=_PERMIT_RECHECK)
+            with self._waiters_lock:
+                waiters = list(self._waiters)
+                if not waiters and not rung:
+                    self._watcher = None
+                    return
+            # Every waiter tries again, those that still find the host full mark themselves again
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(_wake, future)
+
+    def in_use(self, host: str) -> int:
+        """
+        :param host: Host key
+        :return: Number of permits of the host in use by all processes
+        """
+        with self._lock:
+            offset = self._hosts.offset(host_key(host))
+            return 0 if offset is None else sum(_PERMIT_HOLDS.unpack_from(self._memory.buf, offset + _PERMIT_SLOT.size))
+
+    def close(self):
+        """
+        Free the shared memory, only the process that created the permits unlinks it
+        """
+        self._closed = True
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class HostSemaphore(DynamicSemaphore):
+    """
+    Dynamic semaphore of one host, shared by the downloads of the process to that host
+
+    With shared host permits installed every acquisition also takes a permit from the counter of
+    the host in shared memory, so the processes of a downloader together respect one adaptive limit.
+    Semaphores of the host with other concurrency settings draw from the same counter, each one up to
+    its own target.
+    """
+
+    def __init__(self, dcc: 'DynamicConcurrencyController', host: str, permits: 'HostPermits | None' = None):
+        super().__init__(dcc)
+        self.host = host
+        self._permits = permits
+        self.holders = 0
+
+    async def acquire(self):
+        await super().acquire()
+        if self._permits is not None:
+            try:
+                await self._permits.acquire(self.host, lambda: max(1, self._target))
+            except BaseException:
+                super().release()
+                raise
+        self.holders += 1
+        return True
+
+    def release(self):
+        self.holders -= 1
+        if self._permits is not None:
+            self._permits.release(self.host)
+        super().release()
+
+
+class ConcurrencyRegistry:
+    """
+    Per-process registry of the concurrency controllers of each host
+
+    Downloads to the same host with the same concurrency settings draw permits from one semaphore
+    driven by one controller, so the adaptive limit reflects the total load on the host instead of
+    ramping up per resource. Resources that set other limits for the host get a semaphore of their own.
+    Idle hosts beyond ``max_hosts`` are forgotten in least recently used order.
+    """
+
+    def __init__(self, max_hosts: int = 1024):
+        """
+        Concurrency registry
+
+        :param max_hosts: Maximum number of idle hosts kept
+        """
+        self.max_hosts = max_hosts
+        self.permits: HostPermits | None = None
+        self._semaphores: collections.OrderedDict[tuple, HostSemaphore] = collections.OrderedDict()
+        self._pid = os.getpid()
+
+    def install(self, permits: 'HostPermits | None'):
+        """
+        Share the host limits with the other processes of the downloader
+
+        :param permits: Host permits created by the downloader
+        """
+        self.permits = permits
+        self._semaphores.clear()
+
+    def semaphore(self, resources: 'Resources') -> 'HostSemaphore':
+        """
+        Semaphore of the host and the concurrency settings of the resource
+
+        :param resources: Resource object
+        :return: Semaphore shared with the other downloads to the host with the same settings
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._semaphores = collections.OrderedDict()
+        host = _host_of(resources.uri)
+        limits = (resources.dcc.min_concurrency, resources.dcc.max_concurrency, resources.dcc.window_size)
+        key = (host, *limits)
+        semaphore = self._semaphores.get(key)
+        loop = asyncio.get_running_loop()
+        if semaphore is None or getattr(semaphore, '_loop', None) not in (None, loop):
+            semaphore = HostSemaphore(DynamicConcurrencyController(*limits), host, self.permits)
+            self._semaphores[key] = semaphore
+        self._semaphores.move_to_end(key)
+        self._evict()
+        return semaphore
+
+    def _evict(self):
+        idle = [key for key, semaphore in self._semaphores.items() if not semaphore.holders]
+        while len(self._semaphores) > self.max_hosts and idle:
+            self._semaphores.pop(idle.pop(0))
+
+
+concurrency_registry = ConcurrencyRegistry()
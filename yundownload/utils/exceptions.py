@@ -31,4 +31,11 @@ class AuthException(DownloadException):
     Raised when the authentication fails.
     """
     def __init__(self, uri: str):
-        super().__init__(f"Authentication failed for URI: {uri}")
\ No newline at end of file
+        super().__init__(f"Authentication failed for URI: {uri}")
+
+class ResourceChangedException(DownloadException):
+    """
+    Raised when the remote resource changed while it was being downloaded.
+    """
+    def __init__(self, uri: str):
+        super().__init__(f"Remote resource changed during download for URI: {uri}")
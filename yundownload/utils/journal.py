@@ -0,0 +1,148 @@
+import json
+from pathlib import Path
+from typing import TextIO
+
+from ..utils.logger import logger
+
+JOURNAL_VERSION = 1
+
+
+def merge_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """
+    Merge overlapping and adjacent ranges
+
+    :param ranges: Ranges as (start, end) with an inclusive end
+    :return: Sorted disjoint ranges
+    """
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def complement_ranges(ranges: list[tuple[int, int]], size: int) -> list[tuple[int, int]]:
+    """
+    Ranges of [0, size) that are not covered
+
+    :param ranges: Sorted disjoint ranges as (start, end) with an inclusive end
+    :param size: Total size
+    :return: Uncovered ranges
+    """
+    gaps = []
+    position = 0
+    for start, end in ranges:
+        if start > position:
+            gaps.append((position, start - 1))
+        position = max(position, end + 1)
+    if position < size:
+        gaps.append((position, size - 1))
+    return gaps
+
+
+class DownloadJournal:
+    """
+    Sidecar journal of a sliced or segmented download
+
+    The first line is a JSON header with the size and the validators of the remote resource and the
+    slice plan, every following line is a completed range ``start end``. Ranges are only appended while
+    downloading, so resuming costs one small read, and the journal is compacted whenever it is opened.
+    A header that does not match the remote resource any more discards the journal. Downloads that
+    append to their output record the output size after a range as a third field ``start end position``,
+    only the latest of which is kept in ``positions``.
+    """
+
+    def __init__(self, path: Path):
+        """
+        Download journal
+
+        :param path: Journal file path
+        """
+        self.path = path
+        self.header: dict = {}
+        self.positions: dict[int, int] = {}
+        self._file: TextIO | None = None
+
+    def open(self, size: int, **header) -> list[tuple[int, int]]:
+        """
+        Load the journal and keep it open for recording
+
+        :param size: Size of the download, in bytes or segments
+        :param header: Validators and slice plan, e.g. etag, last_modified and chunk
+        :return: Completed ranges, empty if the journal is missing or out of date
+        """
+        self.header = {'version': JOURNAL_VERSION, 'size': size, **header}
+        completed = self._load()
+        self._write(completed)
+        return completed
+
+    def _load(self) -> list[tuple[int, int]]:
+        self.positions = {}
+        if not self.path.exists():
+            return []
+        try:
+            header_line, *lines = self.path.read_text().splitlines()
+            header = json.loads(header_line)
+            ranges = []
+            positions = {}
+            for line in lines:
+                fields = line.split()
+                if len(fields) >= 2:
+                    ranges.append((int(fields[0]), int(fields[1])))
+                if len(fields) == 3:
+                    positions[int(fields[1])] = int(fields[2])
+        except (OSError, ValueError):
+            logger.warning(f'journal is damaged, restart download: {self.path}')
+            return []
+        if header != self.header:
+            logger.info(f'journal is out of date, restart download: {self.path}')
+            return []
+        completed = merge_ranges(ranges)
+        ends = [end for _, end in completed if end in positions]
+        if ends:
+            self.positions = {ends[-1]: positions[ends[-1]]}
+        return completed
+
+    def _write(self, completed: list[tuple[int, int]]):
+        self.close()
+        with self.path.open('w') as f:
+            f.write(json.dumps(self.header) + '\n')
+            f.writelines(
+                f'{start} {end} {self.positions[end]}\n' if end in self.positions else f'{start} {end}\n'
+                for start, end in completed
+            )
+        self._file = self.path.open('a')
+
+    def add(self, start: int, end: int, position: int = None):
+        """
+        Record a completed range
+
+        :param start: First completed byte or segment
+        :param end: Last completed byte or segment (inclusive)
+        :param position: Size of the output once the range is appended to it
+        """
+        if end < start:
+            return
+        if position is None:
+            self._file.write(f'{start} {end}\n')
+        else:
+            # Appending downloads complete their parts in order and resume after the last one, so only
+            # the latest position is kept however long the download runs
+            if not self.positions or end > max(self.positions):
+                self.positions = {end: position}
+            self._file.write(f'{start} {end} {position}\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """
+        Delete the journal once the download is complete
+        """
+        self.close()
+        self.path.unlink(missing_ok=True)
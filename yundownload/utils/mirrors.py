@@ -0,0 +1,93 @@
+from ..utils.logger import logger
+
+
+class Mirror:
+    """
+    One source of a multi-source download
+    """
+    __slots__ = ('uri', 'validators', 'primary', 'active', 'rate', 'downloaded')
+
+    def __init__(self, uri: str, validators: dict[str, str | None] = None, primary: bool = False):
+        """
+        Download source
+
+        :param uri: Uri of the source
+        :param validators: ETag and Last-Modified the source answered with
+        :param primary: Whether this is the uri of the resource itself
+        """
+        self.uri = uri
+        self.validators = validators or {}
+        self.primary = primary
+        self.active = 0
+        self.rate: float | None = None
+        self.downloaded = 0
+
+    def __repr__(self):
+        return f'<Mirror {self.uri} {self.rate}>'
+
+
+class MirrorSelector:
+    """
+    Assigns the ranges of a sliced download to the mirrors in proportion to their throughput
+
+    Each new range goes to the mirror with the fewest connections per measured byte per second,
+    so a mirror twice as fast serves twice as many ranges at once. Mirrors without a measurement
+    yet count as fast as the fastest one, so every mirror gets probed with real traffic.
+    """
+
+    def __init__(self, mirrors: list[Mirror], alpha: float = 0.3):
+        """
+        Mirror selector
+
+        :param mirrors: Sources serving the same content
+        :param alpha: Weight of the latest measurement in the moving average of the throughput
+        """
+        self.mirrors = list(mirrors)
+        self.alpha = alpha
+
+    def _weight(self, mirror: Mirror) -> float:
+        if mirror.rate is not None:
+            return max(mirror.rate, 1.0)
+        return max((m.rate for m in self.mirrors if m.rate is not None), default=1.0)
+
+    def acquire(self) -> Mirror | None:
+        """
+        Take the mirror the next range should be downloaded from
+
+        :return: Mirror, None if every mirror was dropped
+        """
+        if not self.mirrors:
+            return None
+        mirror = min(self.mirrors, key=lambda m: (m.active + 1) / self._weight(m))
+        mirror.active += 1
+        return mirror
+
+    def release(self, mirror: Mirror, nbytes: int = 0, seconds: float = 0):
+        """
+        Give a mirror back and record the throughput of the range it served
+
+        :param mirror: Mirror returned by acquire
+        :param nbytes: Bytes downloaded
+        :param seconds: Time the download took
+        """
+        mirror.active -= 1
+        mirror.downloaded += nbytes
+        if nbytes and seconds > 0:
+            rate = nbytes / seconds
+            mirror.rate = rate if mirror.rate is None else self.alpha * rate + (1 - self.alpha) * mirror.rate
+
+    def drop(self, mirror: Mirror, reason: object) -> bool:
+        """
+        Stop using a mirror
+
+        :param mirror: Mirror that failed
+        :param reason: Failure that is logged
+        :return: Whether other mirrors are left
+        """
+        if mirror in self.mirrors:
+            self.mirrors.remove(mirror)
+            logger.warning(f'drop mirror {mirror.uri}: {reason}')
+        return bool(self.mirrors)
+
+    def __len__(self):
+        return len(self.mirrors)
@@ -0,0 +1,205 @@
+import os
+import struct
+import threading
+import time
+from enum import IntEnum
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+# sequence, current size, total size, steps, total steps, phase, speed, updated at
+_SLOT = struct.Struct('<qqqqqqdd')
+_BLOCK_SLOTS = 1024
+
+
+class Phase(IntEnum):
+    PENDING = 0
+    PROBING = 1
+    DOWNLOADING = 2
+    FINISHING = 3
+    DONE = 4
+    FAILED = 5
+
+    def __str__(self) -> str:
+        return self.name.lower()
+
+
+class ProgressSlot:
+    """
+    Address of one job in the progress board, it is sent to the worker process together with the job
+    """
+    __slots__ = ('name', 'index')
+
+    def __init__(self, name: str, index: int):
+        self.name = name
+        self.index = index
+
+    def __getstate__(self):
+        return self.name, self.index
+
+    def __setstate__(self, state):
+        self.name, self.index = state
+
+    def __repr__(self):
+        return f'<ProgressSlot {self.name}[{self.index}]>'
+
+
+class ProgressSnapshot:
+    """
+    Progress of a job at one moment
+    """
+    __slots__ = ('current_size', 'total_size', 'steps', 'total', 'phase', 'speed', 'updated_at')
+
+    def __init__(self, current_size: int = 0, total_size: int = 0, steps: int = 0, total: int = 0,
+                 phase: Phase = Phase.PENDING, speed: float = 0, updated_at: float = 0):
+        self.current_size = current_size
+        self.total_size = total_size
+        self.steps = steps
+        self.total = total
+        self.phase = phase
+        self.speed = speed
+        self.updated_at = updated_at
+
+    @property
+    def progress(self) -> float:
+        """
+        Download progress, the same way as BaseProtocolHandler.progress computes it
+        """
+        if self.total != 0:
+            return self.steps / self.total
+        if self.total_size != 0:
+            return round(self.current_size / self.total_size, 2)
+        return 0
+
+    def to_dict(self) -> dict:
+        return {
+            'phase': str(self.phase),
+            'progress': self.progress,
+            'current_size': self.current_size,
+            'total_size': self.total_size,
+            'steps': self.steps,
+            'total': self.total,
+            'speed': self.speed,
+            'updated_at': self.updated_at
+        }
+
+    def __repr__(self):
+        return f'<ProgressSnapshot {self.phase} {self.progress} {self.speed}>'
+
+
+def _write(buf, offset: int, values: tuple):
+    """
+    Write a slot under a sequence lock: the sequence is odd while the slot is being written
+    """
+    sequence = struct.unpack_from('<q', buf, offset)[0]
+    struct.pack_into('<q', buf, offset, sequence + 1)
+    _SLOT.pack_into(buf, offset, sequence + 1, *values)
+    struct.pack_into('<q', buf, offset, sequence + 2)
+
+
+def _read(buf, offset: int) -> ProgressSnapshot:
+    while True:
+        sequence, *values = _SLOT.unpack_from(buf, offset)
+        if sequence % 2 == 0 and struct.unpack_from('<q', buf, offset)[0] == sequence:
+            current_size, total_size, steps, total, phase, speed, updated_at = values
+            return ProgressSnapshot(current_size, total_size, steps, total, Phase(phase), speed, updated_at)
+
+
+class ProgressBoard:
+    """
+    Shared memory table the worker processes publish the progress of their jobs to
+
+    The parent allocates one fixed size slot per job, the worker writes it and the parent reads it
+    without any message passing. Blocks of slots are added when the board is full.
+    """
+
+    def __init__(self):
+        if os.name == 'posix':
+            # Worker processes started from now on attach through this tracker instead of starting
+            # their own, which would unlink the blocks when the worker exits
+            resource_tracker.ensure_running()
+        self._blocks: dict[str, SharedMemory] = {}
+        self._free: list[ProgressSlot] = []
+        self._lock = threading.Lock()
+
+    def allocate(self) -> ProgressSlot:
+        """
+        Take a free slot and reset it
+
+        :return: Slot of the job
+        """
+        with self._lock:
+            if not self._free:
+                block = SharedMemory(create=True, size=_SLOT.size * _BLOCK_SLOTS)
+                self._blocks[block.name] = block
+                self._free.extend(ProgressSlot(block.name, index) for index in reversed(range(_BLOCK_SLOTS)))
+            slot = self._free.pop()
+        _write(self._blocks[slot.name].buf, slot.index * _SLOT.size, (0, 0, 0, 0, Phase.PENDING, 0, time.time()))
+        return slot
+
+    def release(self, slot: ProgressSlot):
+        """
+        Return a slot once its job is finished
+
+        :param slot: Slot of the job
+        """
+        with self._lock:
+            if slot.name in self._blocks:
+                self._free.append(slot)
+
+    def read(self, slot: ProgressSlot) -> ProgressSnapshot:
+        """
+        Read the progress of a job
+
+        :param slot: Slot of the job
+        :return: Progress snapshot
+        """
+        return _read(self._blocks[slot.name].buf, slot.index * _SLOT.size)
+
+    def close(self):
+        """
+        Free the shared memory of the board
+        """
+        with self._lock:
+            for block in self._blocks.values():
+                block.close()
+                block.unlink()
+            self._blocks.clear()
+            self._free.clear()
+
+
+class ProgressPublisher:
+    """
+    Writes the progress of a job into its slot from the worker process
+    """
+    _attached: dict[str, SharedMemory] = {}
+    _pid = None
+
+    def __init__(self, slot: ProgressSlot):
+        self._offset = slot.index * _SLOT.size
+        self._buf = self._attach(slot.name).buf
+        self._last_size = 0
+        self._last_time = time.monotonic()
+        self._speed = 0.0
+
+    @classmethod
+    def _attach(cls, name: str) -> SharedMemory:
+        """
+        Blocks stay attached for the life of the worker process, slots are reused across jobs
+        """
+        if cls._pid != os.getpid():
+            cls._pid = os.getpid()
+            cls._attached = {}
+        if name not in cls._attached:
+            cls._attached[name] = SharedMemory(name=name)
+        return cls._attached[name]
+
+    def publish(self, current_size: int, total_size: int, steps: int, total: int, phase: Phase):
+        """
+        Publish the current progress, the speed is measured between two calls
+        """
+        now = time.monotonic()
+        if now - self._last_time > 0.1:
+            self._speed = max(0.0, (current_size - self._last_size) / (now - self._last_time))
+            self._last_size = current_size
+            self._last_time = now
+        _write(self._buf, self._offset, (current_size, total_size, steps, total, phase, self._speed, time.time()))
@@ -0,0 +1,106 @@
+from collections import deque
+from typing import Iterable
+
+
+class ByteRange:
+    """
+    A byte range of a sliced download that is being fetched
+
+    ``pos`` is the next byte to write and ``end`` the last byte (inclusive) of the range,
+    ``end`` moves down when another worker steals the tail of the range.
+    """
+    __slots__ = ('start', 'pos', 'end')
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.pos = start
+        self.end = end
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.end - self.pos + 1)
+
+    def __repr__(self):
+        return f'<ByteRange {self.pos}-{self.end}>'
+
+
+class RangeScheduler:
+    """
+    Work-stealing scheduler of the byte ranges of a sliced download
+
+    Workers take ranges from the initial plan first. Once the plan is exhausted an idle worker
+    splits the largest unfinished range in two and takes over its upper half, so every connection
+    stays busy until the last byte.
+    """
+
+    def __init__(self, ranges: Iterable[tuple[int, int]], chunk_size: int, min_split_size: int):
+        """
+        Range scheduler
+
+        :param ranges: Unfinished ranges as (start, end) with an inclusive end
+        :param chunk_size: Size of the ranges of the initial plan
+        :param min_split_size: Ranges are not split into parts smaller than this
+        """
+        self.min_split_size = max(1, min_split_size)
+        self._pending: deque[ByteRange] = deque()
+        self._active: set[ByteRange] = set()
+        for start, end in ranges:
+            for chunk_start in range(start, end + 1, chunk_size):
+                self._pending.append(ByteRange(chunk_start, min(chunk_start + chunk_size - 1, end)))
+
+    def acquire(self) -> ByteRange | None:
+        """
+        Take the next range to download
+
+        :return: A range, None if there is nothing left worth splitting
+        """
+        if self._pending:
+            byte_range = self._pending.popleft()
+            self._active.add(byte_range)
+            return byte_range
+        victim = max(self._active, key=lambda r: r.remaining, default=None)
+        if victim is None or victim.remaining < 2 * self.min_split_size:
+            return None
+        middle = victim.pos + victim.remaining // 2
+        byte_range = ByteRange(middle, victim.end)
+        victim.end = middle - 1
+        self._active.add(byte_range)
+        return byte_range
+
+    def release(self, byte_range: ByteRange):
+        """
+        Give a range back, its unfinished part is queued again
+
+        :param byte_range: Range returned by acquire
+        """
+        self._active.discard(byte_range)
+        if byte_range.remaining:
+            self._pending.appendleft(ByteRange(byte_range.pos, byte_range.end))
+
+    def unfinished(self) -> list[tuple[int, int]]:
+        """
+        Ranges that are not downloaded yet, sorted by offset
+
+        :return: List of (start, end) with an inclusive end
+        """
+        ranges = [(r.pos, r.end) for r in (*self._pending, *self._active) if r.remaining]
+        return sorted(ranges)
+
+    @property
+    def frontier(self) -> int | None:
+        """
+        First byte that is not downloaded yet, everything before it is on disk
+
+        :return: Offset, None if every range is finished
+        """
+        return min((r.pos for r in (*self._pending, *self._active) if r.remaining), default=None)
+
+    @property
+    def remaining(self) -> int:
+        """
+        Number of bytes not downloaded yet
+        """
+        return sum(r.remaining for r in self._pending) + sum(r.remaining for r in self._active)
+
+    def __bool__(self):
+        return bool(self._pending or self._active)
@@ -0,0 +1,69 @@
+import hashlib
+import struct
+from typing import Iterator
+
+_KEY = struct.Struct('<q')
+
+
+def host_key(host: str) -> int:
+    """
+    Hash of the host name that is the same in every process, never 0
+
+    :param host: Host name or key
+    :return: Signed 64 bit key
+    """
+    return int.from_bytes(hashlib.blake2b(host.encode(), digest_size=8).digest(), 'little', signed=True) or 1
+
+
+class SlotTable:
+    """
+    Hash table of fixed size slots in shared memory, found by open addressing
+
+    The first field of a slot is its key, a signed 64 bit integer where 0 marks a free slot. A key takes
+    the first free slot it probes and keeps it, slots are never freed. Callers serialize the access
+    with a lock shared by the processes.
+    """
+    __slots__ = ('buf', 'base', 'size', 'count')
+
+    def __init__(self, buf: memoryview, base: int, size: int, count: int):
+        """
+        Slot table
+
+        :param buf: Shared memory buffer
+        :param base: Offset of the first slot
+        :param size: Size of a slot in bytes
+        :param count: Number of slots
+        """
+        self.buf = buf
+        self.base = base
+        self.size = size
+        self.count = count
+
+    def offset(self, key: int) -> int | None:
+        """
+        Offset of the slot of a key, a new key takes a zeroed slot
+
+        :param key: Non-zero key, e.g. from :func:`host_key`
+        :return: None if the table is full
+        """
+        index = key % self.count
+        for _ in range(self.count):
+            offset = self.base + index * self.size
+            slot_key, = _KEY.unpack_from(self.buf, offset)
+            if slot_key == key:
+                return offset
+            if slot_key == 0:
+                self.buf[offset:offset + self.size] = bytes(self.size)
+                _KEY.pack_into(self.buf, offset, key)
+                return offset
+            index = (index + 1) % self.count
+        return None
+
+    def occupied(self) -> Iterator[int]:
+        """
+        :return: Offsets of the slots that have a key
+        """
+        for index in range(self.count):
+            offset = self.base + index * self.size
+            if _KEY.unpack_from(self.buf, offset)[0]:
+                yield offset
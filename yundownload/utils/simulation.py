@@ -0,0 +1,281 @@
+"""
+Offline simulation of the adaptive concurrency controller
+
+The controller and its semaphore are driven by synthetic servers on an event loop whose clock is
+virtual: sleeping advances the clock instantly, so minutes of traffic take milliseconds and a run
+is fully reproducible from its seed. Run ``python -m yundownload.utils.simulation`` for a report
+of the built-in scenarios.
+"""
+import asyncio
+import json
+import random
+import statistics
+
+from .equilibrium import DynamicConcurrencyController, DynamicSemaphore
+from .logger import logger
+
+
+class VirtualClock:
+    """
+    Clock of a simulation, it only moves when every task of the loop is waiting
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def new_event_loop(self) -> asyncio.AbstractEventLoop:
+        """
+        Event loop that jumps to the next timer instead of waiting for it
+
+        :return: Event loop
+        """
+        loop = asyncio.new_event_loop()
+        select = loop._selector.select
+
+        def advance(timeout=None):
+            if timeout:
+                self.now += timeout
+            return select(0)
+
+        loop.time = self
+        loop._selector.select = advance
+        return loop
+
+
+class ServerModel:
+    """
+    Synthetic server whose latency grows with the number of requests in flight
+
+    Up to ``capacity`` requests are served in ``latency`` seconds, beyond that the requests queue
+    and the latency grows in proportion to the load, so the throughput saturates at
+    ``capacity / latency`` requests per second.
+    """
+
+    def __init__(self, latency: float = 0.05, capacity: int = 16, jitter: float = 0.1):
+        """
+        Server model
+
+        :param latency: Latency in seconds of an unloaded request
+        :param capacity: Requests served in parallel without queueing
+        :param jitter: Relative random deviation of the latency
+        """
+        self.latency = latency
+        self.capacity = capacity
+        self.jitter = jitter
+
+    def response(self, load: int, now: float, rng: random.Random) -> tuple[float, bool]:
+        """
+        Serve one request
+
+        :param load: Requests in flight including this one
+        :param now: Virtual time
+        :param rng: Random generator of the simulation
+        :return: Response time and whether the request succeeded
+        """
+        latency = self.latency * max(1.0, load / self.capacity)
+        return latency * (1 + rng.uniform(-self.jitter, self.jitter)), True
+
+
+class ErrorSpike(ServerModel):
+    """
+    Server that fails a share of the requests during a period of time
+    """
+
+    def __init__(self, server: ServerModel, start: float, end: float, error_rate: float = 0.5):
+        """
+        Error spike
+
+        :param server: Server the spike is applied to
+        :param start: Virtual time the spike starts
+        :param end: Virtual time the spike ends
+        :param error_rate: Share of the requests that fail during the spike
+        """
+        super().__init__(server.latency, server.capacity, server.jitter)
+        self.server = server
+        self.start = start
+        self.end = end
+        self.error_rate = error_rate
+
+    def response(self, load: int, now: float, rng: random.Random) -> tuple[float, bool]:
+        latency, success = self.server.response(load, now, rng)
+        if self.start <= now < self.end and rng.random() < self.error_rate:
+            return latency, False
+        return latency, success
+
+
+class RateLimitCliff(ServerModel):
+    """
+    Server that rejects every request beyond a number in flight, like a 429 or 503 limit
+    """
+
+    def __init__(self, server: ServerModel, limit: int, reject_latency: float = 0.005):
+        """
+        Rate limit cliff
+
+        :param server: Server the limit is applied to
+        :param limit: Maximum number of requests in flight
+        :param reject_latency: Response time of a rejected request
+        """
+        super().__init__(server.latency, server.capacity, server.jitter)
+        self.server = server
+        self.limit = limit
+        self.reject_latency = reject_latency
+
+    def response(self, load: int, now: float, rng: random.Random) -> tuple[float, bool]:
+        if load > self.limit:
+            return self.reject_latency, False
+        return self.server.response(load, now, rng)
+
+
+class SimulationReport:
+    """
+    Outcome of a simulation
+    """
+    __slots__ = ('duration', 'requests', 'failures', 'throughput', 'convergence_time', 'final_concurrency',
+                 'oscillation', 'reversals', 'concurrency')
+
+    def __init__(self, duration: float, requests: int, failures: int, throughput: float,
+                 convergence_time: float | None, final_concurrency: float, oscillation: float, reversals: int,
+                 concurrency: list[tuple[float, int]]):
+        """
+        Simulation report
+
+        :param duration: Simulated time in seconds
+        :param requests: Number of requests made
+        :param failures: Number of failed requests
+        :param throughput: Successful requests per second
+        :param convergence_time: Time after which the concurrency stayed near its final value,
+            None if it did not settle
+        :param final_concurrency: Median concurrency of the last quarter of the run
+        :param oscillation: Coefficient of variation of the concurrency in the second half of the run
+        :param reversals: Number of times the concurrency changed direction in the second half of the run
+        :param concurrency: Concurrency over time as (time, target) pairs
+        """
+        self.duration = duration
+        self.requests = requests
+        self.failures = failures
+        self.throughput = throughput
+        self.convergence_time = convergence_time
+        self.final_concurrency = final_concurrency
+        self.oscillation = oscillation
+        self.reversals = reversals
+        self.concurrency = concurrency
+
+    def to_dict(self, trace: bool = False) -> dict:
+        """
+        :param trace: Whether to include the concurrency over time
+        :return: Report as plain data
+        """
+        report = {name: getattr(self, name) for name in self.__slots__}
+        if not trace:
+            report.pop('concurrency')
+        return report
+
+    def __repr__(self):
+        return f'<SimulationReport {self.throughput:.1f}/s {self.final_concurrency} {self.oscillation:.2f}>'
+
+
+def _report(duration: float, requests: int, failures: int, trace: list[tuple[float, int]],
+            tolerance: float) -> SimulationReport:
+    settled = [target for now, target in trace if now >= duration * 0.75] or [trace[-1][1]]
+    final = statistics.median(settled)
+    band = max(1.0, final * tolerance)
+    convergence_time = 0.0
+    for now, target in trace:
+        if abs(target - final) > band:
+            convergence_time = now
+    if convergence_time >= duration * 0.75:
+        convergence_time = None
+
+    second_half = [target for now, target in trace if now >= duration / 2] or [trace[-1][1]]
+    mean = statistics.fmean(second_half)
+    oscillation = statistics.pstdev(second_half) / mean if mean else 0.0
+    reversals = 0
+    direction = 0
+    for previous, current in zip(second_half, second_half[1:]):
+        step = (current > previous) - (current < previous)
+        if step and direction and step != direction:
+            reversals += 1
+        direction = step or direction
+    return SimulationReport(
+        duration=duration,
+        requests=requests,
+        failures=failures,
+        throughput=(requests - failures) / duration,
+        convergence_time=convergence_time,
+        final_concurrency=final,
+        oscillation=oscillation,
+        reversals=reversals,
+        concurrency=trace
+    )
+
+
+def simulate(server: ServerModel, duration: float = 300, min_concurrency: int = 2, max_concurrency: int = 30,
+             window_size: int = 100, seed: int = 0, tolerance: float = 0.1) -> SimulationReport:
+    """
+    Run the controller against a server model
+
+    The workers behave like the sliced HTTP download: ``max_concurrency`` tasks share one semaphore,
+    a failed request only records the failure and a successful one also updates the concurrency.
+
+    :param server: Server model
+    :param duration: Simulated time in seconds
+    :param min_concurrency: Minimum concurrency of the controller
+    :param max_concurrency: Maximum concurrency of the controller
+    :param window_size: Sampling window of the controller
+    :param seed: Seed of the random generator
+    :param tolerance: Relative band around the final concurrency that counts as converged
+    :return: Simulation report
+    """
+    clock = VirtualClock()
+    rng = random.Random(seed)
+    counters = {'load': 0, 'requests': 0, 'failures': 0}
+    trace: list[tuple[float, int]] = []
+
+    async def worker(sem: DynamicSemaphore):
+        while clock() < duration:
+            async with sem:
+                counters['load'] += 1
+                response_time, success = server.response(counters['load'], clock(), rng)
+                await asyncio.sleep(response_time)
+                counters['load'] -= 1
+                counters['requests'] += 1
+                if not success:
+                    counters['failures'] += 1
+                    sem.record_result(success=False)
+                    continue
+                sem.record_result(response_time, True)
+                await sem.adaptive_update()
+            if not trace or trace[-1][1] != sem.current_target:
+                trace.append((clock(), sem.current_target))
+
+    async def main():
+        dcc = DynamicConcurrencyController(min_concurrency, max_concurrency, window_size, clock=clock)
+        sem = DynamicSemaphore(dcc)
+        trace.append((clock(), sem.current_target))
+        await asyncio.gather(*(worker(sem) for _ in range(max_concurrency)))
+
+    loop = clock.new_event_loop()
+    level = logger.level
+    # Every adjustment is logged at info, which would flood the output of a long run
+    logger.setLevel('WARNING')
+    try:
+        loop.run_until_complete(main())
+    finally:
+        logger.setLevel(level)
+        loop.close()
+    return _report(duration, counters['requests'], counters['failures'], trace, tolerance)
+
+
+SCENARIOS = {
+    'steady': lambda: ServerModel(latency=0.05, capacity=16),
+    'error_spike': lambda: ErrorSpike(ServerModel(latency=0.05, capacity=16), start=100, end=130, error_rate=0.5),
+    'rate_limit': lambda: RateLimitCliff(ServerModel(latency=0.05, capacity=32), limit=8),
+}
+
+
+if __name__ == '__main__':
+    print(json.dumps({name: simulate(factory()).to_dict() for name, factory in SCENARIOS.items()}, indent=2))
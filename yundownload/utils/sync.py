@@ -0,0 +1,124 @@
+import posixpath
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from ..utils.config import DEFAULT_SYNC_LIST_WORKERS
+from ..utils.logger import logger
+
+# Entries of a directory listing as (name, is_dir, size, mtime)
+ListDir = Callable[[str], Iterable[tuple[str, bool, int, float]]]
+
+
+class RemoteFile:
+    """
+    File found while listing a remote directory tree
+    """
+    __slots__ = ('path', 'size', 'mtime')
+
+    def __init__(self, path: str, size: int, mtime: float):
+        """
+        Remote file
+
+        :param path: Path relative to the listed directory, separated by ``/``
+        :param size: Size in bytes
+        :param mtime: Modification time as a timestamp
+        """
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+
+    def __repr__(self):
+        return f'<RemoteFile {self.path} {self.size} {self.mtime}>'
+
+
+def walk_tree(list_dir: ListDir, root: str, workers: int = DEFAULT_SYNC_LIST_WORKERS) -> Iterator[RemoteFile]:
+    """
+    List a remote directory tree, several directories at once
+
+    Files are yielded as soon as the listing of their directory arrives, so downloads can start
+    while the rest of the tree is still being listed.
+
+    :param list_dir: Lists one directory, called in worker threads
+    :param root: Directory to list
+    :param workers: Number of directories listed at once
+    :return: Files of the tree with paths relative to the root
+    """
+    executor = ThreadPoolExecutor(max(1, workers), thread_name_prefix='yundownload-list')
+    pending: dict[Future, str] = {executor.submit(list_dir, root): ''}
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                relative = pending.pop(future)
+                for name, is_dir, size, mtime in future.result():
+                    path = posixpath.join(relative, name) if relative else name
+                    if is_dir:
+                        pending[executor.submit(list_dir, posixpath.join(root, path))] = path
+                    else:
+                        yield RemoteFile(path, size, mtime)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+class SyncIndex:
+    """
+    sqlite index of the files a mirror downloaded, with the size and modification time of the remote file
+
+    A file whose remote size and modification time still match its entry is not transferred again.
+    Entries are written in batches, an interrupted mirror loses at most the last batch and downloads
+    those files once more.
+    """
+
+    _BATCH = 1000
+
+    def __init__(self, path: str | Path):
+        """
+        Mirror index
+
+        :param path: sqlite database path
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL)')
+        self._pending = 0
+
+    def get(self, path: str) -> tuple[int, float] | None:
+        """
+        Size and modification time recorded for a file
+
+        :param path: Relative path of the file
+        :return: None if the file was never downloaded
+        """
+        return self._db.execute('SELECT size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+
+    def put(self, remote: RemoteFile):
+        """
+        Record a downloaded file
+
+        :param remote: Remote file
+        """
+        if not self._pending:
+            self._db.execute('BEGIN')
+        self._db.execute('INSERT OR REPLACE INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                         (remote.path, remote.size, remote.mtime))
+        self._pending += 1
+        if self._pending >= self._BATCH:
+            self.commit()
+
+    def commit(self):
+        if self._pending:
+            try:
+                self._db.execute('COMMIT')
+            except sqlite3.Error as e:
+                logger.warning(f'sync index write failed: {e}')
+            self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._db.close()
@@ -0,0 +1,205 @@
+import asyncio
+import multiprocessing
+import os
+import struct
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Mapping
+from urllib.parse import urlparse
+
+from ..utils.logger import logger
+from ..utils.shared import SlotTable, host_key
+
+if TYPE_CHECKING:
+    from ..core.resources import Resources
+
+# host key, theoretical arrival time
+_BUCKET = struct.Struct('<qd')
+_HOST_BUCKETS = 1024
+# Smallest chunk handed out while throttled, and the share of a second a chunk should take at most
+_MIN_CHUNK_SIZE = 16 * 1024
+_PACING_INTERVAL = 0.05
+
+_limiter: 'BandwidthLimiter | None' = None
+
+
+def _reserve(tat: float, now: float, nbytes: int, rate: float, burst: float) -> tuple[float, float]:
+    """
+    Reserve bytes on a token bucket kept as a theoretical arrival time (GCRA)
+
+    The bytes are charged at once and the caller waits until the bucket has paid them off, so
+    concurrent consumers queue behind each other instead of bursting together.
+
+    :return: New arrival time and the delay before the bytes may be used
+    """
+    tat = max(tat, now) + nbytes / rate
+    return tat, max(0.0, tat - now - burst)
+
+
+def install_limiter(limiter: 'BandwidthLimiter | None'):
+    """
+    Make the limiter of the downloader the one the handlers of this process use
+
+    :param limiter: Shared bandwidth limiter
+    """
+    global _limiter
+    _limiter = limiter
+
+
+class BandwidthLimiter:
+    """
+    Token buckets shared by all worker processes of a downloader
+
+    One bucket limits the total rate, per-host buckets live in a fixed hash table in shared memory.
+    The buckets are updated under a process shared lock, which is only held for the arithmetic.
+    """
+
+    def __init__(self, rate: int = None, host_rate: int | Mapping[str, int] = None, burst: float = 0.1):
+        """
+        Bandwidth limiter
+
+        :param rate: Total rate in bytes per second
+        :param host_rate: Rate of each host in bytes per second, or a mapping of host names to rates
+            where ``*`` is the rate of the hosts not listed
+        :param burst: Time in seconds an idle bucket may save up
+        """
+        if os.name == 'posix':
+            resource_tracker.ensure_running()
+        self.rate = rate
+        self.host_rate = host_rate
+        self.burst = burst
+        self._lock = multiprocessing.Lock()
+        self._memory = SharedMemory(create=True, size=_BUCKET.size * (_HOST_BUCKETS + 1))
+        self._owner = True
+        self._full_warned = False
+        self._hosts = SlotTable(self._memory.buf, _BUCKET.size, _BUCKET.size, _HOST_BUCKETS)
+
+    def __getstate__(self):
+        return self.rate, self.host_rate, self.burst, self._lock, self._memory.name
+
+    def __setstate__(self, state):
+        self.rate, self.host_rate, self.burst, self._lock, name = state
+        self._memory = SharedMemory(name=name)
+        self._owner = False
+        self._full_warned = False
+        self._hosts = SlotTable(self._memory.buf, _BUCKET.size, _BUCKET.size, _HOST_BUCKETS)
+
+    def rate_of(self, host: str) -> int | None:
+        """
+        :param host: Host name
+        :return: Rate limit of the host, None if it is not limited
+        """
+        if isinstance(self.host_rate, Mapping):
+            return self.host_rate.get(host, self.host_rate.get('*'))
+        return self.host_rate
+
+    def _host_offset(self, host: str) -> int | None:
+        offset = self._hosts.offset(host_key(host))
+        if offset is None and not self._full_warned:
+            self._full_warned = True
+            logger.warning(f'bandwidth limiter host table is full, {host} is not limited per host')
+        return offset
+
+    def reserve(self, host: str, nbytes: int, now: float = None) -> float:
+        """
+        Charge bytes to the total and host buckets
+
+        :param host: Host name the bytes came from
+        :param nbytes: Number of bytes
+        :param now: Current monotonic time
+        :return: Time in seconds to wait before using the bytes
+        """
+        host_rate = self.rate_of(host)
+        if not self.rate and not host_rate:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        delay = 0.0
+        buf = self._memory.buf
+        with self._lock:
+            if self.rate:
+                _, tat = _BUCKET.unpack_from(buf, 0)
+                tat, wait = _reserve(tat, now, nbytes, self.rate, self.burst)
+                _BUCKET.pack_into(buf, 0, 0, tat)
+                delay = max(delay, wait)
+            if host_rate:
+                offset = self._host_offset(host)
+                if offset is not None:
+                    key, tat = _BUCKET.unpack_from(buf, offset)
+                    tat, wait = _reserve(tat, now, nbytes, host_rate, self.burst)
+                    _BUCKET.pack_into(buf, offset, key, tat)
+                    delay = max(delay, wait)
+        return delay
+
+    def close(self):
+        """
+        Free the shared memory, only the process that created the limiter unlinks it
+        """
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+
+class Throttle:
+    """
+    Paces the chunk loop of one download against its own rate and the shared limiter of the process
+    """
+
+    def __init__(self, resources: 'Resources'):
+        """
+        Download throttle
+
+        :param resources: Resource object
+        """
+        self.host = urlparse(resources.uri).hostname or ''
+        self.rate = resources.rate_limit
+        self.burst = _limiter.burst if _limiter is not None else 0.1
+        self._limiter = _limiter
+        self._tat = 0.0
+
+    def chunk_size(self, default: int) -> int:
+        """
+        Chunk size that keeps the pacing smooth, each chunk takes at most a fraction of a second
+
+        :param default: Chunk size when the download is not limited
+        :return: Chunk size
+        """
+        rates = [self.rate]
+        if self._limiter is not None:
+            rates += [self._limiter.rate, self._limiter.rate_of(self.host)]
+        rates = [rate for rate in rates if rate]
+        if not rates:
+            return default
+        return max(_MIN_CHUNK_SIZE, min(default, int(min(rates) * _PACING_INTERVAL)))
+
+    def delay(self, nbytes: int, host: str = None) -> float:
+        """
+        Charge bytes to every bucket of the download
+
+        :param nbytes: Number of bytes received
+        :param host: Host the bytes came from, the host of the resource by default
+        :return: Time in seconds to wait before receiving more
+        """
+        now = time.monotonic()
+        delay = 0.0
+        if self.rate:
+            self._tat, delay = _reserve(self._tat, now, nbytes, self.rate, self.burst)
+        if self._limiter is not None:
+            delay = max(delay, self._limiter.reserve(host or self.host, nbytes, now))
+        return delay
+
+    def consume(self, nbytes: int, host: str = None):
+        """
+        Charge bytes and block until they are paid off
+        """
+        delay = self.delay(nbytes, host)
+        if delay:
+            time.sleep(delay)
+
+    async def aconsume(self, nbytes: int, host: str = None):
+        """
+        Charge bytes and wait until they are paid off without blocking the event loop
+        """
+        delay = self.delay(nbytes, host)
+        if delay:
+            await asyncio.sleep(delay)
@@ -1,12 +1,14 @@
 import asyncio
+import errno
+import os
 import time
 from pathlib import Path
 from random import randint
 from string import Template
 from threading import Thread, Event
-from typing import Callable, Union, TypeVar, ParamSpec, Awaitable
+from typing import Callable, Union, TypeVar, ParamSpec, Awaitable, BinaryIO
 
-from ..utils.config import DEFAULT_SLICED_FILE_SUFFIX
+from ..utils.config import DEFAULT_SLICED_FILE_SUFFIX, DEFAULT_CHUNK_SIZE
 from ..utils.logger import logger
 
 T = TypeVar('T')
@@ -25,6 +27,105 @@ def convert_slice_path(path: Path) -> Callable[[int], Path]:
     return render_slice_path
 
 
+def convert_state_path(path: Path) -> Path:
+    """
+    Get the path of the state file that records the progress of a sliced download
+
+    :param path: The path where the resource is saved
+    :return: State file path
+    """
+    return path.with_name(path.name + DEFAULT_SLICED_FILE_SUFFIX)
+
+
+# Errors of posix_fallocate that mean the file system cannot reserve blocks
+_FALLOCATE_UNSUPPORTED = {errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS}
+
+
+def preallocate_file(path: Path, size: int):
+    """
+    Extend or truncate the file to the specified size, creating it if necessary
+
+    The blocks are reserved with ``posix_fallocate`` where the file system supports it, so a full disk
+    fails here instead of in the middle of the download. Elsewhere the file is extended sparsely.
+
+    :param path: File path
+    :param size: Target file size
+    """
+    with path.open('r+b' if path.exists() else 'wb') as f:
+        if os.fstat(f.fileno()).st_size > size:
+            f.truncate(size)
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError as e:
+                if e.errno not in _FALLOCATE_UNSUPPORTED:
+                    raise
+        f.truncate(size)
+
+
+# Errors of the kernel copy calls that mean the files do not support them
+_COPY_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+def _kernel_copy(src_fd: int, dst_fd: int, offset: int, position: int, count: int) -> int:
+    """
+    Copy bytes between files without passing them through Python, with copy_file_range or sendfile
+
+    :return: Number of bytes copied, less than count if the kernel cannot copy these files
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < count:
+                n = os.copy_file_range(src_fd, dst_fd, count - copied, offset + copied, position + copied)
+                if not n:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED:
+                raise
+    if copied < count and hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dst_fd, position + copied, os.SEEK_SET)
+            while copied < count:
+                n = os.sendfile(dst_fd, src_fd, offset + copied, count - copied)
+                if not n:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED:
+                raise
+    return copied
+
+
+def copy_file(src: BinaryIO, dst: BinaryIO, buffer: bytearray = None) -> int:
+    """
+    Append the rest of src to dst from their current positions
+
+    The kernel copies the data where the platform and the file systems allow it, otherwise the data
+    goes through one reusable buffer.
+
+    :param src: Source file opened for binary reading
+    :param dst: Destination file opened for binary writing
+    :param buffer: Buffer of the fallback copy
+    :return: Number of bytes copied
+    """
+    dst.flush()
+    offset, position = src.tell(), dst.tell()
+    count = max(0, os.fstat(src.fileno()).st_size - offset)
+    copied = _kernel_copy(src.fileno(), dst.fileno(), offset, position, count)
+    src.seek(offset + copied)
+    dst.seek(position + copied)
+    if copied < count:
+        buffer = buffer if buffer is not None else bytearray(DEFAULT_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while n := src.readinto(buffer):
+            dst.write(view[:n])
+            copied += n
+    return copied
+
+
 def retry(
         retry_count: int = 1,
         retry_delay: Union[int, tuple[float, float]] = 2,
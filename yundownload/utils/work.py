@@ -1,17 +1,72 @@
 from concurrent.futures import Future
-from typing import Type, TYPE_CHECKING
+from typing import Type, TYPE_CHECKING, Callable
 from .core import Result
+from .progress import Phase, ProgressSnapshot
 
 if TYPE_CHECKING:
     from network import BaseProtocolHandler
     from ..core.resources import Resources
+    from .progress import ProgressBoard, ProgressSlot
 
 
 class WorkerFuture:
-    def __init__(self, future: Future, protocol: Type['BaseProtocolHandler'], resources: 'Resources'):
+    def __init__(self, future: Future, protocol: Type['BaseProtocolHandler'], resources: 'Resources',
+                 progress_board: 'ProgressBoard' = None, progress_slot: 'ProgressSlot' = None):
         self._future = future
         self._protocol = protocol
         self.resources = resources
+        self._progress_board = progress_board
+        self._progress_slot = progress_slot
+        self._snapshot: ProgressSnapshot | None = None
+        if progress_board is not None:
+            self._future.add_done_callback(self._release_progress)
+
+    def _release_progress(self, _):
+        """
+        Keep the final progress and give the slot back to the board
+        """
+        self._snapshot = self._progress_board.read(self._progress_slot)
+        self._progress_board.release(self._progress_slot)
+
+    @property
+    def snapshot(self) -> 'ProgressSnapshot':
+        """
+        Latest progress published by the worker process
+        """
+        if self._progress_board is None:
+            return ProgressSnapshot()
+        if self._snapshot is None:
+            snapshot = self._progress_board.read(self._progress_slot)
+            # The slot may have been released and reused while reading
+            return self._snapshot or snapshot
+        return self._snapshot
+
+    @property
+    def progress(self) -> float:
+        """
+        :return: 下载进度
+        """
+        return self.snapshot.progress
+
+    @property
+    def speed(self) -> float:
+        """
+        :return: 下载速度（字节/秒）
+        """
+        return self.snapshot.speed
+
+    @property
+    def phase(self) -> 'Phase':
+        """
+        :return: 下载阶段
+        """
+        return self.snapshot.phase
+
+    def add_done_callback(self, fn: Callable[['WorkerFuture'], None]):
+        """
+        任务完成后调用 fn(self)
+        """
+        self._future.add_done_callback(lambda _: fn(self))
 
     def wait(self):
         self._future.result()
@@ -0,0 +1,252 @@
+import asyncio
+import collections
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Literal
+
+from ..utils.config import DEFAULT_WRITE_BUFFER_SIZE, DEFAULT_WRITE_COALESCE_SIZE, DEFAULT_FSYNC_POLICY
+from ..utils.logger import logger
+
+FsyncPolicy = Literal['never', 'checkpoint', 'close']
+
+_pwritev = getattr(os, 'pwritev', None)
+_pwrite = getattr(os, 'pwrite', None)
+# Most platforms accept at most IOV_MAX (1024) buffers per call
+_MAX_BUFFERS = 1024
+
+
+class WriteBehind:
+    """
+    Write-behind stage between the download coroutines and the disk
+
+    Coroutines queue ``(file, offset, data)`` items and go on receiving, one writer thread merges
+    adjacent items of the same file into one positional vectored write. The queue is bounded in
+    bytes, a coroutine queueing beyond it waits for the disk, which slows down the network side
+    instead of buffering without limit. Callbacks queued with ``call_after`` run on the event loop
+    once everything queued before them is written, which is how journal records are kept behind
+    the data they describe.
+    """
+
+    def __init__(self, max_pending: int = DEFAULT_WRITE_BUFFER_SIZE, coalesce_size: int = DEFAULT_WRITE_COALESCE_SIZE,
+                 fsync: FsyncPolicy = DEFAULT_FSYNC_POLICY):
+        """
+        Write-behind writer
+
+        :param max_pending: Maximum number of queued bytes before writers wait
+        :param coalesce_size: Maximum number of bytes merged into one write
+        :param fsync: ``never`` leaves flushing to the OS, ``checkpoint`` syncs the files before each
+            callback and when they are closed, ``close`` only syncs when they are closed
+        """
+        if fsync not in ('never', 'checkpoint', 'close'):
+            raise ValueError(f'unknown fsync policy: {fsync}')
+        self.max_pending = max_pending
+        self.coalesce_size = coalesce_size
+        self.fsync = fsync
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._items: collections.deque = collections.deque()
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._space: asyncio.Event | None = None
+        self._thread: threading.Thread | None = None
+        self._error: BaseException | None = None
+        self._dirty: set[int] = set()
+
+    def open(self, path: Path, truncate: bool = False) -> int:
+        """
+        Open a file for positional writes
+
+        :param path: File path, it is created if missing
+        :param truncate: Whether to empty the file
+        :return: File descriptor to queue writes for
+        """
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if truncate:
+            flags |= os.O_TRUNC
+        return os.open(path, flags, 0o666)
+
+    def _start(self):
+        if self._thread is None:
+            self._loop = asyncio.get_running_loop()
+            self._space = asyncio.Event()
+            self._thread = threading.Thread(target=self._run, name='yundownload-writer', daemon=True)
+            self._thread.start()
+
+    def _put(self, item: tuple, size: int = 0):
+        with self._condition:
+            self._pending += size
+            self._items.append(item)
+            self._condition.notify()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise IOError(f'write-behind failed: {self._error}') from self._error
+
+    async def write(self, fd: int, offset: int, data: bytes):
+        """
+        Queue data to be written at an offset, waiting while the queue is full
+
+        :param fd: File descriptor returned by open
+        :param offset: Offset in the file
+        :param data: Data, it must not be modified afterwards
+        """
+        self._raise_error()
+        self._start()
+        while True:
+            self._space.clear()
+            if self._pending < self.max_pending:
+                break
+            await self._space.wait()
+            self._raise_error()
+        self._put(('write', fd, offset, data), len(data))
+
+    def call_after(self, callback: Callable, *args):
+        """
+        Run a callback on the event loop once everything queued so far is written
+
+        :param callback: Callback, e.g. recording a journal range
+        :param args: Arguments of the callback
+        """
+        self._start()
+        self._put(('call', callback, args))
+
+    async def flush(self):
+        """
+        Wait until everything queued so far is written
+        """
+        self._start()
+        future = self._loop.create_future()
+        self._put(('call', future.set_result, (None,)))
+        await future
+        self._raise_error()
+
+    async def close_file(self, fd: int):
+        """
+        Write what is queued for the file, sync it according to the policy and close it
+
+        :param fd: File descriptor returned by open
+        """
+        self._start()
+        future = self._loop.create_future()
+        self._put(('close', fd, future))
+        await future
+        self._raise_error()
+
+    async def aclose(self):
+        """
+        Write everything queued and stop the writer thread
+        """
+        if self._thread is None:
+            return
+        future = self._loop.create_future()
+        self._put(('stop', future))
+        await future
+        self._thread.join()
+        self._thread = None
+        self._raise_error()
+
+    def _notify(self, callback: Callable, *args):
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The loop was closed while the writer was still running
+            pass
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._items:
+                    self._condition.wait()
+                item = self._items.popleft()
+            kind = item[0]
+            if kind == 'write':
+                self._write_batch(item)
+                self._notify(self._space.set)
+            elif kind == 'call':
+                _, callback, args = item
+                if self._error is None:
+                    self._sync(self.fsync == 'checkpoint')
+                    self._notify(callback, *args)
+                elif isinstance(getattr(callback, '__self__', None), asyncio.Future):
+                    # Waiters of flush must wake up to see the error, other callbacks are dropped
+                    self._notify(callback, *args)
+            elif kind == 'close':
+                _, fd, future = item
+                try:
+                    if self._error is None and self.fsync != 'never':
+                        os.fsync(fd)
+                    os.close(fd)
+                except OSError as e:
+                    self._error = self._error or e
+                self._dirty.discard(fd)
+                self._notify(future.set_result, None)
+            elif kind == 'stop':
+                self._notify(item[1].set_result, None)
+                return
+
+    def _write_batch(self, first: tuple):
+        """
+        Write the first item together with the writes queued behind it
+
+        The writes up to the next callback are sorted by file and offset, so chunks of different
+        ranges that arrived interleaved are still merged with the chunks they continue.
+        """
+        items = [first]
+        size = len(first[3])
+        with self._condition:
+            while self._items and size < self.coalesce_size and self._items[0][0] == 'write':
+                item = self._items.popleft()
+                items.append(item)
+                size += len(item[3])
+        items.sort(key=lambda item: (item[1], item[2]))
+        run: list = []
+        fd = offset = end = None
+        for _, item_fd, item_offset, data in items:
+            if run and (item_fd != fd or item_offset != end or len(run) >= _MAX_BUFFERS):
+                self._write_run(fd, offset, run)
+                run = []
+            if not run:
+                fd, offset, end = item_fd, item_offset, item_offset
+            run.append(data)
+            end += len(data)
+        self._write_run(fd, offset, run)
+        with self._condition:
+            self._pending -= size
+
+    def _write_run(self, fd: int, offset: int, buffers: list[bytes]):
+        if self._error is not None:
+            return
+        try:
+            self._pwrite(fd, buffers, offset)
+            self._dirty.add(fd)
+        except OSError as e:
+            logger.error(f'write-behind failed: {e}')
+            self._error = e
+
+    @staticmethod
+    def _pwrite(fd: int, buffers: list[bytes], offset: int):
+        while buffers:
+            if _pwritev is not None:
+                written = _pwritev(fd, buffers, offset)
+            elif _pwrite is not None:
+                written = _pwrite(fd, buffers[0], offset)
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, buffers[0])
+            offset += written
+            # Drop the buffers written completely and keep the rest of a partly written one
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers[0])
+                buffers.pop(0)
+            if buffers and written:
+                buffers[0] = memoryview(buffers[0])[written:]
+
+    def _sync(self, enabled: bool):
+        if not enabled:
+            return
+        for fd in list(self._dirty):
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                self._error = self._error or e
+        self._dirty.clear()